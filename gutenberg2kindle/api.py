@@ -0,0 +1,798 @@
+"""
+Programmatic API to download and send books, meant to be used as a library:
+it never prompts, prints anything or exits the process, and reports the
+outcome of every book as a result object instead
+"""
+
+import socket
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass, field
+from io import BytesIO
+from itertools import chain
+from typing import Callable, Final, Iterable, Iterator, Mapping, Optional, Union
+
+import requests
+
+from gutenberg2kindle.budget import ByteBudget
+from gutenberg2kindle.cache import BookCache, content_digest
+from gutenberg2kindle.config import (
+    SETTINGS_KINDLE_EMAIL,
+    ensure_settings,
+    get_config,
+    resolve_config,
+)
+from gutenberg2kindle.email import (
+    SMTP_ERROR_AUTH,
+    SMTP_ERROR_CONNECTION,
+    SMTP_ERROR_REJECTED,
+    SMTP_ERROR_TRANSIENT,
+    BookFile,
+    SmtpSession,
+    classify_smtp_error,
+    get_book_size,
+    get_book_view,
+    get_size_limit_in_bytes,
+    is_valid_file_size,
+    map_book,
+    send_book,
+)
+from gutenberg2kindle.epub import compact_epub, split_epub
+from gutenberg2kindle.gutenberg import (
+    Book,
+    download_book,
+    estimate_book_size,
+    get_reserved_bytes,
+    verify_book,
+)
+from gutenberg2kindle.network import DNS_CACHE, create_http_session
+from gutenberg2kindle.pool import Passwords, SenderPool
+from gutenberg2kindle.preflight import (
+    CHECK_GUTENBERG,
+    CHECK_SMTP,
+    CheckResult,
+    run_checks,
+)
+from gutenberg2kindle.progress import ProgressReporter
+from gutenberg2kindle.schedule import SCHEDULE_INPUT, schedule_books
+from gutenberg2kindle.spool import Spool, SpoolEntry
+
+STATUS_SENT: Final[str] = "sent"
+STATUS_SPOOLED: Final[str] = "spooled"
+STATUS_NOT_DOWNLOADED: Final[str] = "not_downloaded"
+STATUS_CORRUPT: Final[str] = "corrupt"
+STATUS_TOO_LARGE: Final[str] = "too_large"
+STATUS_DUPLICATE: Final[str] = "duplicate"
+STATUS_ALREADY_SENT: Final[str] = "already_sent"
+STATUS_NOT_COMPACTED: Final[str] = "not_compacted"
+STATUS_NOT_SPLIT: Final[str] = "not_split"
+STATUS_SMTP_ERROR: Final[str] = "smtp_error"
+STATUS_SMTP_UNAVAILABLE: Final[str] = "smtp_unavailable"
+STATUS_REJECTED: Final[str] = "rejected"
+STATUS_GUTENBERG_UNREACHABLE: Final[str] = "gutenberg_unreachable"
+STATUS_SKIPPED: Final[str] = "skipped"
+
+# statuses of the errors that stop a batch, as no other book can be sent
+STOPPING_STATUSES: Final[tuple[str, ...]] = (
+    STATUS_SMTP_ERROR,
+    STATUS_SMTP_UNAVAILABLE,
+    STATUS_GUTENBERG_UNREACHABLE,
+)
+SMTP_ERROR_STATUSES: Final[dict[str, str]] = {
+    SMTP_ERROR_AUTH: STATUS_SMTP_ERROR,
+    SMTP_ERROR_REJECTED: STATUS_REJECTED,
+    SMTP_ERROR_TRANSIENT: STATUS_SMTP_UNAVAILABLE,
+    SMTP_ERROR_CONNECTION: STATUS_SMTP_UNAVAILABLE,
+}
+
+EVENT_SENDING: Final[str] = "sending"
+EVENT_SENDING_VOLUME: Final[str] = "sending_volume"
+EVENT_SPOOLING: Final[str] = "spooling"
+EVENT_SPOOLING_VOLUME: Final[str] = "spooling_volume"
+EVENT_COMPACTING: Final[str] = "compacting"
+
+DEFAULT_WORKERS: Final[int] = 8
+DEFAULT_RETRIES: Final[int] = 2
+RETRY_DELAY_IN_SECONDS: Final[float] = 5.0
+
+
+@dataclass
+class SendOptions:  # pylint: disable=too-many-instance-attributes
+    """Options that tweak how a batch of books is downloaded and sent"""
+
+    ignore_errors: bool = False
+    max_memory: Optional[int] = None
+    compact: bool = False
+    split: bool = False
+    cache_dir: Optional[str] = None
+    revalidate: bool = False
+    skip_sent: bool = False
+    workers: int = DEFAULT_WORKERS
+    spool_dir: Optional[str] = None
+    preflight: bool = True
+    verify: bool = True
+    retries: int = DEFAULT_RETRIES
+    schedule: str = SCHEDULE_INPUT
+    priorities: dict[int, int] = field(default_factory=dict)
+
+
+@dataclass
+class BookResult:  # pylint: disable=too-many-instance-attributes
+    """Outcome of downloading and sending a single book"""
+
+    book_id: int
+    status: str = STATUS_SKIPPED
+    size_in_bytes: int = 0
+    digest: Optional[str] = None
+    download_seconds: float = 0.0
+    send_seconds: float = 0.0
+    volumes: int = 0
+    duplicate_of: Optional[int] = None
+    error: Optional[str] = None
+    error_type: Optional[str] = None
+    book_format: Optional[str] = None
+    url: Optional[str] = None
+    recipient: Optional[str] = None
+
+    @property
+    def sent(self) -> bool:
+        """Whether the book was sent"""
+
+        return self.status == STATUS_SENT
+
+    def set_error(self, error: BaseException) -> None:
+        """Records the error that made the book fail, and its type"""
+
+        self.error = str(error)
+        self.error_type = type(error).__name__
+
+
+@dataclass
+class BookEvent:
+    """Something that is about to happen to a book while it's being processed"""
+
+    book_id: int
+    event: str
+    volume: int = 0
+    total_volumes: int = 0
+
+
+PendingCompaction = tuple[BookResult, Future[bytes]]
+PendingDownload = tuple[BookResult, Future[Optional[Book]]]
+
+
+class BookSender:  # pylint: disable=too-many-instance-attributes
+    """
+    Downloads and sends batches of books, sharing one Project Gutenberg
+    session, the SMTP connections and one memory budget across every batch
+    sent through it. Use it as a context manager so its connections
+    are closed afterwards.
+
+    If sender profiles are configured, `password` can map each profile
+    name to its password.
+
+    The stored config, overridden by `config` if given, is resolved once
+    (see `resolve_config`) and passed to everything the sender calls,
+    without changing the stored settings, so that senders with different
+    configs can be used at the same time.
+
+    If a spool directory is set, books are written to the spool instead
+    of being emailed, and are emailed later on with `iter_flush`.
+
+    Unless disabled in the options, every batch starts with a preflight:
+    while the first book is being downloaded, Project Gutenberg is checked
+    (unless there's a cache, as cached books don't need it) and the
+    connection to every SMTP sender profile is opened, or reused if it's
+    still open from the previous batch. If any check fails, the first book
+    is not sent and neither are the rest.
+
+    Books are downloaded one ahead: while a book is verified (unless
+    disabled in the options, see `verify_book`) and sent, the next one
+    is already being downloaded in the background.
+
+    If a progress reporter is given, it's kept up to date with the books
+    started and done, and with the bytes downloaded and sent.
+
+    While books are being checked, scheduled, sent or flushed through it,
+    DNS lookups are cached (see `DnsCache`), and the cache is uninstalled
+    once done so that the rest of the process resolves hosts as usual. New
+    connections resume the TLS session of the previous one to the same
+    host, so that reconnecting is cheap.
+    """
+
+    def __init__(
+        self,
+        password: Passwords,
+        *,
+        config: Optional[Mapping[str, Union[int, str]]] = None,
+        options: Optional[SendOptions] = None,
+        on_event: Optional[Callable[[BookEvent], None]] = None,
+        progress: Optional[ProgressReporter] = None,
+    ) -> None:
+        ensure_settings()
+
+        self.config = resolve_config(config)
+        self.options = options or SendOptions()
+        self.on_event = on_event
+        self.progress = progress
+        self.budget = ByteBudget.from_mb(self.options.max_memory)
+        self.cache = (
+            BookCache(self.options.cache_dir) if self.options.cache_dir else None
+        )
+        self.spool = Spool(self.options.spool_dir) if self.options.spool_dir else None
+        self.http_session = create_http_session()
+        self.smtp_pool = SenderPool.from_config(password, self.config)
+        self._checker = ThreadPoolExecutor(max_workers=1)
+        self._downloader = ThreadPoolExecutor(max_workers=1)
+        self._verifier = ThreadPoolExecutor(max_workers=self.options.workers)
+        self._preflight: Optional[Future[list[CheckResult]]] = None
+
+    def __enter__(self) -> "BookSender":
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """Closes the connections shared by the batches"""
+
+        self._checker.shutdown()
+        self._downloader.shutdown()
+        self._verifier.shutdown()
+        self.smtp_pool.close()
+        self.http_session.close()
+
+    def check(self) -> list[CheckResult]:
+        """
+        Checks that Project Gutenberg can be reached and, unless books are
+        only spooled, that every SMTP sender profile in rotation can log in,
+        returning the result of each check
+        """
+
+        with DNS_CACHE.installed():
+            return self._run_checks(check_gutenberg=True)
+
+    def _run_checks(self, check_gutenberg: bool) -> list[CheckResult]:
+        return run_checks(
+            self.smtp_pool if self.spool is None else None,
+            self.http_session if check_gutenberg else None,
+        )
+
+    def send(self, book_ids: Iterable[int]) -> list[BookResult]:
+        """Downloads and sends the given books, returning one result per book"""
+
+        return list(self.iter_send(book_ids))
+
+    def schedule(self, book_ids: Iterable[int]) -> list[int]:
+        """
+        Returns the given books in the order they should be sent, according
+        to the schedule and priorities in the options (see `schedule_books`).
+        Sizes are estimated without downloading the books, `workers` books
+        at a time, from the cache or from the sizes announced upstream.
+        """
+
+        book_ids = list(book_ids)
+        if self.options.schedule == SCHEDULE_INPUT:
+            return schedule_books(book_ids, SCHEDULE_INPUT, {}, self.options.priorities)
+
+        def _estimate(book_id: int) -> Optional[int]:
+            try:
+                return estimate_book_size(
+                    book_id, self.cache, self.http_session, self.config
+                )
+            except requests.RequestException:
+                return None
+
+        with DNS_CACHE.installed(), ThreadPoolExecutor(
+            max_workers=self.options.workers
+        ) as executor:
+            sizes = dict(zip(book_ids, executor.map(_estimate, book_ids)))
+
+        return schedule_books(
+            book_ids, self.options.schedule, sizes, self.options.priorities
+        )
+
+    def iter_send(self, book_ids: Iterable[int]) -> Iterator[BookResult]:
+        """
+        Downloads and sends the given books, yielding each book's result as
+        soon as it's known. Books being compacted are yielded last.
+
+        If the preflight fails, or no SMTP sender profile can be used
+        anymore (e.g. because their credentials are invalid or their servers
+        are down), the remaining books are not sent and are yielded as
+        skipped. Books rejected by the server don't stop the batch. Profiles
+        taken out of rotation by their circuit breaker in a previous batch
+        are tried again.
+        """
+
+        self.smtp_pool.reactivate()
+        seen_digests: dict[str, int] = {}
+        pending: list[PendingCompaction] = []
+        remaining = iter(book_ids)
+
+        with DNS_CACHE.installed(), (
+            ProcessPoolExecutor() if self.options.compact else nullcontext()
+        ) as executor:
+            if self.options.preflight:
+                # with a cache, books may not need Project Gutenberg at all,
+                # so it's only contacted if a book is missing from the cache
+                self._preflight = self._checker.submit(
+                    self._run_checks, self.cache is None
+                )
+            try:
+                for result in self._iter_batch(
+                    remaining, seen_digests, pending, executor
+                ):
+                    if self.progress is not None:
+                        self.progress.book_done()
+                    yield result
+            finally:
+                self._finish_preflight()
+
+    def _iter_batch(
+        self,
+        remaining: Iterator[int],
+        seen_digests: dict[str, int],
+        pending: list[PendingCompaction],
+        executor: Optional[ProcessPoolExecutor],
+    ) -> Iterator[BookResult]:
+        upcoming = self._submit_download(remaining)
+        try:
+            while upcoming is not None:
+                result, download = upcoming
+                book = download.result()
+                if not self._check_preflight(result):
+                    upcoming = None
+                    if book is not None:
+                        self._release(book)
+                    yield result
+                    yield from self._skip(remaining, pending)
+                    return
+
+                # the next book is downloaded while this one is verified and sent
+                verification = self._verifier.submit(self._verify, result, book)
+                upcoming = self._submit_download(remaining)
+                if not self._process_book(
+                    result, verification.result(), seen_digests, pending, executor
+                ):
+                    continue
+
+                yield result
+                if result.status in STOPPING_STATUSES:
+                    skipped, upcoming = self._discard(upcoming), None
+                    yield from self._skip(chain(skipped, remaining), pending)
+                    return
+        finally:
+            self._discard(upcoming)
+
+        while pending:
+            result = self._send_compacted(*pending.pop(0))
+            yield result
+            if result.status in STOPPING_STATUSES:
+                yield from self._skip(iter([]), pending)
+                return
+
+    def _finish_preflight(self) -> list[CheckResult]:
+        """Waits for the preflight of the batch, if still pending, and returns it"""
+
+        if self._preflight is None:
+            return []
+
+        checks = self._preflight.result()
+        self._preflight = None
+        return checks
+
+    def _check_preflight(self, result: BookResult) -> bool:
+        """
+        Waits for the preflight of the batch, if still pending, returning
+        whether the batch can go on. If it can't, the reason is set as the
+        outcome of the given book
+        """
+
+        checks = self._finish_preflight()
+        for check in checks:
+            if check.target == CHECK_GUTENBERG and not check.ok:
+                result.status = STATUS_GUTENBERG_UNREACHABLE
+                result.error, result.error_type = check.error, check.error_type
+                return False
+
+        smtp_checks = [check for check in checks if check.target == CHECK_SMTP]
+        if smtp_checks and not any(check.ok for check in smtp_checks):
+            assert smtp_checks[0].smtp_error is not None
+            result.status = SMTP_ERROR_STATUSES[smtp_checks[0].smtp_error]
+            result.error = smtp_checks[0].error
+            result.error_type = smtp_checks[0].error_type
+            return False
+
+        return True
+
+    def _emit(self, book_id: int, event: str, volume: int = 0, total: int = 0) -> None:
+        if self.on_event is not None:
+            self.on_event(BookEvent(book_id, event, volume, total))
+
+    def _release(self, book: Book) -> None:
+        self.budget.release(get_reserved_bytes(book))
+        book.close()
+
+    def _skip(
+        self, remaining: Iterator[int], pending: list[PendingCompaction]
+    ) -> Iterator[BookResult]:
+        for result, compaction in pending:
+            compaction.cancel()
+            yield result
+        pending.clear()
+        yield from (BookResult(book_id) for book_id in remaining)
+
+    def _submit_download(self, remaining: Iterator[int]) -> Optional[PendingDownload]:
+        """Starts downloading the next book in the background, if any"""
+
+        book_id = next(remaining, None)
+        if book_id is None:
+            return None
+
+        if self.progress is not None:
+            self.progress.book_started()
+        result = BookResult(book_id)
+        return result, self._downloader.submit(self._download, result)
+
+    def _discard(self, upcoming: Optional[PendingDownload]) -> list[int]:
+        """
+        Waits for a book downloaded ahead that won't be sent, releasing it,
+        and returns its ID, if any, so that it can be skipped
+        """
+
+        if upcoming is None:
+            return []
+
+        result, download = upcoming
+        book = download.result()
+        if book is not None:
+            self._release(book)
+        return [result.book_id]
+
+    def _download(self, result: BookResult) -> Optional[Book]:
+        def _on_resolved(book_format: str, url: str) -> None:
+            result.book_format, result.url = book_format, url
+
+        start = time.perf_counter()
+        try:
+            book = download_book(
+                result.book_id,
+                self.budget,
+                self.cache,
+                self.options.revalidate,
+                self.http_session,
+                self._on_chunk,
+                _on_resolved,
+                self.config,
+            )
+        except requests.RequestException as err:
+            result.set_error(err)
+            book = None
+        finally:
+            result.download_seconds = time.perf_counter() - start
+
+        if book is None:
+            result.status = STATUS_NOT_DOWNLOADED
+        return book
+
+    @property
+    def _on_chunk(self) -> Optional[Callable[[int], None]]:
+        return None if self.progress is None else self.progress.add_downloaded
+
+    def _verify(self, result: BookResult, book: Optional[Book]) -> Optional[Book]:
+        """
+        Verifies a downloaded book, fetching it once more if corrupt, and
+        records its digest and size. Returns None if it's still corrupt
+        """
+
+        if book is None:
+            return None
+
+        if self.options.verify:
+            try:
+                book = verify_book(
+                    result.book_id,
+                    book,
+                    self.budget,
+                    self.cache,
+                    self.http_session,
+                    self._on_chunk,
+                    self.config,
+                )
+            except (ValueError, requests.RequestException) as err:
+                result.status = STATUS_CORRUPT
+                result.set_error(err)
+                return None
+
+        with get_book_view(book) as book_view:
+            result.digest = content_digest(book_view)
+            result.size_in_bytes = book_view.nbytes
+        return book
+
+    def _process_book(
+        self,
+        result: BookResult,
+        book: Optional[Book],
+        seen_digests: dict[str, int],
+        pending: list[PendingCompaction],
+        executor: Optional[ProcessPoolExecutor],
+    ) -> bool:
+        """
+        Sends a downloaded book, returning whether its outcome is known,
+        which isn't the case if it's being compacted
+        """
+
+        if book is None:
+            return True
+
+        if self._is_duplicate(result, seen_digests):
+            self._release(book)
+            return True
+
+        if executor is not None and not is_valid_file_size(book, self.config):
+            self._emit(result.book_id, EVENT_COMPACTING)
+            with get_book_view(book) as book_view:
+                content = bytes(book_view)
+            pending.append((result, executor.submit(compact_epub, content)))
+            # the book is handed to another process, so its budget is given
+            # back right away: books being compacted are only sent once every
+            # download is done, and the downloads must not wait for them
+            self._release(book)
+            return False
+
+        if self.options.split and not is_valid_file_size(book, self.config):
+            self._send_split(result, book)
+        else:
+            self._send_whole(result, book)
+        return True
+
+    def _kindle_email(self) -> str:
+        kindle_email = get_config(SETTINGS_KINDLE_EMAIL, self.config)
+        assert isinstance(kindle_email, str)
+        return kindle_email
+
+    def _is_duplicate(self, result: BookResult, seen_digests: dict[str, int]) -> bool:
+        assert result.digest is not None
+
+        if result.digest in seen_digests:
+            result.status = STATUS_DUPLICATE
+            result.duplicate_of = seen_digests[result.digest]
+            return True
+
+        seen_digests[result.digest] = result.book_id
+        if self.options.skip_sent and self.cache is not None:
+            if self.cache.was_sent(result.digest, self._kindle_email()):
+                result.status = STATUS_ALREADY_SENT
+                return True
+
+        return False
+
+    def _deliver(
+        self, result: BookResult, book: Book, filename: Optional[str] = None
+    ) -> bool:
+        result.recipient = self._kindle_email()
+        if self.spool is None:
+            delivered = self._email(result, book, filename)
+        elif is_valid_file_size(book, self.config):
+            with get_book_view(book) as book_view:
+                self.spool.add(result.book_id, book_view, filename, result.digest)
+            delivered = True
+        else:
+            delivered = False
+
+        if delivered and self.progress is not None:
+            self.progress.add_sent(get_book_size(book))
+        return delivered
+
+    def _email(
+        self, result: BookResult, book: BookFile, filename: Optional[str] = None
+    ) -> bool:
+        result.recipient = self._kindle_email()
+
+        def _send(session: SmtpSession) -> bool:
+            # rewind, as a profile that failed may have already read the book
+            book.seek(0)
+            sent: bool = send_book(
+                result.book_id, book, session.password, filename, session, self.config
+            )
+            return sent
+
+        start = time.perf_counter()
+        try:
+            sent = self.smtp_pool.send(_send, get_book_size(book))
+        except socket.error as err:  # pylint: disable=no-member
+            result.status = SMTP_ERROR_STATUSES[classify_smtp_error(err)]
+            result.set_error(err)
+            return False
+        finally:
+            result.send_seconds += time.perf_counter() - start
+
+        return sent
+
+    def _mark_sent(self, result: BookResult) -> None:
+        if self.spool is not None:
+            result.status = STATUS_SPOOLED
+        else:
+            self._record_sent(result)
+
+    def _record_sent(self, result: BookResult) -> None:
+        result.status = STATUS_SENT
+        if self.cache is not None and result.digest is not None:
+            self.cache.record_sent(result.digest, result.book_id, self._kindle_email())
+
+    def _send_whole(self, result: BookResult, book: Book) -> None:
+        self._emit(
+            result.book_id, EVENT_SENDING if self.spool is None else EVENT_SPOOLING
+        )
+        try:
+            sent = self._deliver(result, book)
+        finally:
+            self._release(book)
+
+        if sent:
+            self._mark_sent(result)
+        elif result.status == STATUS_SKIPPED:
+            result.status = STATUS_TOO_LARGE
+
+    def _send_split(self, result: BookResult, book: Book) -> None:
+        sent_volumes = 0
+        try:
+            for volume in split_epub(book, get_size_limit_in_bytes(self.config)):
+                result.volumes = volume.total
+                self._emit(
+                    result.book_id,
+                    (
+                        EVENT_SENDING_VOLUME
+                        if self.spool is None
+                        else EVENT_SPOOLING_VOLUME
+                    ),
+                    volume.number,
+                    volume.total,
+                )
+                filename = f"{result.book_id}_{volume.number}.epub"
+                if self._deliver(result, BytesIO(volume.content), filename):
+                    sent_volumes += 1
+                elif result.status in STOPPING_STATUSES:
+                    break
+        except ValueError as err:
+            result.status = STATUS_NOT_SPLIT
+            result.set_error(err)
+        finally:
+            self._release(book)
+
+        if 0 < result.volumes == sent_volumes:
+            self._mark_sent(result)
+        elif result.status == STATUS_SKIPPED:
+            result.status = STATUS_TOO_LARGE
+
+    def _send_compacted(
+        self, result: BookResult, compaction: Future[bytes]
+    ) -> BookResult:
+        try:
+            book_content = compaction.result()
+        except ValueError as err:
+            result.status = STATUS_NOT_COMPACTED
+            result.set_error(err)
+            return result
+
+        self.budget.acquire(len(book_content))
+        self._send_whole(result, BytesIO(book_content))
+        return result
+
+    def iter_flush(self) -> Iterator[BookResult]:
+        """
+        Emails the books waiting in the spool, `workers` at a time, yielding
+        each book's result in spool order. Books are removed from the spool
+        once sent; books rejected by the server or by its credentials, or
+        that still can't be sent after `retries` more attempts while the
+        server is down, are kept in it for the next flush. Once no SMTP
+        profile is left in rotation (see `SenderPool`), the remaining books
+        are kept in it without being tried, and are yielded as skipped.
+
+        Each book is claimed before it's sent (see `Spool.claim`), so that
+        flushes of the same spool can run at the same time: books claimed by
+        another flush are left to it and have no result in this one. Claims
+        left behind by a crashed flush are released after an hour.
+        """
+
+        if self.spool is None:
+            raise ValueError("No spool directory was given")
+
+        self.smtp_pool.reactivate()
+        self.spool.release_stale_claims()
+        with DNS_CACHE.installed(), ThreadPoolExecutor(
+            max_workers=self.options.workers
+        ) as executor:
+            # a single worker sends the books in this thread, so that each
+            # book's result is known before the next one is started
+            entries = self.spool.entries()
+            results: Iterator[Optional[BookResult]]
+            if self.options.workers == 1:
+                results = map(self._flush_entry, entries)
+            else:
+                results = executor.map(self._flush_entry, entries)
+            yield from (result for result in results if result is not None)
+
+    def flush(self) -> list[BookResult]:
+        """Emails the books waiting in the spool, returning one result per book"""
+
+        return list(self.iter_flush())
+
+    def _flush_entry(self, entry: SpoolEntry) -> Optional[BookResult]:
+        """
+        Claims and emails a book in the spool, returning its result, or
+        None if another flush claimed it first. The book is removed from the
+        spool once sent, and put back in it otherwise. Once no SMTP profile
+        is left in rotation, books are left in the spool without claiming
+        them, and are skipped
+        """
+
+        assert self.spool is not None
+        result = BookResult(
+            entry.book_id, STATUS_SKIPPED, entry.size_in_bytes, entry.digest
+        )
+        if not self.smtp_pool.active_sessions():
+            return result
+        if not self.spool.claim(entry):
+            return None
+
+        try:
+            # mapped rather than read, so that concurrent workers take little memory
+            with map_book(self.spool.content_path(entry.name)) as book:
+                self._email_entry(result, entry, book)
+        finally:
+            if result.status == STATUS_SENT:
+                self.spool.remove(entry)
+            else:
+                self.spool.release(entry)
+        return result
+
+    def _email_entry(
+        self, result: BookResult, entry: SpoolEntry, book: BookFile
+    ) -> None:
+        for attempt in range(self.options.retries + 1):
+            if attempt:
+                time.sleep(RETRY_DELAY_IN_SECONDS * attempt)
+
+            self._emit(entry.book_id, EVENT_SENDING)
+            result.status = STATUS_SKIPPED
+            if self._email(result, book, entry.filename):
+                self._record_sent(result)
+                return
+
+            if result.status == STATUS_SKIPPED:
+                result.status = STATUS_TOO_LARGE
+                return
+
+            entry.attempts += 1
+            entry.last_error = result.error
+            # only servers that are down or busy are worth trying again, and
+            # only while a profile is in rotation: rejected books would be
+            # rejected again and invalid credentials stay invalid, so those
+            # are kept in the spool right away
+            if (
+                result.status != STATUS_SMTP_UNAVAILABLE
+                or not self.smtp_pool.active_sessions()
+            ):
+                return
+
+
+def send_books(
+    book_ids: Iterable[int],
+    *,
+    password: Passwords,
+    config: Optional[Mapping[str, Union[int, str]]] = None,
+    options: Optional[SendOptions] = None,
+) -> list[BookResult]:
+    """
+    Downloads and sends the given books with the stored config, overridden
+    by `config` if given, and returns one result per book, in the order
+    the books were sent (see `BookSender.schedule`).
+
+    To send several batches sharing the same connections, use `BookSender`.
+    """
+
+    with BookSender(password, config=config, options=options) as sender:
+        return sender.send(sender.schedule(book_ids))
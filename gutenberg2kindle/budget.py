@@ -0,0 +1,72 @@
+"""Auxiliary module to bound the memory held by books that are in flight"""
+
+import threading
+from typing import Final, Optional
+
+BYTES_PER_MB: Final[int] = 1024 * 1024
+
+
+class ByteBudget:
+    """
+    Thread-safe counter of the bytes held by books that have been
+    downloaded but not yet sent.
+
+    Acquiring blocks while the budget is exhausted. A single reservation
+    larger than the whole budget is still admitted when nothing else is
+    in flight, so an oversized book can never deadlock a batch.
+    """
+
+    def __init__(self, limit_in_bytes: Optional[int] = None) -> None:
+        if limit_in_bytes is not None and limit_in_bytes <= 0:
+            raise ValueError("The memory budget must be a positive amount of bytes")
+
+        self.limit_in_bytes = limit_in_bytes
+        self._in_use = 0
+        self._condition = threading.Condition()
+
+    @classmethod
+    def from_mb(cls, limit_in_mb: Optional[int]) -> "ByteBudget":
+        """Builds a budget from a limit in megabytes, or an unbounded one"""
+
+        if limit_in_mb is None:
+            return cls()
+        return cls(limit_in_mb * BYTES_PER_MB)
+
+    @property
+    def in_use(self) -> int:
+        """Amount of bytes currently reserved"""
+
+        with self._condition:
+            return self._in_use
+
+    def _fits(self, amount: int) -> bool:
+        if self.limit_in_bytes is None or self._in_use == 0:
+            return True
+        return self._in_use + amount <= self.limit_in_bytes
+
+    def acquire(self, amount: int) -> None:
+        """
+        Reserves the given amount of bytes, blocking until
+        there's enough room left in the budget
+        """
+
+        with self._condition:
+            self._condition.wait_for(lambda: self._fits(amount))
+            self._in_use += amount
+
+    def resize(self, reserved: int, actual: int) -> None:
+        """
+        Adjusts a previous reservation to the amount of bytes actually
+        held, without blocking (the bytes are already in memory)
+        """
+
+        with self._condition:
+            self._in_use += actual - reserved
+            self._condition.notify_all()
+
+    def release(self, amount: int) -> None:
+        """Gives back a previously reserved amount of bytes"""
+
+        with self._condition:
+            self._in_use = max(self._in_use - amount, 0)
+            self._condition.notify_all()
@@ -0,0 +1,319 @@
+"""
+Content-addressed local store for downloaded books, along with
+the history of books sent from it
+"""
+
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Final, Iterator, Optional, Union
+
+try:
+    import fcntl
+except ImportError:  # e.g. on Windows, where only threads are kept in sync
+    fcntl = None  # type: ignore[assignment]
+
+INDEX_FILENAME: Final[str] = "index.json"
+INDEX_LOCK_FILENAME: Final[str] = "index.json.lock"
+SENT_HISTORY_FILENAME: Final[str] = "sent.jsonl"
+OBJECTS_DIRNAME: Final[str] = "objects"
+CHOSEN_VARIANT_KEY: Final[str] = "chosen"
+
+
+class MappedFile(mmap.mmap):
+    """
+    File mapped into memory, read-only, that can also be read as a regular
+    file object, e.g. by `zipfile`
+    """
+
+    def seekable(self) -> bool:
+        """Whether the file can be read in any order, which it always can"""
+
+        return True
+
+    def seek(  # type: ignore[override]
+        self, pos: int, whence: int = os.SEEK_SET, /
+    ) -> int:
+        """Moves to the given position, which is returned as with files"""
+
+        super().seek(pos, whence)  # type: ignore[arg-type]
+        return self.tell()
+
+
+def content_digest(content: Union[bytes, memoryview]) -> str:
+    """Returns the SHA-256 hex digest used to address a book's content"""
+
+    return hashlib.sha256(content).hexdigest()
+
+
+def fsync_directory(directory: str) -> None:
+    """
+    Flushes a directory's entries to disk, so that a file just renamed into
+    it survives a crash. Skipped where directories can't be opened (Windows)
+    """
+
+    if not hasattr(os, "O_DIRECTORY"):
+        return
+
+    file_descriptor = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(file_descriptor)
+    finally:
+        os.close(file_descriptor)
+
+
+def write_atomically(path: str, content: Union[bytes, memoryview]) -> None:
+    """
+    Writes a file so that readers (and crashes) never observe it
+    partially written: the content goes to a temporary file in the same
+    directory, is flushed to disk, and is then renamed over the target.
+    The directory is flushed too, so that the rename itself is durable
+    """
+
+    # a bare filename is written to the current directory
+    directory = os.path.dirname(path) or "."
+    os.makedirs(directory, exist_ok=True)
+    file_descriptor, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    try:
+        with os.fdopen(file_descriptor, "wb") as temp_file:
+            temp_file.write(content)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    fsync_directory(directory)
+
+
+@contextmanager
+def lock_file(path: str) -> Iterator[None]:
+    """
+    Holds an exclusive lock on a file, created if needed, while within it,
+    so that processes sharing a directory (even on different hosts, if the
+    filesystem supports it) take turns. Where `fcntl` isn't available,
+    nothing is locked.
+    """
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "ab") as lock:
+        if fcntl is not None:
+            # released when the file is closed
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        yield
+
+
+class BookCache:
+    """
+    Local store of downloaded books, where identical content is stored
+    only once, addressed by its SHA-256 digest.
+
+    An index maps each book ID and format to the digest of its content
+    (and each book ID to the variant chosen for it, when the smallest one
+    is picked), and a sent history records which digests were sent to
+    which address.
+
+    The cache can be shared by several processes: the index is read again
+    whenever another process changed it, and every change is made to the
+    latest index on disk while holding a lock on it (see `lock_file`), so
+    that no process drops the entries of another.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self._index: Optional[dict[str, dict[str, Union[str, int]]]] = None
+        self._index_stamp: Optional[tuple[int, int, int]] = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def index_key(book_id: int, fmt: str) -> str:
+        """Returns the key of a book in a given format within the index"""
+
+        return f"{book_id}:{fmt}"
+
+    @property
+    def index_path(self) -> str:
+        """Path of the file that maps books to their content digest"""
+
+        return os.path.join(self.directory, INDEX_FILENAME)
+
+    @property
+    def index_lock_path(self) -> str:
+        """Path of the file locked by the process changing the index"""
+
+        return os.path.join(self.directory, INDEX_LOCK_FILENAME)
+
+    @property
+    def sent_history_path(self) -> str:
+        """Path of the file that records every book sent"""
+
+        return os.path.join(self.directory, SENT_HISTORY_FILENAME)
+
+    def object_path(self, digest: str) -> str:
+        """Path of the file that stores the content with the given digest"""
+
+        return os.path.join(self.directory, OBJECTS_DIRNAME, digest[:2], digest)
+
+    def _get_index_stamp(self) -> Optional[tuple[int, int, int]]:
+        # the index is replaced as a whole, so a new inode means a new index
+        try:
+            stat = os.stat(self.index_path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _read_index(self) -> dict[str, dict[str, Union[str, int]]]:
+        try:
+            with open(self.index_path, encoding="utf-8") as index_file:
+                index: dict[str, dict[str, Union[str, int]]] = json.load(index_file)
+        except (OSError, ValueError):
+            return {}
+        return index
+
+    def _load_index(self) -> dict[str, dict[str, Union[str, int]]]:
+        # callers are expected to hold the lock
+        stamp = self._get_index_stamp()
+        if self._index is None or stamp != self._index_stamp:
+            self._index, self._index_stamp = self._read_index(), stamp
+        return self._index
+
+    @contextmanager
+    def _edit_index(self) -> Iterator[dict[str, dict[str, Union[str, int]]]]:
+        """
+        Yields the latest index on disk, to be changed in place, and saves
+        it afterwards, while no other thread or process can change it
+        """
+
+        with self._lock, lock_file(self.index_lock_path):
+            # always read again, rather than trusting the stamp
+            index = self._read_index()
+            yield index
+            write_atomically(
+                self.index_path, json.dumps(index, indent=2, sort_keys=True).encode()
+            )
+            self._index, self._index_stamp = index, self._get_index_stamp()
+
+    def lookup(self, book_id: int, fmt: str) -> Optional[dict[str, Union[str, int]]]:
+        """
+        Returns the index entry (digest, URL, size...) of a book in a given
+        format, if its content is in the store
+        """
+
+        with self._lock:
+            entry = self._load_index().get(self.index_key(book_id, fmt))
+        if entry is None or not os.path.exists(self.object_path(str(entry["sha256"]))):
+            return None
+        return entry
+
+    def read(self, digest: str) -> Optional[bytes]:
+        """Returns the content with the given digest, if stored"""
+
+        try:
+            with open(self.object_path(digest), "rb") as object_file:
+                return object_file.read()
+        except FileNotFoundError:
+            return None
+
+    def map(self, digest: str) -> Optional[MappedFile]:
+        """
+        Returns the content with the given digest mapped into memory,
+        read-only, if stored and not empty, so that it isn't read into
+        memory up front. The caller closes it once done
+        """
+
+        try:
+            with open(self.object_path(digest), "rb") as object_file:
+                return MappedFile(object_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):
+            # empty files can't be mapped
+            return None
+
+    def store(self, book_id: int, fmt: str, url: str, content: bytes) -> str:
+        """
+        Stores a book's content, unless identical content was already
+        stored, indexes it under its book ID and format, and returns
+        its digest
+        """
+
+        digest = content_digest(content)
+        if not os.path.exists(self.object_path(digest)):
+            write_atomically(self.object_path(digest), content)
+
+        self.update_index(
+            book_id, fmt, {"sha256": digest, "url": url, "size": len(content)}
+        )
+        return digest
+
+    def update_index(
+        self, book_id: int, fmt: str, entry: dict[str, Union[str, int]]
+    ) -> None:
+        """Sets the index entry of a book in a given format and saves the index"""
+
+        with self._edit_index() as index:
+            index[self.index_key(book_id, fmt)] = entry
+
+    def forget(self, book_id: int) -> None:
+        """
+        Removes a book from the index, in every format, so that it's
+        downloaded again, e.g. because its stored copy is corrupt. The
+        variant chosen for it, if any, is kept.
+        """
+
+        prefix = self.index_key(book_id, "")
+        chosen = self.index_key(book_id, CHOSEN_VARIANT_KEY)
+        with self._edit_index() as index:
+            for key in [key for key in index if key.startswith(prefix)]:
+                if key != chosen:
+                    del index[key]
+
+    def chosen_variant(self, book_id: int) -> Optional[str]:
+        """Returns the variant chosen for a book in a previous run, if recorded"""
+
+        with self._lock:
+            entry = self._load_index().get(self.index_key(book_id, CHOSEN_VARIANT_KEY))
+        return None if entry is None else str(entry["variant"])
+
+    def record_variant(self, book_id: int, variant: str) -> None:
+        """Records the variant chosen for a book, so later runs can skip choosing"""
+
+        self.update_index(book_id, CHOSEN_VARIANT_KEY, {"variant": variant})
+
+    def verify(self, digest: str) -> bool:
+        """
+        Returns whether the content stored under the given digest
+        is still on disk and still matches its digest
+        """
+
+        content = self.read(digest)
+        return content is not None and content_digest(content) == digest
+
+    def was_sent(self, digest: str, recipient: str) -> bool:
+        """Returns whether the content with the given digest was sent to an address"""
+
+        try:
+            with open(self.sent_history_path, encoding="utf-8") as history_file:
+                for line in history_file:
+                    record = json.loads(line)
+                    if record["sha256"] == digest and record["recipient"] == recipient:
+                        return True
+        except FileNotFoundError:
+            pass
+        return False
+
+    def record_sent(self, digest: str, book_id: int, recipient: str) -> None:
+        """Appends a book that was just sent to the sent history"""
+
+        record = {
+            "sha256": digest,
+            "book_id": book_id,
+            "recipient": recipient,
+            "sent_at": datetime.now(timezone.utc).isoformat(),
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.sent_history_path, "a", encoding="utf-8") as history_file:
+            history_file.write(json.dumps(record) + "\n")
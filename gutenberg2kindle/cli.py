@@ -2,30 +2,118 @@
 Functions and other helpers for `gutenberg2kindle`'s command-line interface.
 """
 
+# pylint: disable=too-many-lines
+
 import argparse
 import getpass
-import socket
 import sys
-from typing import Final, Optional, Union
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import asdict
+from functools import partial
+from typing import Final, Iterator, Optional, Union
 
 from gutenberg2kindle import __version__
+from gutenberg2kindle.api import (
+    DEFAULT_RETRIES,
+    DEFAULT_WORKERS,
+    EVENT_COMPACTING,
+    EVENT_SENDING,
+    EVENT_SENDING_VOLUME,
+    EVENT_SPOOLING,
+    EVENT_SPOOLING_VOLUME,
+    STATUS_ALREADY_SENT,
+    STATUS_CORRUPT,
+    STATUS_DUPLICATE,
+    STATUS_GUTENBERG_UNREACHABLE,
+    STATUS_NOT_COMPACTED,
+    STATUS_NOT_DOWNLOADED,
+    STATUS_NOT_SPLIT,
+    STATUS_REJECTED,
+    STATUS_SENT,
+    STATUS_SKIPPED,
+    STATUS_SMTP_ERROR,
+    STATUS_SMTP_UNAVAILABLE,
+    STATUS_SPOOLED,
+    STATUS_TOO_LARGE,
+    STOPPING_STATUSES,
+    BookEvent,
+    BookResult,
+    BookSender,
+    SendOptions,
+)
+from gutenberg2kindle.budget import ByteBudget
+from gutenberg2kindle.cache import BookCache
 from gutenberg2kindle.config import (
+    ADVANCED_SETTINGS,
     AVAILABLE_SETTINGS,
     get_config,
     interactive_config,
     set_config,
     setup_settings,
 )
-from gutenberg2kindle.email import send_book
-from gutenberg2kindle.gutenberg import download_book
+from gutenberg2kindle.email import bytes_to_mb
+from gutenberg2kindle.feed import (
+    DEFAULT_WATCH_INTERVAL_IN_SECONDS,
+    DEFAULT_WATCH_STATE_PATH,
+    NEW_RELEASES_FEED_URL,
+    FeedUpdate,
+    FeedWatcher,
+    get_watch_filters,
+)
+from gutenberg2kindle.gutenberg import prefetch_book
+from gutenberg2kindle.network import (
+    DNS_CACHE,
+    create_http_session,
+    report_network_stats,
+)
+from gutenberg2kindle.pool import Passwords, SenderPool, load_profiles
+from gutenberg2kindle.preflight import CHECK_GUTENBERG, CheckResult
+from gutenberg2kindle.profiling import profile_run
+from gutenberg2kindle.progress import ProgressReporter
+from gutenberg2kindle.report import (
+    EXIT_CODES,
+    VALID_REPORT_FORMATS,
+    get_outcome,
+    merge_results,
+    read_json_report,
+    summarize_run,
+    write_report,
+)
+from gutenberg2kindle.schedule import SCHEDULE_INPUT, VALID_SCHEDULES, parse_priority
+from gutenberg2kindle.server import (
+    DEFAULT_HOST,
+    DEFAULT_PORT,
+    BookServer,
+    create_http_server,
+)
+from gutenberg2kindle.shard import ClaimDirectory, parse_shard, shard_book_ids
 
 COMMAND_SEND: Final[str] = "send"
+COMMAND_PREFETCH: Final[str] = "prefetch"
+COMMAND_FLUSH: Final[str] = "flush"
+COMMAND_SERVE: Final[str] = "serve"
+COMMAND_CHECK: Final[str] = "check"
+COMMAND_REPORT: Final[str] = "report"
+COMMAND_WATCH: Final[str] = "watch"
 COMMAND_GET_CONFIG: Final[str] = "get-config"
 COMMAND_SET_CONFIG: Final[str] = "set-config"
 COMMAND_INTERACTIVE_CONFIG: Final[str] = "interactive-config"
 COMMAND_VERSION: Final[str] = "version"
+CONFIG_COMMANDS: Final[list[str]] = [
+    COMMAND_GET_CONFIG,
+    COMMAND_SET_CONFIG,
+    COMMAND_INTERACTIVE_CONFIG,
+]
 AVAILABLE_COMMANDS: Final[list[str]] = [
     COMMAND_SEND,
+    COMMAND_PREFETCH,
+    COMMAND_FLUSH,
+    COMMAND_SERVE,
+    COMMAND_CHECK,
+    COMMAND_REPORT,
+    COMMAND_WATCH,
     COMMAND_GET_CONFIG,
     COMMAND_SET_CONFIG,
     COMMAND_INTERACTIVE_CONFIG,
@@ -33,6 +121,32 @@ AVAILABLE_COMMANDS: Final[list[str]] = [
 ]
 
 
+def positive_int_argument(value: str) -> int:
+    """Parses an argument that must be a positive integer, e.g. `--workers`"""
+
+    if not value.isdigit() or int(value) < 1:
+        raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+    return int(value)
+
+
+def shard_argument(value: str) -> tuple[int, int]:
+    """Parses the `--shard` argument, see `parse_shard`"""
+
+    try:
+        return parse_shard(value)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(str(err)) from err
+
+
+def priority_argument(value: str) -> tuple[int, int]:
+    """Parses a `--priority` argument, see `parse_priority`"""
+
+    try:
+        return parse_priority(value)
+    except ValueError as err:
+        raise argparse.ArgumentTypeError(str(err)) from err
+
+
 def get_parser() -> argparse.ArgumentParser:
     """
     Generate and return a parser for the CLI tool
@@ -75,7 +189,7 @@ def get_parser() -> argparse.ArgumentParser:
         "-n",
         metavar="NAME",
         type=str,
-        choices=AVAILABLE_SETTINGS,
+        choices=AVAILABLE_SETTINGS + ADVANCED_SETTINGS,
         help="Setting to get / set, whenever these commands are used.",
     )
     parser.add_argument(
@@ -95,7 +209,301 @@ def get_parser() -> argparse.ArgumentParser:
             "multiple books at once. Default is false."
         ),
     )
-    parser.set_defaults(ignore_errors=False)
+    parser.add_argument(
+        "--max-memory",
+        "-m",
+        metavar="MEGABYTES",
+        type=positive_int_argument,
+        default=None,
+        help=(
+            "Maximum amount of memory, in megabytes, that downloaded books "
+            "can take while waiting to be sent. Downloads block until there's "
+            "room left in the budget. Unlimited by default."
+        ),
+    )
+    oversized_books = parser.add_mutually_exclusive_group()
+    oversized_books.add_argument(
+        "--compact",
+        "-c",
+        action="store_true",
+        help=(
+            "If set, books over the size limit are recompressed (stripping "
+            "unused fonts and images, and downscaling images if Pillow is "
+            "installed) in a separate process before being sent, instead of "
+            "being skipped. Default is false."
+        ),
+    )
+    oversized_books.add_argument(
+        "--split",
+        "-s",
+        action="store_true",
+        help=(
+            "If set, books over the size limit are split at chapter boundaries "
+            "into several volumes that are sent as separate emails, instead of "
+            "being skipped. Default is false."
+        ),
+    )
+    parser.add_argument(
+        "--cache-dir",
+        metavar="DIRECTORY",
+        type=str,
+        default=None,
+        help=(
+            "Directory of a local book cache. Books found in it are sent without "
+            "contacting Project Gutenberg, and downloaded books are stored in it. "
+            "Identical files are stored only once. Disabled by default."
+        ),
+    )
+    parser.add_argument(
+        "--revalidate",
+        action="store_true",
+        help=(
+            "If set, cached books are checked against the digest announced by "
+            "Project Gutenberg, if any, and downloaded again if they differ. "
+            "Default is false."
+        ),
+    )
+    parser.add_argument(
+        "--skip-sent",
+        action="store_true",
+        help=(
+            "If set, books whose exact content was already sent to the "
+            "configured Kindle address (according to the cache's history) "
+            "are skipped. Default is false."
+        ),
+    )
+    parser.add_argument(
+        "--workers",
+        "-w",
+        metavar="WORKERS",
+        type=positive_int_argument,
+        default=DEFAULT_WORKERS,
+        help=(
+            "Amount of books to download at the same time when prefetching, "
+            f"or to email at the same time when flushing. Default is {DEFAULT_WORKERS}."
+        ),
+    )
+    parser.add_argument(
+        "--spool",
+        metavar="DIRECTORY",
+        type=str,
+        default=None,
+        help=(
+            "Spool directory. If set, the `send` command writes the books to it "
+            "instead of emailing them, and the `flush` command emails the books "
+            "waiting in it. Disabled by default."
+        ),
+    )
+    parser.add_argument(
+        "--retries",
+        "-r",
+        metavar="RETRIES",
+        type=int,
+        default=DEFAULT_RETRIES,
+        help=(
+            "Amount of times the `flush` command retries emailing a book before "
+            f"keeping it in the spool for the next flush. Default is {DEFAULT_RETRIES}."
+        ),
+    )
+    parser.add_argument(
+        "--schedule",
+        metavar="POLICY",
+        type=str,
+        choices=VALID_SCHEDULES,
+        default=SCHEDULE_INPUT,
+        help=(
+            "Order in which the `send` command sends the books: as given "
+            "(`input`), smallest first to get most books delivered soonest "
+            "(`smallest_first`), or largest first (`largest_first`). Sizes are "
+            "taken from the cache or from the sizes announced by Project "
+            f"Gutenberg. Default is {SCHEDULE_INPUT}."
+        ),
+    )
+    parser.add_argument(
+        "--priority",
+        metavar="BOOK_ID:PRIORITY",
+        type=priority_argument,
+        nargs="+",
+        default=[],
+        help=(
+            "Priority of a book, e.g. 1234:5. Books with a higher priority are "
+            "sent first among books of the same size (or among all books, with "
+            "the `input` schedule). Can be specified for multiple books. "
+            "Default is 0."
+        ),
+    )
+    parser.add_argument(
+        "--shard",
+        metavar="INDEX/COUNT",
+        type=shard_argument,
+        default=None,
+        help=(
+            "If set, the `send` and `prefetch` commands only handle the books "
+            "of one of COUNT shards, numbered from 0, e.g. 0/4 for the first of "
+            "four. Books are assigned to shards by their ID, so that several "
+            "processes or hosts given the same books never handle the same one."
+        ),
+    )
+    parser.add_argument(
+        "--claim-dir",
+        metavar="DIRECTORY",
+        type=str,
+        default=None,
+        help=(
+            "Directory shared by several processes, on one machine or on a shared "
+            "filesystem, given the same books. If set, the `send` and `prefetch` "
+            "commands only handle the books they manage to claim in it, and the "
+            "`send` command saves the result of each book in it, for the `report` "
+            "command to merge. Use a new directory for every job list."
+        ),
+    )
+    parser.add_argument(
+        "--merge",
+        metavar="PATH",
+        type=str,
+        nargs="+",
+        default=[],
+        help=(
+            "JSON reports (see `--report`) for the `report` command to merge, "
+            "e.g. the ones written by every shard of a job. Can be combined "
+            "with `--claim-dir`."
+        ),
+    )
+    parser.add_argument(
+        "--no-preflight",
+        dest="preflight",
+        action="store_false",
+        help=(
+            "If set, the `send` command doesn't check that Project Gutenberg and "
+            "the SMTP server can be reached, and that the SMTP credentials are "
+            "valid, while downloading the first book."
+        ),
+    )
+    parser.add_argument(
+        "--no-verify",
+        dest="verify",
+        action="store_false",
+        help=(
+            "If set, the `send` command doesn't verify that downloaded books are "
+            "intact EPUB files before sending them, nor downloads corrupt books "
+            "again."
+        ),
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="PATH",
+        type=str,
+        default=None,
+        help=(
+            "If set, the run is profiled with cProfile and its CPU profile is "
+            "written to this path in pstats format, e.g. to be read with "
+            "`python -m pstats PATH`. Disabled by default."
+        ),
+    )
+    parser.add_argument(
+        "--trace-memory",
+        metavar="PATH",
+        type=str,
+        default=None,
+        help=(
+            "If set, memory allocations are traced with tracemalloc during the "
+            "run, and the memory peak and the lines of code with the most memory "
+            "allocated are written to this path as text. Disabled by default."
+        ),
+    )
+    parser.add_argument(
+        "--network-stats",
+        action="store_true",
+        help=(
+            "If set, the amount of DNS lookups and TLS handshakes done during "
+            "the run, and the time spent on them, are printed at the end. "
+            "Lookups are cached and TLS sessions resumed across connections."
+        ),
+    )
+    parser.add_argument(
+        "--report",
+        metavar=("FORMAT", "PATH"),
+        type=str,
+        nargs=2,
+        default=None,
+        help=(
+            "If set, the `send`, `flush` and `report` commands write a report of "
+            "the run to PATH, in FORMAT (one of "
+            f"{', '.join(VALID_REPORT_FORMATS)}), with a row per book and the "
+            "totals of the run (in a `.summary.csv` file of their own, for CSV). "
+            "Disabled by default."
+        ),
+    )
+    parser.add_argument(
+        "--host",
+        metavar="HOST",
+        type=str,
+        default=DEFAULT_HOST,
+        help=f"Host the `serve` command listens on. Default is {DEFAULT_HOST}.",
+    )
+    parser.add_argument(
+        "--port",
+        "-p",
+        metavar="PORT",
+        type=int,
+        default=DEFAULT_PORT,
+        help=f"Port the `serve` command listens on. Default is {DEFAULT_PORT}.",
+    )
+    parser.add_argument(
+        "--socket",
+        metavar="PATH",
+        type=str,
+        default=None,
+        help=(
+            "If set, the `serve` command listens on a Unix socket at this path "
+            "instead of a TCP port."
+        ),
+    )
+    parser.add_argument(
+        "--feed",
+        metavar="URL_OR_PATH",
+        type=str,
+        default=NEW_RELEASES_FEED_URL,
+        help=(
+            "Feed of new releases polled by the `watch` command, as a URL or as "
+            "the path to a local copy of it. Default is Project Gutenberg's "
+            f"feed, {NEW_RELEASES_FEED_URL}."
+        ),
+    )
+    parser.add_argument(
+        "--interval",
+        metavar="SECONDS",
+        type=int,
+        default=DEFAULT_WATCH_INTERVAL_IN_SECONDS,
+        help=(
+            "Seconds between polls of the feed by the `watch` command. "
+            f"Default is {DEFAULT_WATCH_INTERVAL_IN_SECONDS}."
+        ),
+    )
+    parser.add_argument(
+        "--once",
+        action="store_true",
+        help="If set, the `watch` command polls the feed only once, e.g. from cron.",
+    )
+    parser.add_argument(
+        "--watch-state",
+        metavar="PATH",
+        type=str,
+        default=DEFAULT_WATCH_STATE_PATH,
+        help=(
+            "File where the `watch` command keeps track of the newest book "
+            f"processed between polls. Default is {DEFAULT_WATCH_STATE_PATH}."
+        ),
+    )
+    parser.set_defaults(
+        ignore_errors=False,
+        compact=False,
+        split=False,
+        revalidate=False,
+        skip_sent=False,
+        preflight=True,
+        verify=True,
+    )
 
     return parser
 
@@ -121,50 +529,545 @@ def print_settings(
         print(setting_or_dict)
 
 
-def handle_book_download(book_ids: list[int], ignore_errors: bool) -> None:
+EVENT_MESSAGES: Final[dict[str, str]] = {
+    EVENT_SENDING: "Sending book `{book_id}`...",
+    EVENT_SENDING_VOLUME: (
+        "Sending book `{book_id}` (volume {volume} of {total_volumes})..."
+    ),
+    EVENT_SPOOLING: "Spooling book `{book_id}`...",
+    EVENT_SPOOLING_VOLUME: (
+        "Spooling book `{book_id}` (volume {volume} of {total_volumes})..."
+    ),
+    EVENT_COMPACTING: "Compacting book `{book_id}`...",
+}
+
+RESULT_MESSAGES: Final[dict[str, str]] = {
+    STATUS_SENT: "Book `{book_id}` sent!",
+    STATUS_SPOOLED: "Book `{book_id}` spooled!",
+    STATUS_NOT_DOWNLOADED: "Book `{book_id}` could not be downloaded!",
+    STATUS_CORRUPT: (
+        "Book `{book_id}` is corrupt, even after downloading it again: {error}"
+    ),
+    STATUS_TOO_LARGE: "Book `{book_id}` could not be sent, please check its file size.",
+    STATUS_DUPLICATE: (
+        "Book `{book_id}` is identical to book `{duplicate_of}`, skipping..."
+    ),
+    STATUS_ALREADY_SENT: "Book `{book_id}` was already sent, skipping...",
+    STATUS_NOT_COMPACTED: "Book `{book_id}` could not be compacted: {error}",
+    STATUS_NOT_SPLIT: "Book `{book_id}` could not be split: {error}",
+    STATUS_SMTP_ERROR: (
+        "SMTP credentials are invalid! "
+        "Please validate your current config.\n"
+        "Server error message: {error}"
+    ),
+    STATUS_SMTP_UNAVAILABLE: (
+        "SMTP server is unavailable, please try again later.\n"
+        "Server error message: {error}"
+    ),
+    STATUS_REJECTED: "Book `{book_id}` was rejected by the SMTP server: {error}",
+    STATUS_GUTENBERG_UNREACHABLE: (
+        "Project Gutenberg is unreachable, please check your connection.\n"
+        "Error message: {error}"
+    ),
+}
+
+
+def print_book_event(event: BookEvent) -> None:
+    """Prints what's about to happen to a book while a batch is being sent"""
+
+    print(EVENT_MESSAGES[event.event].format(**asdict(event)))
+
+
+def print_book_result(result: BookResult) -> None:
+    """Prints the outcome of sending a book, if there's anything to say about it"""
+
+    if result.sent and result.volumes:
+        print(f"Book `{result.book_id}` sent in {result.volumes} volumes!")
+    elif result.status == STATUS_SPOOLED and result.volumes:
+        print(f"Book `{result.book_id}` spooled in {result.volumes} volumes!")
+    elif result.status in RESULT_MESSAGES:
+        print(RESULT_MESSAGES[result.status].format(**asdict(result)))
+
+
+def request_passwords() -> Passwords:
+    """
+    Prompts for the SMTP password or, if sender profiles are configured,
+    for the password of each profile
+    """
+
+    profiles = load_profiles()
+    if not profiles:
+        return getpass.getpass("Please enter your SMTP password: ")
+
+    return {
+        profile.name: getpass.getpass(
+            f"Please enter the SMTP password for profile `{profile.name}`: "
+        )
+        for profile in profiles
+    }
+
+
+def print_profile_stats(pool: SenderPool) -> None:
+    """Prints how many emails were sent through each sender profile, if several"""
+
+    if len(pool.stats) < 2:
+        return
+
+    for name, stats in pool.stats.items():
+        reason = stats.disabled_reason or "server looks down"
+        status = "active" if stats.active else f"out of rotation: {reason}"
+        print(
+            f"Profile `{name}`: {stats.emails_sent} emails sent "
+            f"({bytes_to_mb(stats.bytes_sent)} MB), {stats.failures} failures ({status})"
+        )
+
+
+def record_book_result(claims: Optional[ClaimDirectory], result: BookResult) -> None:
+    """
+    Saves the result of a claimed book, if books are claimed, releasing the
+    claim on the books that were skipped so that they can be claimed again
+    """
+
+    if claims is None:
+        return
+
+    if result.status == STATUS_SKIPPED:
+        claims.release(result.book_id)
+    else:
+        claims.record(result)
+
+
+def stops_batch(result: BookResult, ignore_errors: bool) -> bool:
+    """
+    Returns whether the rest of the batch can't be sent after the given
+    book's result, either because of the error itself or because books
+    that can't be downloaded aren't to be ignored
+    """
+
+    if result.status in (STATUS_NOT_DOWNLOADED, STATUS_CORRUPT):
+        return not ignore_errors
+    return result.status in STOPPING_STATUSES
+
+
+@contextmanager
+def keep_claims_alive(
+    claims: Optional[ClaimDirectory], release_unfinished: bool = False
+) -> Iterator[None]:
+    """
+    Keeps the claims held by this process alive while within it, for as long
+    as their books may be sent (see `ClaimDirectory.keep_alive`), if any.
+    If `release_unfinished` is set, the claims still held when leaving it
+    (e.g. on books discarded or never reached after an error) are released,
+    so that other processes can claim them right away
+    """
+
+    if claims is None:
+        yield
+        return
+
+    with claims.keep_alive():
+        try:
+            yield
+        finally:
+            if release_unfinished:
+                claims.release_held()
+
+
+def finish_run(
+    results: list[BookResult],
+    report: Optional[tuple[str, str]] = None,
+    elapsed_seconds: Optional[float] = None,
+) -> None:
+    """
+    Writes the report of a run, if asked to, given as its format and path,
+    and exits the tool unless every book succeeded: with 1 if none did and
+    with 3 if only some did
+    """
+
+    if report is None:
+        summary = summarize_run(results, elapsed_seconds)
+    else:
+        report_format, path = report
+        try:
+            summary = write_report(path, report_format, results, elapsed_seconds)
+        except OSError as err:
+            print(f"Could not write the report to `{path}`: {err}")
+            sys.exit(1)
+
+    if summary.exit_code:
+        sys.exit(summary.exit_code)
+
+
+def handle_book_download(
+    book_ids: list[int],
+    options: SendOptions,
+    claims: Optional[ClaimDirectory] = None,
+    report: Optional[tuple[str, str]] = None,
+) -> None:
     """
     Given a list of book IDs, downloads and sends the books
-    using the current tool config
+    using the current tool config (or writes them to the spool, if set),
+    printing the outcome of each book and stopping on errors
+    (see `BookSender` for the details), then exits the tool depending
+    on how many books succeeded (see `finish_run`).
+
+    If a claim directory is given, only the books claimed in it are sent.
+    A progress line is shown while the batch is being sent, if on a terminal.
+    """
+
+    start = time.perf_counter()
+    results: list[BookResult] = []
+
+    # request password, unless books are only spooled
+    password = request_passwords() if options.spool_dir is None else ""
+
+    # with claims, it's not known ahead how many books will be sent
+    progress = ProgressReporter(len(book_ids) if claims is None else None)
+
+    def _print_book_event(event: BookEvent) -> None:
+        with progress.paused():
+            print_book_event(event)
+
+    with keep_claims_alive(claims, release_unfinished=True), BookSender(
+        password, options=options, on_event=_print_book_event, progress=progress
+    ) as sender:
+        # books are claimed in the scheduled order, as they're reached
+        book_ids = sender.schedule(book_ids)
+        claimed_ids = book_ids if claims is None else claims.claim_all(book_ids)
+        try:
+            for result in sender.iter_send(claimed_ids):
+                results.append(result)
+                record_book_result(claims, result)
+                with progress.paused():
+                    print_book_result(result)
+                    if stops_batch(result, options.ignore_errors):
+                        break
+                    if result.status in (STATUS_NOT_DOWNLOADED, STATUS_CORRUPT):
+                        print(f"Skipping book `{result.book_id}`...")
+            else:
+                progress.close()
+                sent_amount = sum(
+                    result.sent or result.status == STATUS_SPOOLED for result in results
+                )
+                if sent_amount > 1:
+                    action = "sent" if options.spool_dir is None else "spooled"
+                    print(f"{sent_amount} books {action} successfully!")
+        finally:
+            progress.close()
+            print_profile_stats(sender.smtp_pool)
+
+    # books that were never reached, e.g. after an error, weren't sent either
+    if claims is None:
+        reached_ids = {result.book_id for result in results}
+        results += [
+            BookResult(book_id) for book_id in book_ids if book_id not in reached_ids
+        ]
+    finish_run(results, report, time.perf_counter() - start)
+
+
+def handle_spool_flush(
+    options: SendOptions, report: Optional[tuple[str, str]] = None
+) -> None:
+    """
+    Emails the books waiting in the spool, printing the outcome of each
+    book, then exits the tool with an error if any book was kept in it
+    (see `finish_run`)
+    """
+
+    if not options.spool_dir:
+        print("Please specify a spool directory with the `--spool` flag")
+        sys.exit(1)
+
+    start = time.perf_counter()
+    results: list[BookResult] = []
+    password = request_passwords()
+
+    with BookSender(password, options=options, on_event=print_book_event) as sender:
+        try:
+            for result in sender.iter_flush():
+                results.append(result)
+                if result.status in (*STOPPING_STATUSES, STATUS_REJECTED):
+                    print(
+                        f"Book `{result.book_id}` could not be sent, keeping it "
+                        f"in the spool: {result.error}"
+                    )
+                elif result.status == STATUS_SKIPPED:
+                    print(
+                        f"Book `{result.book_id}` was kept in the spool, "
+                        "as no SMTP profile is left to send it"
+                    )
+                else:
+                    print_book_result(result)
+
+            flushed_amount = sum(result.sent for result in results)
+            print(f"Flushed {flushed_amount} of {len(results)} books from the spool")
+        finally:
+            print_profile_stats(sender.smtp_pool)
+
+    finish_run(results, report, time.perf_counter() - start)
+
+
+def print_check(check: CheckResult) -> None:
+    """Prints the outcome of a preflight check, and how long it took"""
+
+    name = (
+        "Project Gutenberg"
+        if check.target == CHECK_GUTENBERG
+        else f"SMTP profile `{check.profile}`"
+    )
+    if check.ok:
+        print(f"{name}: OK ({check.seconds:.2f} seconds)")
+    else:
+        print(f"{name}: failed after {check.seconds:.2f} seconds: {check.error}")
+
+
+def handle_check(options: SendOptions) -> None:
+    """
+    Checks that Project Gutenberg and the SMTP server can be reached, and
+    that the SMTP credentials are valid, printing how long each check took
+    and exiting the tool with an error if any failed
+    """
+
+    password = request_passwords() if options.spool_dir is None else ""
+    with BookSender(password, options=options) as sender:
+        checks = sender.check()
+
+    for check in checks:
+        print_check(check)
+
+    if not all(check.ok for check in checks):
+        sys.exit(1)
+
+
+def handle_book_prefetch(
+    book_ids: list[int],
+    options: SendOptions,
+    claims: Optional[ClaimDirectory] = None,
+) -> None:
     """
+    Given a list of book IDs, downloads the books concurrently into the
+    local cache and verifies them, so that sending them later doesn't
+    need to contact Project Gutenberg.
 
-    books_amount = len(book_ids)
+    If a claim directory is given, only the books claimed in it are
+    prefetched, each one being claimed right before it's downloaded.
+    A progress line is shown while books are downloaded, if on a terminal.
+    """
 
-    # request password
-    password = getpass.getpass("Please enter your SMTP password: ")
+    if not options.cache_dir:
+        print("Please specify a cache directory with the `--cache-dir` flag")
+        sys.exit(1)
 
-    for book_id in book_ids:
-        book = download_book(book_id)
+    start = time.perf_counter()
+    progress = ProgressReporter(len(book_ids) if claims is None else None)
+    http_session = create_http_session()
+    prefetch = partial(
+        prefetch_book,
+        cache=BookCache(options.cache_dir),
+        budget=ByteBudget.from_mb(options.max_memory),
+        on_chunk=progress.add_downloaded,
+        session=http_session,
+    )
 
-        if book is None:
-            print(f"Book `{book_id}` could not be downloaded!")
-            books_amount -= 1
+    def _prefetch(book_id: int) -> tuple[bool, Optional[int]]:
+        if claims is not None and not claims.claim(book_id):
+            return False, None
+        progress.book_started()
+        return True, prefetch(book_id)
 
-            if ignore_errors:
-                print(f"Skipping book `{book_id}`...")
+    with progress, DNS_CACHE.installed(), http_session, keep_claims_alive(
+        claims
+    ), ThreadPoolExecutor(max_workers=options.workers) as executor:
+        prefetched_bytes, prefetched_amount, claimed_amount = 0, 0, 0
+        for book_id, (claimed, size) in zip(
+            book_ids, executor.map(_prefetch, book_ids)
+        ):
+            claimed_amount += claimed
+            if not claimed:
                 continue
-            sys.exit(1)
 
-        print(f"Sending book `{book_id}`...")
+            progress.book_done()
+            with progress.paused():
+                if size is None:
+                    print(f"Book `{book_id}` could not be prefetched!")
+                    continue
+
+                print(f"Book `{book_id}` prefetched ({bytes_to_mb(size)} MB)")
+            prefetched_bytes += size
+            prefetched_amount += 1
+
+    print(
+        f"Prefetched {prefetched_amount} of {claimed_amount} books "
+        f"({bytes_to_mb(prefetched_bytes)} MB) "
+        f"in {time.perf_counter() - start:.1f} seconds"
+    )
+    if prefetched_amount < claimed_amount:
+        sys.exit(
+            EXIT_CODES[
+                get_outcome(prefetched_amount, claimed_amount - prefetched_amount)
+            ]
+        )
+
+
+def handle_report(
+    claims: Optional[ClaimDirectory],
+    report: Optional[tuple[str, str]] = None,
+    merge_paths: Optional[list[str]] = None,
+) -> None:
+    """
+    Prints the outcome of every book sent through a claim directory, by any
+    process, and in the given JSON reports (e.g. of every shard of a job),
+    then exits the tool with an error if any book wasn't sent (see
+    `finish_run`)
+    """
+
+    if claims is None and not merge_paths:
+        print(
+            "Please specify a claim directory with the `--claim-dir` flag, "
+            "or reports to merge with the `--merge` flag"
+        )
+        sys.exit(1)
+
+    try:
+        results = merge_results(
+            [] if claims is None else claims.results(),
+            *map(read_json_report, merge_paths or []),
+        )
+    except (OSError, ValueError) as err:
+        print(f"Could not read the reports to merge: {err}")
+        sys.exit(1)
+
+    for result in results:
+        print_book_result(result)
+
+    sent_amount = sum(
+        result.sent or result.status == STATUS_SPOOLED for result in results
+    )
+    print(f"{sent_amount} of {len(results)} books sent successfully")
+    finish_run(results, report)
+
+
+def handle_serve(
+    options: SendOptions, host: str, port: int, socket_path: Optional[str]
+) -> None:
+    """
+    Keeps the tool running, accepting send jobs over a local HTTP API
+    and reusing the same connections and cache across jobs
+    """
+
+    book_server = BookServer(request_passwords(), options)
+    http_server = create_http_server(book_server, host, port, socket_path)
+
+    print(
+        f"Listening on {socket_path or f'http://{host}:{port}'}, press Ctrl+C to stop"
+    )
+    book_server.start()
+    try:
+        http_server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping, waiting for queued jobs to finish...")
+    finally:
+        http_server.server_close()
+        book_server.stop()
+
+
+def handle_feed_update(
+    sender: BookSender,
+    watcher: FeedWatcher,
+    update: FeedUpdate,
+    filters: tuple[list[str], list[str]],
+) -> bool:
+    """
+    Sends the new releases in a poll of the feed that match the filters,
+    given as authors and subjects, and commits the poll once they're
+    processed, returning whether it was. If books can't be sent, the rest
+    are left alone and the poll isn't committed, so that they're polled again
+    """
+
+    book_ids = [entry.book_id for entry in update.entries if entry.matches(*filters)]
+    if update.entries:
+        print(
+            f"Found {len(update.entries)} new releases, "
+            f"{len(book_ids)} matching the filters"
+        )
+
+    for result in sender.iter_send(sender.schedule(book_ids)):
+        print_book_result(result)
+        if result.status in STOPPING_STATUSES:
+            print("Could not send the new releases, they'll be polled again")
+            return False
+
+    watcher.commit(update)
+    return True
+
+
+def handle_watch(
+    options: SendOptions, watcher: FeedWatcher, interval: int, once: bool
+) -> None:
+    """
+    Polls the feed of new releases every `interval` seconds, or only once,
+    sending the new books that match the authors and subjects saved in the
+    config. Polls that fail, or whose books can't be sent, are retried in
+    the next one. When polling only once, the tool exits with an error
+    instead.
+    """
+
+    filters = get_watch_filters()
+    password = request_passwords() if options.spool_dir is None else ""
+
+    if not once:
+        print(
+            f"Watching {watcher.source} every {interval} seconds, "
+            "press Ctrl+C to stop"
+        )
+
+    with BookSender(password, options=options, on_event=print_book_event) as sender:
         try:
-            sent: bool = send_book(book_id, book, password)
-        except socket.error as err:  # pylint: disable=no-member
-            print(
-                "SMTP credentials are invalid! "
-                "Please validate your current config.\n"
-                f"Server error message: {err}"
-            )
-            sys.exit(1)
-        else:
-            book.close()
+            while True:
+                try:
+                    update = watcher.poll(sender.http_session)
+                except (OSError, ValueError) as err:
+                    print(f"Could not poll the feed of new releases: {err}")
+                    if once:
+                        sys.exit(1)
+                else:
+                    committed = handle_feed_update(sender, watcher, update, filters)
+                    if not committed and once:
+                        sys.exit(1)
+
+                if once:
+                    return
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            print("Stopping...")
+
+
+def handle_set_config(name: Optional[str], value: Optional[str]) -> None:
+    """Sets the value of a setting, given both its name and its value"""
+
+    if name is None:
+        print("Please specify a setting name with the `--name` flag")
+        sys.exit(1)
+
+    if value is None:
+        print("Please specify a setting value with the `--value` flag")
+        sys.exit(1)
 
-        if sent:
-            print(f"Book `{book_id}` sent!")
-        else:
-            print(f"Book `{book_id}` could not be sent, please check its file size.")
-            books_amount -= 1
+    set_config(name, value)
+    print(format_setting(name, value))
 
-    if books_amount > 1:
-        print(f"{books_amount} books sent successfully!")
+
+def handle_config(command: str, name: Optional[str], value: Optional[str]) -> None:
+    """Reads or sets the tool's config, depending on the command"""
+
+    if command == COMMAND_GET_CONFIG:
+        print_settings(get_config(name))
+
+    elif command == COMMAND_SET_CONFIG:
+        handle_set_config(name, value)
+
+    elif command == COMMAND_INTERACTIVE_CONFIG:
+        interactive_config()
 
 
 def main() -> None:
@@ -178,34 +1081,86 @@ def main() -> None:
     # parse arguments
     parser = get_parser()
     args = parser.parse_args()
+    if args.report is not None and args.report[0] not in VALID_REPORT_FORMATS:
+        parser.error(
+            f"argument --report: invalid format {args.report[0]!r} (choose from "
+            f"{', '.join(map(repr, VALID_REPORT_FORMATS))})"
+        )
+
+    options = SendOptions(
+        ignore_errors=args.ignore_errors,
+        max_memory=args.max_memory,
+        compact=args.compact,
+        split=args.split,
+        cache_dir=args.cache_dir,
+        revalidate=args.revalidate,
+        skip_sent=args.skip_sent,
+        workers=args.workers,
+        spool_dir=args.spool,
+        retries=args.retries,
+        preflight=args.preflight,
+        verify=args.verify,
+        schedule=args.schedule,
+        priorities=dict(args.priority),
+    )
+
+    with profile_run(args.profile, args.trace_memory), report_network_stats(
+        args.network_stats
+    ):
+        run_command(args, options)
+
+
+def get_book_ids(
+    args: argparse.Namespace,
+) -> tuple[list[int], Optional[ClaimDirectory]]:
+    """
+    Returns the books given in the parsed arguments that belong to this
+    process's shard, if any, and the directory to claim them from, if any
+    """
+
+    book_id_list: list[int] = args.book_id
+    if args.shard is not None:
+        book_id_list = list(shard_book_ids(book_id_list, *args.shard))
+    claims = ClaimDirectory(args.claim_dir) if args.claim_dir else None
+    return book_id_list, claims
+
+
+def run_command(args: argparse.Namespace, options: SendOptions) -> None:
+    """Runs the command given in the parsed arguments"""
 
     # cast certain arguments to expected types
     command: str = args.command
     name: Optional[str] = args.name
     value: Optional[str] = args.value
-    ignore_errors: bool = args.ignore_errors
+    book_id_list, claims = get_book_ids(args)
+    report: Optional[tuple[str, str]] = (
+        None if args.report is None else tuple(args.report)
+    )
 
     if command == COMMAND_SEND:
-        book_id_list: list[int] = args.book_id
-        handle_book_download(book_id_list, ignore_errors)
+        handle_book_download(book_id_list, options, claims, report)
 
-    elif command == COMMAND_GET_CONFIG:
-        print_settings(get_config(name))
+    elif command == COMMAND_PREFETCH:
+        handle_book_prefetch(book_id_list, options, claims)
 
-    elif command == COMMAND_SET_CONFIG:
-        if name is None:
-            print("Please specify a setting name with the `--name` flag")
-            sys.exit(1)
+    elif command == COMMAND_REPORT:
+        handle_report(claims, report, args.merge)
 
-        if value is None:
-            print("Please specify a setting value with the `--value` flag")
-            sys.exit(1)
+    elif command == COMMAND_FLUSH:
+        handle_spool_flush(options, report)
 
-        set_config(name, value)
-        print(format_setting(name, value))
+    elif command == COMMAND_SERVE:
+        handle_serve(options, args.host, args.port, args.socket)
 
-    elif command == COMMAND_INTERACTIVE_CONFIG:
-        interactive_config()
+    elif command == COMMAND_CHECK:
+        handle_check(options)
+
+    elif command == COMMAND_WATCH:
+        watcher = FeedWatcher(args.feed, args.watch_state)
+        handle_watch(options, watcher, args.interval, args.once)
+
+    elif command in CONFIG_COMMANDS:
+        handle_config(command, name, value)
 
     elif command == COMMAND_VERSION:
         print(f"gutenberg2kindle version {__version__}")
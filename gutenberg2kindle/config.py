@@ -2,7 +2,8 @@
 Auxiliary functions to handle user configuration for `gutenberg2kindle`
 """
 
-from typing import Final, Optional, Union
+import json
+from typing import Any, Final, Mapping, Optional, Union
 
 import usersettings
 
@@ -20,17 +21,54 @@ AVAILABLE_SETTINGS: Final[list[str]] = [
     SETTINGS_FORMAT,
 ]
 
+# settings that can be set with `set-config` but are not prompted
+# by `interactive-config`
+SETTINGS_SMTP_PROFILES: Final[str] = "smtp_profiles"
+SETTINGS_SMTP_STRATEGY: Final[str] = "smtp_strategy"
+SETTINGS_WATCH_AUTHORS: Final[str] = "watch_authors"
+SETTINGS_WATCH_SUBJECTS: Final[str] = "watch_subjects"
+ADVANCED_SETTINGS: Final[list[str]] = [
+    SETTINGS_SIZE_LIMIT_IN_MB,
+    SETTINGS_SMTP_PROFILES,
+    SETTINGS_SMTP_STRATEGY,
+    SETTINGS_WATCH_AUTHORS,
+    SETTINGS_WATCH_SUBJECTS,
+]
+
 FORMAT_IMAGES: Final[str] = "images"
 FORMAT_NO_IMAGES: Final[str] = "no_images"
 FORMAT_AUTO: Final[str] = "auto"
+FORMAT_SMALLEST: Final[str] = "smallest"
 VALID_FORMATS: Final[list[str]] = [
     FORMAT_IMAGES,
     FORMAT_NO_IMAGES,
     FORMAT_AUTO,
+    FORMAT_SMALLEST,
+]
+
+STRATEGY_ROUND_ROBIN: Final[str] = "round_robin"
+STRATEGY_LEAST_LOADED: Final[str] = "least_loaded"
+VALID_STRATEGIES: Final[list[str]] = [
+    STRATEGY_ROUND_ROBIN,
+    STRATEGY_LEAST_LOADED,
 ]
 
+SMTP_PROFILE_REQUIRED_FIELDS: Final[dict[str, type]] = {
+    "name": str,
+    "smtp_server": str,
+    "sender_email": str,
+}
+SMTP_PROFILE_OPTIONAL_FIELDS: Final[dict[str, type]] = {
+    "smtp_port": int,
+    "weight": int,
+    "limit": int,
+}
+
 DEFAULT_MAX_SIZE_IN_MB: Final[int] = 15
 
+# every setting, resolved for a given use (see `resolve_config`)
+Config = Mapping[str, Union[int, str]]
+
 settings: usersettings.Settings = usersettings.Settings("gutenberg2kindle")
 
 
@@ -46,12 +84,19 @@ def setup_settings() -> None:
     settings.add_setting(SETTINGS_KINDLE_EMAIL, str, "")
     settings.add_setting(SETTINGS_FORMAT, str, FORMAT_AUTO)
     settings.add_setting(SETTINGS_SIZE_LIMIT_IN_MB, int, DEFAULT_MAX_SIZE_IN_MB)
+    settings.add_setting(SETTINGS_SMTP_PROFILES, str, "")
+    settings.add_setting(SETTINGS_SMTP_STRATEGY, str, STRATEGY_ROUND_ROBIN)
+    settings.add_setting(SETTINGS_WATCH_AUTHORS, str, "")
+    settings.add_setting(SETTINGS_WATCH_SUBJECTS, str, "")
     settings.load_settings()
 
 
-def get_config(name: Optional[str] = None) -> Union[usersettings.Settings, int, str]:
+def get_config(
+    name: Optional[str] = None, config: Optional[Config] = None
+) -> Union[usersettings.Settings, int, str]:
     """
-    Given a setting name, returns the value for said setting.
+    Given a setting name, returns the value for said setting, from the
+    given config (see `resolve_config`) or, if none, as stored.
 
     If no name is given, returns a dictionary with all settings
     and their corresponding values.
@@ -60,19 +105,20 @@ def get_config(name: Optional[str] = None) -> Union[usersettings.Settings, int,
     if name is None:
         return settings
 
-    if name not in AVAILABLE_SETTINGS:
+    if name not in AVAILABLE_SETTINGS + ADVANCED_SETTINGS:
         raise ValueError(f"`{name}` is not a valid setting name")
 
-    stored_value: Union[int, str] = settings[name]
+    stored_value: Union[int, str] = (settings if config is None else config)[name]
     return stored_value
 
 
-def set_config(name: str, value: Union[int, str]) -> None:
+def validate_setting(name: str, value: Union[int, str]) -> None:
     """
-    Given a setting name and a value, sets the value for said setting.
+    Given a setting name and a value, raises a `ValueError` if the
+    name is not a valid setting name or the value is not valid for it.
     """
 
-    if name not in AVAILABLE_SETTINGS:
+    if name not in AVAILABLE_SETTINGS + ADVANCED_SETTINGS:
         raise ValueError(f"`{name}` is not a valid setting name")
 
     if name == SETTINGS_FORMAT and value not in VALID_FORMATS:
@@ -80,10 +126,115 @@ def set_config(name: str, value: Union[int, str]) -> None:
             f"`{value}` is not a valid format " f"(expected one of: {VALID_FORMATS})"
         )
 
-    settings[name] = value
+    if name == SETTINGS_SMTP_STRATEGY and value not in VALID_STRATEGIES:
+        raise ValueError(
+            f"`{value}` is not a valid strategy (expected one of: {VALID_STRATEGIES})"
+        )
+
+    if name == SETTINGS_SMTP_PROFILES and value:
+        parse_smtp_profiles(str(value))
+
+    if name == SETTINGS_SIZE_LIMIT_IN_MB and (
+        not str(value).isdigit() or int(value) < 1
+    ):
+        raise ValueError(
+            f"`{value}` is not a valid size limit (expected a positive integer)"
+        )
+
+
+def parse_setting(name: str, value: Union[int, str]) -> Union[int, str]:
+    """
+    Given a valid setting name and value, returns the value with the type
+    it's read with, e.g. the size limit given as text to `set-config`
+    """
+
+    if name == SETTINGS_SIZE_LIMIT_IN_MB:
+        return int(value)
+    return value
+
+
+def validate_smtp_profile(profile: object) -> None:
+    """
+    Given a single SMTP profile, raises a `ValueError` if it's missing
+    any required field or if any of its fields is not valid
+    """
+
+    if not isinstance(profile, dict):
+        raise ValueError("SMTP profiles must be a list of objects")
+
+    fields = SMTP_PROFILE_REQUIRED_FIELDS | SMTP_PROFILE_OPTIONAL_FIELDS
+    for field, value in profile.items():
+        if field not in fields:
+            raise ValueError(f"`{field}` is not a valid SMTP profile field")
+        if not isinstance(value, fields[field]) or isinstance(value, bool):
+            raise ValueError(f"`{field}` must be of type `{fields[field].__name__}`")
+        if isinstance(value, int) and value < 1:
+            raise ValueError(f"`{field}` must be a positive integer")
+
+    for field in SMTP_PROFILE_REQUIRED_FIELDS:
+        if field not in profile:
+            raise ValueError(f"SMTP profile is missing the `{field}` field")
+
+
+def parse_smtp_profiles(value: str) -> list[dict[str, Any]]:
+    """
+    Given the SMTP profiles setting, a JSON list of objects, returns the
+    profiles in it, raising a `ValueError` if any of them is not valid
+    """
+
+    try:
+        profiles = json.loads(value)
+    except ValueError as err:
+        raise ValueError(f"SMTP profiles are not valid JSON: {err}") from err
+
+    if not isinstance(profiles, list):
+        raise ValueError("SMTP profiles must be a list of objects")
+
+    names: set[str] = set()
+    for profile in profiles:
+        validate_smtp_profile(profile)
+        if profile["name"] in names:
+            raise ValueError(f"SMTP profile `{profile['name']}` is defined twice")
+        names.add(profile["name"])
+
+    return profiles
+
+
+def set_config(name: str, value: Union[int, str]) -> None:
+    """
+    Given a setting name and a value, sets the value for said setting.
+    """
+
+    validate_setting(name, value)
+
+    settings[name] = parse_setting(name, value)
     settings.save_settings()
 
 
+def ensure_settings() -> None:
+    """Sets up the settings, unless they were already set up"""
+
+    if SETTINGS_SMTP_SERVER not in settings:
+        setup_settings()
+
+
+def resolve_config(
+    values: Optional[Mapping[str, Union[int, str]]] = None,
+) -> Config:
+    """
+    Returns every setting as stored, with the given values taking their
+    place, so that it can be passed around (e.g. to `get_config`) without
+    changing the stored settings, which are global to the process.
+    """
+
+    values = values or {}
+    for name, value in values.items():
+        validate_setting(name, value)
+
+    stored = {name: settings[name] for name in AVAILABLE_SETTINGS + ADVANCED_SETTINGS}
+    return stored | {name: parse_setting(name, value) for name, value in values.items()}
+
+
 def interactive_config() -> None:
     """
     Interactively attempts to fill-in the config values, one by one.
@@ -1,14 +1,17 @@
 """Auxiliary module with functions that help with sending email"""
 
+import base64
+import mmap
 import smtplib
-import ssl
+from contextlib import contextmanager
+from dataclasses import dataclass
 from email import encoders
 from email.mime.base import MIMEBase
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from io import BytesIO
 from math import ceil
-from typing import Final
+from typing import Callable, Final, Iterable, Iterator, Optional, Union
 
 from gutenberg2kindle.config import (
     SETTINGS_KINDLE_EMAIL,
@@ -16,12 +19,102 @@ from gutenberg2kindle.config import (
     SETTINGS_SIZE_LIMIT_IN_MB,
     SETTINGS_SMTP_PORT,
     SETTINGS_SMTP_SERVER,
+    Config,
     get_config,
 )
+from gutenberg2kindle.network import get_tls_context
 
 EMAIL_SUBJECT: Final[str] = "Your Project Gutenberg ebook!"
 EMAIL_BODY: Final[str] = "- Sent with gutenberg2kindle. Happy reading!"
 
+DEFAULT_PROFILE_NAME: Final[str] = "default"
+DEFAULT_SMTP_PORT: Final[int] = 465
+
+SMTP_ERROR_AUTH: Final[str] = "auth"
+SMTP_ERROR_REJECTED: Final[str] = "rejected"
+SMTP_ERROR_TRANSIENT: Final[str] = "transient"
+SMTP_ERROR_CONNECTION: Final[str] = "connection"
+AUTH_FAILURE_CODES: Final[frozenset[int]] = frozenset({530, 534, 535})
+
+# 57 bytes are encoded as a 76 character line of base64, the maximum allowed
+ATTACHMENT_LINE_BYTES: Final[int] = 57
+ATTACHMENT_CHUNK_BYTES: Final[int] = ATTACHMENT_LINE_BYTES * 1024
+ATTACHMENT_PLACEHOLDER: Final[str] = "@@attachment@@"
+
+BookFile = Union[BytesIO, mmap.mmap]
+
+
+@dataclass
+class SmtpProfile:
+    """
+    Sender account on an SMTP server. `weight` is its share of the emails
+    when several profiles are used, and `limit` the maximum amount of
+    emails it can send per run, if any
+    """
+
+    name: str
+    smtp_server: str
+    sender_email: str
+    smtp_port: int = DEFAULT_SMTP_PORT
+    weight: int = 1
+    limit: Optional[int] = None
+
+
+def get_default_profile(config: Optional[Config] = None) -> SmtpProfile:
+    """
+    Returns the sender account configured with the regular SMTP settings,
+    as stored or as in `config`, if given
+    """
+
+    smtp_server = get_config(SETTINGS_SMTP_SERVER, config)
+    assert isinstance(smtp_server, str)
+
+    sender_email = get_config(SETTINGS_SENDER_EMAIL, config)
+    assert isinstance(sender_email, str)
+
+    port = get_config(SETTINGS_SMTP_PORT, config)
+    assert isinstance(port, int)
+
+    return SmtpProfile(DEFAULT_PROFILE_NAME, smtp_server, sender_email, port)
+
+
+def is_transient_code(code: int) -> bool:
+    """Returns whether an SMTP reply code is a transient (4xx) failure"""
+
+    return 400 <= code < 500
+
+
+def classify_smtp_error(error: OSError) -> str:
+    """
+    Given an error raised while sending an email, returns its kind:
+
+    - `auth`: the account can't be used, e.g. its credentials are invalid
+    - `rejected`: the server permanently rejected this email in particular
+    - `transient`: the server replied with a 4xx code, worth retrying later
+    - `connection`: the connection failed or was dropped
+    """
+
+    codes = []
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in error.recipients.values()]
+    elif isinstance(error, smtplib.SMTPResponseException):
+        codes = [error.smtp_code]
+
+    if codes and all(map(is_transient_code, codes)):
+        return SMTP_ERROR_TRANSIENT
+
+    if isinstance(
+        error, (smtplib.SMTPAuthenticationError, smtplib.SMTPNotSupportedError)
+    ) or any(code in AUTH_FAILURE_CODES for code in codes):
+        return SMTP_ERROR_AUTH
+
+    if not codes or isinstance(
+        error, (smtplib.SMTPConnectError, smtplib.SMTPHeloError)
+    ):
+        return SMTP_ERROR_CONNECTION
+
+    return SMTP_ERROR_REJECTED
+
 
 def create_base_email(sender_email: str, kindle_email: str) -> MIMEMultipart:
     """Generates and returns the base email to use when sending a book"""
@@ -34,60 +127,342 @@ def create_base_email(sender_email: str, kindle_email: str) -> MIMEMultipart:
     return message
 
 
-def send_book(book_id: int, book_in_memory: BytesIO, password: str) -> bool:
+class SmtpSession:
+    """
+    Authenticated connection to the SMTP server of a profile (or to the
+    configured one, if none) that is opened lazily and kept open across
+    several emails, reconnecting transparently if the server drops it
+    in between. Every connection shares the same TLS context, so that
+    reconnecting resumes the previous TLS session instead of negotiating
+    a new one (see `ResumingTlsContext`).
+
+    Without a profile, the SMTP settings are read from `config`, if given.
+    """
+
+    def __init__(
+        self,
+        password: str,
+        profile: Optional[SmtpProfile] = None,
+        config: Optional[Config] = None,
+    ) -> None:
+        self.password = password
+        self.profile = profile
+        self.config = config
+        self._server: Optional[smtplib.SMTP] = None
+
+    def __enter__(self) -> "SmtpSession":
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        self.close()
+
+    @property
+    def sender_email(self) -> str:
+        """Address the emails sent through this session are sent from"""
+
+        return (self.profile or get_default_profile(self.config)).sender_email
+
+    def connect(self) -> smtplib.SMTP:
+        """Opens and authenticates a new connection to the SMTP server"""
+
+        profile = self.profile or get_default_profile(self.config)
+
+        self.close()
+        # shared by every connection, so that TLS sessions can be resumed
+        context = get_tls_context()
+        server = smtplib.SMTP(profile.smtp_server, profile.smtp_port)
+        try:
+            server.starttls(context=context)
+            server.login(profile.sender_email, self.password)
+            context.remember(server.sock)
+        except BaseException:
+            server.close()
+            raise
+
+        self._server = server
+        return server
+
+    def ensure_connected(self) -> smtplib.SMTP:
+        """
+        Returns the open connection to the SMTP server, if the server still
+        answers a NOOP on it, or opens and authenticates a new one otherwise
+        """
+
+        if self._server is not None:
+            try:
+                if self._server.noop()[0] == 250:
+                    return self._server
+            except smtplib.SMTPException:
+                # dropped, the new connection replaces it below
+                pass
+
+        return self.connect()
+
+    def sendmail(self, sender_email: str, kindle_email: str, text: str) -> None:
+        """
+        Sends an email through the open connection, opening a new one
+        if there's none yet or if the previous one was dropped
+        """
+
+        self._send(lambda server: server.sendmail(sender_email, kindle_email, text))
+
+    def send_data(
+        self,
+        sender_email: str,
+        kindle_email: str,
+        chunks: Callable[[], Iterator[bytes]],
+    ) -> None:
+        """
+        Same as `sendmail`, but the email is given in chunks that are already
+        in SMTP DATA form (see `iter_email_data`) and that are streamed as
+        they're produced. `chunks` is called again if the email has to be
+        sent over a new connection.
+        """
+
+        self._send(
+            lambda server: stream_email(server, sender_email, kindle_email, chunks())
+        )
+
+    def _send(self, send: Callable[[smtplib.SMTP], object]) -> None:
+        if self._server is not None:
+            try:
+                send(self._server)
+                return
+            except smtplib.SMTPServerDisconnected:
+                self._server = None
+
+        send(self.connect())
+
+    def close(self) -> None:
+        """Closes the connection to the SMTP server, if open"""
+
+        if self._server is None:
+            return
+
+        get_tls_context().remember(self._server.sock)
+        try:
+            self._server.quit()
+        except smtplib.SMTPException:
+            self._server.close()
+        self._server = None
+
+
+@contextmanager
+def map_book(path: str) -> Iterator[mmap.mmap]:
+    """Maps a book on disk into memory, read-only, while within it"""
+
+    with open(path, "rb") as book_file:
+        try:
+            book = mmap.mmap(book_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError as err:
+            # empty files can't be mapped
+            raise ValueError(f"Could not map {path}: {err}") from err
+
+    with book:
+        yield book
+
+
+def get_book_size(book: BookFile) -> int:
+    """Returns the size of a book in memory or mapped from disk, in bytes"""
+
+    if isinstance(book, mmap.mmap):
+        return len(book)
+    return book.getbuffer().nbytes
+
+
+def get_book_view(book: BookFile) -> memoryview:
+    """
+    Returns a view of the bytes of a book in memory or mapped from disk,
+    without copying them, to be released once done
+    """
+
+    if isinstance(book, mmap.mmap):
+        return memoryview(book)
+    return book.getbuffer()
+
+
+def iter_email_data(
+    sender_email: str, kindle_email: str, book: mmap.mmap, filename: str
+) -> Iterator[bytes]:
     """
-    Given a book as a file in memory, sends the file via email
-    using the stored config if the file is less than the set limit
+    Yields the email with a book mapped from disk attached, in SMTP DATA
+    form (CRLF line endings, leading dots doubled, see `smtplib.quotedata`),
+    encoding the attachment to base64 one chunk at a time straight from the
+    mapped pages, so that no copy of the whole book is ever made
     """
 
+    message = create_base_email(sender_email, kindle_email)
+    part = MIMEBase("application", "octet-stream")
+    part["Content-Transfer-Encoding"] = "base64"
+    part.add_header("Content-Disposition", f"attachment; filename={filename}")
+    part.set_payload(ATTACHMENT_PLACEHOLDER)
+    message.attach(part)
+    head, _, tail = message.as_string().partition(ATTACHMENT_PLACEHOLDER)
+
+    yield smtplib.quotedata(head).encode("ascii")
+    # base64 has no dots, and full chunks are a whole amount of lines
+    with memoryview(book) as book_view:
+        for start in range(0, len(book_view), ATTACHMENT_CHUNK_BYTES):
+            end = start + ATTACHMENT_CHUNK_BYTES
+            yield base64.encodebytes(book_view[start:end]).replace(b"\n", b"\r\n")
+    yield smtplib.quotedata(tail).encode("ascii")
+
+
+def _abort_transaction(server: smtplib.SMTP, code: int) -> None:
+    """Resets the mail transaction after an error, as `sendmail` does"""
+
+    if code == 421:
+        server.close()
+        return
+
+    try:
+        server.rset()
+    except smtplib.SMTPServerDisconnected:
+        pass
+
+
+def stream_email(
+    server: smtplib.SMTP,
+    sender_email: str,
+    kindle_email: str,
+    chunks: Iterable[bytes],
+) -> None:
+    """
+    Sends an email given in chunks already in SMTP DATA form, writing each
+    chunk to the connection as soon as it's produced. Raises the same
+    errors as `smtplib.SMTP.sendmail` would.
+    """
+
+    server.ehlo_or_helo_if_needed()
+    code, reply = server.mail(sender_email)
+    if code != 250:
+        _abort_transaction(server, code)
+        raise smtplib.SMTPSenderRefused(code, reply, sender_email)
+
+    code, reply = server.rcpt(kindle_email)
+    if code not in (250, 251):
+        _abort_transaction(server, code)
+        raise smtplib.SMTPRecipientsRefused({kindle_email: (code, reply)})
+
+    server.putcmd("data")
+    code, reply = server.getreply()
+    if code != 354:
+        _abort_transaction(server, code)
+        raise smtplib.SMTPDataError(code, reply)
+
+    last_chunk = b""
+    for chunk in chunks:
+        server.send(chunk)
+        last_chunk = chunk or last_chunk
+    server.send(b".\r\n" if last_chunk.endswith(b"\r\n") else b"\r\n.\r\n")
+
+    code, reply = server.getreply()
+    if code != 250:
+        _abort_transaction(server, code)
+        raise smtplib.SMTPDataError(code, reply)
+
+
+def send_book(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    book_id: int,
+    book: Union[BookFile, str],
+    password: str,
+    filename: Optional[str] = None,
+    session: Optional[SmtpSession] = None,
+    config: Optional[Config] = None,
+) -> bool:
+    """
+    Given a book as a file in memory, mapped from disk or as the path of a
+    file on disk, sends the file via email using the stored config if the
+    file is less than the set limit.
+
+    Books on disk are mapped into memory, and their attachment is encoded
+    and sent chunk by chunk (see `iter_email_data`), so that sending them
+    takes little memory regardless of their size.
+
+    The attachment is named after the book ID unless a filename is given.
+    If an SMTP session is given, its connection is reused instead of
+    opening a new one just for this book, and the book is sent from
+    the session's sender address. If a config is given (see
+    `resolve_config`), it's used instead of the stored one.
+    """
+
+    if isinstance(book, str):
+        with map_book(book) as mapped_book:
+            return send_book(book_id, mapped_book, password, filename, session, config)
+
     # retrieving config
-    sender_email = get_config(SETTINGS_SENDER_EMAIL)
+    sender_email = (
+        session.sender_email
+        if session is not None
+        else get_config(SETTINGS_SENDER_EMAIL, config)
+    )
     assert isinstance(sender_email, str)
 
-    kindle_email = get_config(SETTINGS_KINDLE_EMAIL)
+    kindle_email = get_config(SETTINGS_KINDLE_EMAIL, config)
     assert isinstance(kindle_email, str)
 
-    smtp_server = get_config(SETTINGS_SMTP_SERVER)
-    assert isinstance(smtp_server, str)
+    if not is_valid_file_size(book, config):
+        return False
 
-    port = get_config(SETTINGS_SMTP_PORT)
-    assert isinstance(port, int)
+    filename = filename or f"{book_id}.epub"
+    if isinstance(book, mmap.mmap):
+        mapped_book = book
 
-    if not is_valid_file_size(book_in_memory):
-        return False
+        def _send(smtp_session: SmtpSession) -> None:
+            smtp_session.send_data(
+                sender_email,
+                kindle_email,
+                lambda: iter_email_data(
+                    sender_email, kindle_email, mapped_book, filename
+                ),
+            )
 
-    # creating email message
-    message = create_base_email(sender_email, kindle_email)
+    else:
+        # creating email message
+        message = create_base_email(sender_email, kindle_email)
 
-    # loading the file as an attachment
-    part = MIMEBase("application", "octet-stream")
-    part.set_payload(book_in_memory.read())
-    encoders.encode_base64(part)
-    part.add_header("Content-Disposition", f"attachment; filename={book_id}.epub")
-    message.attach(part)
+        # loading the file as an attachment
+        part = MIMEBase("application", "octet-stream")
+        part.set_payload(book.read())
+        encoders.encode_base64(part)
+        part.add_header("Content-Disposition", f"attachment; filename={filename}")
+        message.attach(part)
+        text = message.as_string()
+
+        def _send(smtp_session: SmtpSession) -> None:
+            smtp_session.sendmail(sender_email, kindle_email, text)
 
     # send email
-    text = message.as_string()
-    context = ssl.create_default_context()
-    with smtplib.SMTP(smtp_server, port) as server:
-        server.starttls(context=context)
-        server.login(sender_email, password)
-        server.sendmail(sender_email, kindle_email, text)
+    if session is not None:
+        _send(session)
+        return True
+
+    with SmtpSession(password, config=config) as new_session:
+        _send(new_session)
 
     return True
 
 
-def is_valid_file_size(book_in_memory: BytesIO) -> bool:
+def get_size_limit_in_bytes(config: Optional[Config] = None) -> int:
+    """Returns the configured file size limit (or the one in `config`), in bytes"""
+
+    size_limit = get_config(SETTINGS_SIZE_LIMIT_IN_MB, config)
+    assert isinstance(size_limit, int)
+
+    return size_limit * 1024 * 1024
+
+
+def is_valid_file_size(book: BookFile, config: Optional[Config] = None) -> bool:
     """
-    Given a book as a file in memory, returns whether the file is
-    less than the set limit
+    Given a book as a file in memory, or mapped from disk, returns whether
+    the file is less than the set limit, or the one in `config` if given
     """
 
     # retrieving config
-    size_limit = get_config(SETTINGS_SIZE_LIMIT_IN_MB)
+    size_limit = get_config(SETTINGS_SIZE_LIMIT_IN_MB, config)
     assert isinstance(size_limit, int)
 
-    file_size = bytes_to_mb(len(book_in_memory.getvalue()))
+    file_size = bytes_to_mb(get_book_size(book))
     return file_size <= size_limit
 
 
@@ -0,0 +1,643 @@
+"""Auxiliary functions to inspect and rewrite EPUB files"""
+
+import posixpath
+import re
+import shutil
+import zipfile
+import zlib
+from dataclasses import dataclass, field
+from io import BytesIO
+from typing import IO, Final, Iterator, Optional, Union
+from urllib.parse import unquote, urlsplit
+from xml.etree import ElementTree
+
+from gutenberg2kindle.cache import MappedFile
+
+EPUB_MIMETYPE_ENTRY: Final[str] = "mimetype"
+EPUB_MIMETYPE: Final[bytes] = b"application/epub+zip"
+EPUB_CONTAINER_ENTRY: Final[str] = "META-INF/container.xml"
+
+CONTAINER_NAMESPACE: Final[str] = "urn:oasis:names:tc:opendocument:xmlns:container"
+OPF_NAMESPACE: Final[str] = "http://www.idpf.org/2007/opf"
+
+DEFAULT_MAX_IMAGE_SIDE: Final[int] = 1200
+DEFAULT_JPEG_QUALITY: Final[int] = 75
+
+NCX_MEDIA_TYPE: Final[str] = "application/x-dtbncx+xml"
+TEXT_MEDIA_TYPES: Final[tuple[str, ...]] = (
+    "application/xhtml+xml",
+    "text/html",
+    "text/css",
+    NCX_MEDIA_TYPE,
+)
+REMOVABLE_MEDIA_PREFIXES: Final[tuple[str, ...]] = (
+    "font/",
+    "application/font",
+    "application/x-font",
+    "application/vnd.ms-opentype",
+    "image/",
+)
+# entries of the table of contents in EPUB 3 navigation documents and NCX files
+NAV_ENTRY_TAG: Final[str] = "li"
+NCX_ENTRY_TAG: Final[str] = "navPoint"
+NAV_LINK_PATTERN: Final[str] = r"""(\b(?:href|src)\s*=\s*["'])([^"']*)(["'])"""
+ZIP_ENTRY_OVERHEAD_IN_BYTES: Final[int] = 128
+RECOMPRESSIBLE_IMAGE_TYPES: Final[dict[str, str]] = {
+    "image/jpeg": "JPEG",
+    "image/png": "PNG",
+}
+
+
+@dataclass
+class ManifestItem:
+    """An item listed in the package document of an EPUB"""
+
+    item_id: str
+    path: str
+    media_type: str
+    properties: str = ""
+
+
+@dataclass
+class Volume:
+    """A self-contained part of a book that was split across several EPUBs"""
+
+    number: int
+    total: int
+    content: bytes
+
+
+@dataclass
+class VolumePlan:
+    """The chapters and archive entries that make up a volume of a split book"""
+
+    chapter_ids: list[str] = field(default_factory=list)
+    paths: set[str] = field(default_factory=set)
+    size: int = 0
+
+
+@dataclass
+class Package:
+    """The parts of an EPUB's package document needed to rewrite the book"""
+
+    opf_path: str
+    manifest: dict[str, ManifestItem] = field(default_factory=dict)
+    spine: list[str] = field(default_factory=list)
+    cover_id: Optional[str] = None
+
+
+def find_opf_path(archive: zipfile.ZipFile) -> str:
+    """
+    Given an open EPUB archive, returns the path of its package
+    document as declared in the container file
+    """
+
+    container = ElementTree.fromstring(archive.read(EPUB_CONTAINER_ENTRY))
+    rootfile = container.find(f".//{{{CONTAINER_NAMESPACE}}}rootfile")
+    if rootfile is None or not rootfile.get("full-path"):
+        raise ValueError("EPUB container does not declare a package document")
+    return str(rootfile.get("full-path"))
+
+
+def read_package(archive: zipfile.ZipFile) -> Package:
+    """
+    Given an open EPUB archive, parses its package document and
+    returns its manifest and spine, with paths relative to the archive root
+    """
+
+    opf_path = find_opf_path(archive)
+    opf_dir = posixpath.dirname(opf_path)
+    root = ElementTree.fromstring(archive.read(opf_path))
+    package = Package(opf_path=opf_path)
+
+    for item in root.iter(f"{{{OPF_NAMESPACE}}}item"):
+        item_id = item.get("id", "")
+        href = unquote(item.get("href", ""))
+        package.manifest[item_id] = ManifestItem(
+            item_id=item_id,
+            # remote resources are kept as URLs, as they're not in the archive
+            path=(
+                href
+                if urlsplit(href).scheme
+                else posixpath.normpath(posixpath.join(opf_dir, href))
+            ),
+            media_type=item.get("media-type", ""),
+            properties=item.get("properties", ""),
+        )
+        if "cover-image" in package.manifest[item_id].properties:
+            package.cover_id = item_id
+
+    for itemref in root.iter(f"{{{OPF_NAMESPACE}}}itemref"):
+        package.spine.append(itemref.get("idref", ""))
+
+    for meta in root.iter(f"{{{OPF_NAMESPACE}}}meta"):
+        if meta.get("name") == "cover" and package.cover_id is None:
+            package.cover_id = meta.get("content")
+
+    return package
+
+
+def verify_epub(book: Union[IO[bytes], MappedFile]) -> None:
+    """
+    Given an EPUB as a file object, checks that it's complete and intact,
+    raising a ValueError with the first problem found otherwise:
+
+    - its central directory can be read, which a truncated download loses
+    - every entry decompresses and matches its CRC-32, reading one chunk
+      at a time, so that no entry is ever fully unpacked in memory
+    - it starts with the EPUB `mimetype` entry
+    - its container declares a package document, and every local file
+      in the package's manifest is in the archive
+
+    The file object is rewound afterwards.
+    """
+
+    try:
+        with zipfile.ZipFile(book) as archive:
+            names = archive.namelist()
+            if names[:1] != [EPUB_MIMETYPE_ENTRY]:
+                raise ValueError("EPUB file does not start with its mimetype")
+            if archive.read(EPUB_MIMETYPE_ENTRY).strip() != EPUB_MIMETYPE:
+                raise ValueError("EPUB file has an invalid mimetype")
+
+            corrupt_entry = archive.testzip()
+            if corrupt_entry is not None:
+                raise ValueError(f"EPUB entry {corrupt_entry} is corrupt")
+
+            package = read_package(archive)
+            missing = sorted(
+                item.path
+                for item in package.manifest.values()
+                if item.path not in names and not urlsplit(item.path).scheme
+            )
+            if missing:
+                raise ValueError(f"EPUB manifest lists missing files: {missing}")
+    except (
+        zipfile.BadZipFile,
+        KeyError,
+        ElementTree.ParseError,
+        zlib.error,
+        EOFError,
+    ) as err:
+        raise ValueError(f"Invalid EPUB file: {err}") from err
+    finally:
+        book.seek(0)
+
+
+def _remove_elements(opf_text: str, tag: str, attribute: str, values: set[str]) -> str:
+    def _drop(match: re.Match[str]) -> str:
+        value = re.search(rf'\b{attribute}\s*=\s*["\']([^"\']*)["\']', match.group(0))
+        if value is not None and value.group(1) in values:
+            return ""
+        return match.group(0)
+
+    return re.sub(rf"[ \t]*<(?:\w+:)?{tag}\b[^>]*/>[ \t]*\r?\n?", _drop, opf_text)
+
+
+def remove_manifest_items(opf_text: str, item_ids: set[str]) -> str:
+    """
+    Given the text of a package document, removes the manifest items
+    with the given IDs while keeping the rest of the document untouched
+    """
+
+    return _remove_elements(opf_text, "item", "id", item_ids)
+
+
+def remove_spine_items(opf_text: str, item_ids: set[str]) -> str:
+    """
+    Given the text of a package document, removes the spine references
+    to the given IDs while keeping the rest of the document untouched
+    """
+
+    return _remove_elements(opf_text, "itemref", "idref", item_ids)
+
+
+def find_unused_resources(archive: zipfile.ZipFile, package: Package) -> set[str]:
+    """
+    Given an open EPUB archive and its package, returns the IDs of the fonts
+    and images that no text document of the book refers to
+    """
+
+    referenced_text = []
+    for item in package.manifest.values():
+        if item.media_type in TEXT_MEDIA_TYPES and item.path in archive.NameToInfo:
+            referenced_text.append(archive.read(item.path).decode("utf-8", "replace"))
+    corpus = unquote("\n".join(referenced_text))
+
+    unused = set()
+    for item in package.manifest.values():
+        if item.item_id == package.cover_id or item.item_id in package.spine:
+            continue
+        if "nav" in item.properties.split():
+            continue
+        if not item.media_type.startswith(REMOVABLE_MEDIA_PREFIXES):
+            continue
+        if posixpath.basename(item.path) not in corpus:
+            unused.add(item.item_id)
+
+    return unused
+
+
+def recompress_image(
+    image_bytes: bytes,
+    media_type: str,
+    max_side: int = DEFAULT_MAX_IMAGE_SIDE,
+    jpeg_quality: int = DEFAULT_JPEG_QUALITY,
+) -> bytes:
+    """
+    Given an image, downscales it so that its longest side is at most
+    `max_side` pixels and recompresses it, returning the original bytes
+    if that doesn't make it smaller.
+
+    Requires Pillow (the `images` extra); without it, images are returned
+    untouched, and so are images that Pillow can't read, e.g. corrupt ones.
+    """
+
+    image_format = RECOMPRESSIBLE_IMAGE_TYPES.get(media_type)
+    if image_format is None:
+        return image_bytes
+
+    try:
+        from PIL import Image  # type: ignore  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return image_bytes
+
+    output = BytesIO()
+    try:
+        with Image.open(BytesIO(image_bytes)) as image:
+            image.thumbnail((max_side, max_side))
+            if image_format == "JPEG":
+                image.convert("RGB").save(
+                    output, "JPEG", quality=jpeg_quality, optimize=True
+                )
+            else:
+                image.save(output, "PNG", optimize=True)
+    except (OSError, ValueError, SyntaxError, Image.DecompressionBombError):
+        # unreadable images are kept as they are, rather than failing the book
+        return image_bytes
+
+    compressed = output.getvalue()
+    return compressed if len(compressed) < len(image_bytes) else image_bytes
+
+
+def write_epub_entry(
+    archive: zipfile.ZipFile, info: zipfile.ZipInfo, content: bytes
+) -> None:
+    """
+    Writes an entry into an EPUB archive, storing the `mimetype` entry
+    uncompressed as required by the spec and deflating everything else
+    at the maximum level
+    """
+
+    new_info = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+    new_info.external_attr = info.external_attr
+    if info.filename == EPUB_MIMETYPE_ENTRY:
+        new_info.compress_type = zipfile.ZIP_STORED
+        archive.writestr(new_info, content)
+    else:
+        new_info.compress_type = zipfile.ZIP_DEFLATED
+        archive.writestr(new_info, content, compresslevel=9)
+
+
+def compact_epub(
+    book_bytes: bytes,
+    max_image_side: int = DEFAULT_MAX_IMAGE_SIDE,
+    jpeg_quality: int = DEFAULT_JPEG_QUALITY,
+) -> bytes:
+    """
+    Given the bytes of an EPUB, returns a smaller but equivalent EPUB:
+    unused fonts and images are stripped, the remaining images are
+    downscaled and recompressed, and the archive is deflated at the
+    maximum level.
+
+    Designed to run in a separate process, so it only takes and
+    returns plain bytes.
+    """
+
+    try:
+        compacted = _compact_archive(book_bytes, max_image_side, jpeg_quality)
+    except (zipfile.BadZipFile, KeyError, ElementTree.ParseError) as err:
+        raise ValueError(f"Invalid EPUB file: {err}") from err
+
+    return compacted if len(compacted) < len(book_bytes) else book_bytes
+
+
+def _compact_archive(
+    book_bytes: bytes, max_image_side: int, jpeg_quality: int
+) -> bytes:
+    output = BytesIO()
+    with zipfile.ZipFile(BytesIO(book_bytes)) as source:
+        package = read_package(source)
+        unused_ids = find_unused_resources(source, package)
+        unused_paths = {package.manifest[item_id].path for item_id in unused_ids}
+        media_types = {item.path: item.media_type for item in package.manifest.values()}
+
+        with zipfile.ZipFile(output, "w") as target:
+            infos = sorted(
+                source.infolist(), key=lambda i: i.filename != EPUB_MIMETYPE_ENTRY
+            )
+            for info in infos:
+                if info.is_dir() or info.filename in unused_paths:
+                    continue
+
+                content = source.read(info.filename)
+                if info.filename == package.opf_path and unused_ids:
+                    content = remove_manifest_items(
+                        content.decode("utf-8"), unused_ids
+                    ).encode("utf-8")
+                elif info.filename in media_types:
+                    content = recompress_image(
+                        content,
+                        media_types[info.filename],
+                        max_image_side,
+                        jpeg_quality,
+                    )
+
+                write_epub_entry(target, info, content)
+
+    return output.getvalue()
+
+
+def _entry_size(info: zipfile.ZipInfo) -> int:
+    return info.compress_size + len(info.filename) * 2 + ZIP_ENTRY_OVERHEAD_IN_BYTES
+
+
+def find_chapter_images(
+    archive: zipfile.ZipFile, package: Package
+) -> dict[str, set[str]]:
+    """
+    Given an open EPUB archive and its package, returns the paths of the
+    images each chapter of the spine refers to, reading one chapter at a time
+    """
+
+    images = [
+        item
+        for item in package.manifest.values()
+        if item.media_type.startswith("image/") and item.item_id != package.cover_id
+    ]
+
+    chapter_images: dict[str, set[str]] = {}
+    for chapter_id in package.spine:
+        chapter = package.manifest[chapter_id]
+        with archive.open(chapter.path) as chapter_file:
+            text = unquote(chapter_file.read().decode("utf-8", "replace"))
+        chapter_images[chapter_id] = {
+            image.path for image in images if posixpath.basename(image.path) in text
+        }
+
+    return chapter_images
+
+
+def plan_volumes(
+    archive: zipfile.ZipFile, package: Package, max_volume_bytes: int
+) -> list[VolumePlan]:
+    """
+    Given an open EPUB archive and its package, greedily groups its chapters
+    into volumes whose estimated size, based on the compressed sizes in the
+    archive's central directory, stays under `max_volume_bytes`.
+
+    Every volume carries the entries that aren't chapters or chapter images
+    (stylesheets, fonts, cover, navigation documents...).
+    """
+
+    chapter_images = find_chapter_images(archive, package)
+    splittable = {package.manifest[chapter_id].path for chapter_id in package.spine}
+    splittable = splittable.union(*chapter_images.values())
+    sizes = {info.filename: _entry_size(info) for info in archive.infolist()}
+    shared_size = (
+        sum(size for path, size in sizes.items() if path not in splittable)
+        + len(package.spine) * ZIP_ENTRY_OVERHEAD_IN_BYTES
+    )
+
+    volumes: list[VolumePlan] = []
+    current = VolumePlan(size=shared_size)
+    for chapter_id in package.spine:
+        chapter_paths = {package.manifest[chapter_id].path} | chapter_images[chapter_id]
+        extra = sum(sizes.get(path, 0) for path in chapter_paths - current.paths)
+
+        if current.chapter_ids and current.size + extra > max_volume_bytes:
+            volumes.append(current)
+            current = VolumePlan(size=shared_size)
+            extra = sum(sizes.get(path, 0) for path in chapter_paths)
+
+        if shared_size + extra > max_volume_bytes:
+            raise ValueError(f"Chapter `{chapter_id}` does not fit in a single volume")
+
+        current.chapter_ids.append(chapter_id)
+        current.paths |= chapter_paths
+        current.size += extra
+
+    volumes.append(current)
+    return volumes
+
+
+def rewrite_volume_package(
+    opf_text: str, excluded_ids: set[str], number: int, total: int
+) -> str:
+    """
+    Given the text of a package document, drops the chapters and images
+    that don't belong to a volume and marks the volume in the book's title
+    """
+
+    opf_text = remove_spine_items(opf_text, excluded_ids)
+    opf_text = remove_manifest_items(opf_text, excluded_ids)
+    return re.sub(
+        r"(<(?:\w+:)?title\b[^>]*>)(.*?)(</(?:\w+:)?title>)",
+        rf"\1\2 (Volume {number} of {total})\3",
+        opf_text,
+        count=1,
+        flags=re.DOTALL,
+    )
+
+
+def find_entries(text: str, tag: str) -> list[tuple[int, int]]:
+    """
+    Given the text of a document, returns the start and end of each of its
+    outermost elements with the given tag, nested ones included in them
+    """
+
+    spans = []
+    depth = start = 0
+    for match in re.finditer(rf"<(/?)(?:\w+:)?{tag}\b[^>]*?(/?)>", text):
+        if match.group(2):
+            continue
+        if not match.group(1):
+            if not depth:
+                start = match.start()
+            depth += 1
+        elif depth:
+            depth -= 1
+            if not depth:
+                spans.append((start, match.end()))
+    return spans
+
+
+def _points_to(link: re.Match[str], nav_dir: str, paths: set[str]) -> bool:
+    href = unquote(link.group(2).split("#", 1)[0])
+    if not href or urlsplit(href).scheme:
+        return False
+    return posixpath.normpath(posixpath.join(nav_dir, href)) in paths
+
+
+def _retarget_links(text: str, nav_dir: str, paths: set[str], target: str) -> str:
+    def _retarget(link: re.Match[str]) -> str:
+        if _points_to(link, nav_dir, paths):
+            return f"{link.group(1)}{target}{link.group(3)}"
+        return link.group(0)
+
+    return re.sub(NAV_LINK_PATTERN, _retarget, text)
+
+
+def prune_nav_entries(
+    text: str, tag: str, nav_dir: str, excluded_paths: set[str]
+) -> str:
+    """
+    Given the text of a navigation document, removes the entries with the
+    given tag whose links (theirs and those of the entries nested in them)
+    all point to the excluded files. Entries that only keep some of their
+    nested entries point to the first of them instead, so that no link is
+    left dangling, and the rest of the document is kept untouched.
+    """
+
+    pieces = []
+    last = 0
+    for start, end in find_entries(text, tag):
+        entry = text[start:end]
+        kept = [
+            link.group(2)
+            for link in re.finditer(NAV_LINK_PATTERN, entry)
+            if not _points_to(link, nav_dir, excluded_paths)
+        ]
+        if not kept and re.search(NAV_LINK_PATTERN, entry):
+            # the entry's line is dropped along with it
+            pieces.append(text[last:start].rstrip(" \t"))
+            trailing = re.compile(r"[ \t]*\r?\n?").match(text, end)
+            assert trailing is not None
+            last = trailing.end()
+            continue
+
+        body_start, body_end = entry.index(">") + 1, entry.rindex("<")
+        body = prune_nav_entries(
+            entry[body_start:body_end], tag, nav_dir, excluded_paths
+        )
+        if kept:
+            body = _retarget_links(body, nav_dir, excluded_paths, kept[0])
+        pieces.append(text[last:start] + entry[:body_start] + body + entry[body_end:])
+        last = end
+
+    pieces.append(text[last:])
+    return "".join(pieces)
+
+
+def rewrite_volume_nav(
+    nav_text: str, item: ManifestItem, excluded_paths: set[str]
+) -> str:
+    """
+    Given the text of a navigation document (EPUB 3 navigation document or
+    NCX file), drops its entries for the chapters that don't belong to a volume
+    """
+
+    tag = NCX_ENTRY_TAG if item.media_type == NCX_MEDIA_TYPE else NAV_ENTRY_TAG
+    return prune_nav_entries(
+        nav_text, tag, posixpath.dirname(item.path), excluded_paths
+    )
+
+
+def write_volume(
+    archive: zipfile.ZipFile,
+    package: Package,
+    volumes: list[VolumePlan],
+    number: int,
+) -> bytes:
+    """
+    Writes the given volume (counting from 1) of a split book as a new EPUB,
+    copying the archive entries it needs one at a time
+    """
+
+    plan = volumes[number - 1]
+    splittable = set().union(*(volume.paths for volume in volumes))
+    excluded_ids = {
+        item.item_id
+        for item in package.manifest.values()
+        if item.path in splittable and item.path not in plan.paths
+    }
+
+    nav_items = {
+        item.path: item
+        for item in package.manifest.values()
+        if "nav" in item.properties.split() or item.media_type == NCX_MEDIA_TYPE
+    }
+
+    output = BytesIO()
+    with zipfile.ZipFile(output, "w", compresslevel=9) as target:
+        infos = sorted(
+            archive.infolist(), key=lambda i: i.filename != EPUB_MIMETYPE_ENTRY
+        )
+        for info in infos:
+            if info.is_dir() or (
+                info.filename in splittable and info.filename not in plan.paths
+            ):
+                continue
+
+            if info.filename == package.opf_path:
+                write_epub_entry(
+                    target,
+                    info,
+                    rewrite_volume_package(
+                        archive.read(info).decode("utf-8"),
+                        excluded_ids,
+                        number,
+                        len(volumes),
+                    ).encode("utf-8"),
+                )
+            elif info.filename in nav_items:
+                write_epub_entry(
+                    target,
+                    info,
+                    rewrite_volume_nav(
+                        archive.read(info).decode("utf-8"),
+                        nav_items[info.filename],
+                        splittable - plan.paths,
+                    ).encode("utf-8"),
+                )
+            elif info.filename == EPUB_MIMETYPE_ENTRY:
+                write_epub_entry(target, info, archive.read(info))
+            else:
+                new_info = zipfile.ZipInfo(info.filename, date_time=info.date_time)
+                new_info.compress_type = zipfile.ZIP_DEFLATED
+                with archive.open(info) as source, target.open(new_info, "w") as dest:
+                    shutil.copyfileobj(source, dest)
+
+    return output.getvalue()
+
+
+def split_epub(
+    book: Union[IO[bytes], MappedFile], max_volume_bytes: int
+) -> Iterator[Volume]:
+    """
+    Given an EPUB as a file object, lazily yields it split at chapter
+    boundaries into valid volume EPUBs of at most `max_volume_bytes` each.
+
+    Volumes are planned from the archive's central directory and written
+    one at a time, entry by entry, so the source archive is never fully
+    unpacked in memory. As the plan is only an estimate, every volume is
+    written once to check its size before the first one is yielded, so that
+    a ValueError is raised before any volume is sent if one is too large.
+    """
+
+    try:
+        with zipfile.ZipFile(book) as archive:
+            package = read_package(archive)
+            volumes = plan_volumes(archive, package, max_volume_bytes)
+
+            for number in range(1, len(volumes) + 1):
+                content = write_volume(archive, package, volumes, number)
+                if len(content) > max_volume_bytes:
+                    raise ValueError(f"Volume {number} exceeds the size limit")
+
+            # volumes are written the same way twice, so their sizes still hold
+            for number in range(1, len(volumes) + 1):
+                content = write_volume(archive, package, volumes, number)
+                yield Volume(number=number, total=len(volumes), content=content)
+    except (zipfile.BadZipFile, KeyError, ElementTree.ParseError) as err:
+        raise ValueError(f"Invalid EPUB file: {err}") from err
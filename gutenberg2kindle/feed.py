@@ -0,0 +1,221 @@
+"""
+Incremental polling of Project Gutenberg's feed of new releases, so that
+books matching the saved filters can be sent as soon as they're published
+"""
+
+import json
+import os
+from dataclasses import asdict, dataclass, field
+from typing import Final, Optional
+from urllib.parse import urlsplit
+from xml.etree import ElementTree
+
+import requests
+
+from gutenberg2kindle.cache import write_atomically
+from gutenberg2kindle.config import (
+    SETTINGS_WATCH_AUTHORS,
+    SETTINGS_WATCH_SUBJECTS,
+    get_config,
+)
+from gutenberg2kindle.gutenberg import REQUESTS_TIMEOUT
+
+NEW_RELEASES_FEED_URL: Final[str] = (
+    "https://www.gutenberg.org/cache/epub/feeds/today.rss"
+)
+DEFAULT_WATCH_STATE_PATH: Final[str] = "~/.gutenberg2kindle-watch.json"
+DEFAULT_WATCH_INTERVAL_IN_SECONDS: Final[int] = 3600
+
+
+@dataclass
+class FeedEntry:
+    """A book listed in the feed of new releases"""
+
+    book_id: int
+    title: str
+    author: str = ""
+    description: str = ""
+
+    def matches(self, authors: list[str], subjects: list[str]) -> bool:
+        """
+        Returns whether the entry matches any of the given authors (in its
+        author) or subjects (in its title or description), ignoring case.
+        Every entry matches if no filter is given.
+        """
+
+        if not authors and not subjects:
+            return True
+
+        text = f"{self.title}\n{self.description}".casefold()
+        return any(
+            author.casefold() in self.author.casefold() for author in authors
+        ) or any(subject.casefold() in text for subject in subjects)
+
+
+@dataclass
+class WatchState:
+    """
+    What's persisted between polls: the validators of the last copy of the
+    feed that was processed, for conditional requests, and the high-water
+    mark, the newest book ID that was processed
+    """
+
+    source: str = ""
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    high_water_mark: Optional[int] = None
+
+
+@dataclass
+class FeedUpdate:
+    """
+    Outcome of a poll: the entries newer than the high-water mark, and the
+    state to persist once they've been processed
+    """
+
+    state: WatchState
+    entries: list[FeedEntry] = field(default_factory=list)
+
+
+def parse_filters(value: str) -> list[str]:
+    """Parses a comma-separated list of filters, e.g. `Twain, Austen`"""
+
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def get_watch_filters() -> tuple[list[str], list[str]]:
+    """Returns the authors and subjects saved in the config to watch for"""
+
+    authors = get_config(SETTINGS_WATCH_AUTHORS)
+    assert isinstance(authors, str)
+
+    subjects = get_config(SETTINGS_WATCH_SUBJECTS)
+    assert isinstance(subjects, str)
+
+    return parse_filters(authors), parse_filters(subjects)
+
+
+def parse_feed(content: bytes) -> list[FeedEntry]:
+    """
+    Given an RSS feed of books, e.g. Project Gutenberg's new releases, returns
+    its entries, skipping those that don't link to a book. Titles are split
+    from their author at their last ` by `, as listed by Project Gutenberg.
+    """
+
+    try:
+        root = ElementTree.fromstring(content)
+    except ElementTree.ParseError as err:
+        raise ValueError(f"Invalid feed: {err}") from err
+
+    entries = []
+    for item in root.iter("item"):
+        book_id = urlsplit(item.findtext("link", "").strip()).path.rpartition("/")[2]
+        if not book_id.isdigit():
+            continue
+
+        title, _, author = item.findtext("title", "").strip().rpartition(" by ")
+        entries.append(
+            FeedEntry(
+                int(book_id),
+                title or author,
+                author if title else "",
+                item.findtext("description", "").strip(),
+            )
+        )
+    return entries
+
+
+class FeedWatcher:
+    """
+    Polls a feed of new releases, either from a URL or from a local copy of
+    it, returning only the entries newer than the high-water mark. Polls are
+    conditional: a feed that didn't change since the last poll is not
+    downloaded again (with `If-None-Match` and `If-Modified-Since`) nor
+    read again (its modification time and size are compared instead).
+
+    The state is only persisted through `commit`, once the entries of a
+    poll have been processed, so that they're polled again otherwise.
+    On the very first poll, every entry in the feed is considered already
+    seen, so that only later releases are returned.
+    """
+
+    def __init__(self, source: str, state_path: str) -> None:
+        self.source = source
+        self.state_path = os.path.expanduser(state_path)
+
+    @property
+    def is_local(self) -> bool:
+        """Whether the feed is read from a local file"""
+
+        return urlsplit(self.source).scheme not in ("http", "https")
+
+    def load_state(self) -> WatchState:
+        """Returns the persisted state, if it belongs to the watched feed"""
+
+        try:
+            with open(self.state_path, encoding="utf-8") as state_file:
+                state = WatchState(**json.load(state_file))
+        except (OSError, ValueError, TypeError):
+            return WatchState(self.source)
+
+        if state.source != self.source:
+            # validators of another feed are useless, but its mark still holds
+            return WatchState(self.source, high_water_mark=state.high_water_mark)
+        return state
+
+    def commit(self, update: FeedUpdate) -> None:
+        """Persists the state of a poll, once its entries were processed"""
+
+        write_atomically(self.state_path, json.dumps(asdict(update.state)).encode())
+
+    def poll(self, session: Optional[requests.Session] = None) -> FeedUpdate:
+        """
+        Fetches the feed, unless unchanged since the last poll, and returns
+        its entries newer than the high-water mark
+        """
+
+        state = self.load_state()
+        content = (
+            self._read_local(state) if self.is_local else self._fetch(state, session)
+        )
+        if content is None:
+            return FeedUpdate(state)
+
+        entries = parse_feed(content)
+        mark = state.high_water_mark
+        state.high_water_mark = max(
+            [entry.book_id for entry in entries] + ([] if mark is None else [mark]),
+            default=None,
+        )
+        if mark is None:
+            return FeedUpdate(state)
+        return FeedUpdate(state, [entry for entry in entries if entry.book_id > mark])
+
+    def _read_local(self, state: WatchState) -> Optional[bytes]:
+        stat = os.stat(self.source)
+        validator = f"{stat.st_mtime_ns}-{stat.st_size}"
+        if validator == state.etag:
+            return None
+
+        state.etag = validator
+        with open(self.source, "rb") as feed_file:
+            return feed_file.read()
+
+    def _fetch(
+        self, state: WatchState, session: Optional[requests.Session]
+    ) -> Optional[bytes]:
+        headers = {}
+        if state.etag is not None:
+            headers["If-None-Match"] = state.etag
+        if state.last_modified is not None:
+            headers["If-Modified-Since"] = state.last_modified
+
+        http = session if session is not None else requests
+        response = http.get(self.source, headers=headers, timeout=REQUESTS_TIMEOUT)
+        if response.status_code == 304:
+            return None
+
+        response.raise_for_status()
+        state.etag = response.headers.get("ETag")
+        state.last_modified = response.headers.get("Last-Modified")
+        return response.content
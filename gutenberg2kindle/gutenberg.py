@@ -1,68 +1,521 @@
 """Auxiliary functions to connect to Project Gutenberg's library"""
 
+import base64
+import binascii
 from io import BytesIO
-from typing import Final, Optional
+from typing import Callable, Final, Mapping, Optional, Union
 
 import requests
 
+from gutenberg2kindle.budget import ByteBudget
+from gutenberg2kindle.cache import BookCache, MappedFile, content_digest
 from gutenberg2kindle.config import (
     FORMAT_AUTO,
     FORMAT_IMAGES,
     FORMAT_NO_IMAGES,
+    FORMAT_SMALLEST,
     SETTINGS_FORMAT,
+    Config,
     get_config,
 )
+from gutenberg2kindle.email import get_book_size, get_book_view
+from gutenberg2kindle.epub import verify_epub
 
 GUTENBERG_BOOK_WITH_IMAGES_BASE_URL: Final[
     str
 ] = "https://www.gutenberg.org/ebooks/{book_id}.epub.images"
 GUTENBERG_BOOK_BASE_URL: Final[str] = "https://www.gutenberg.org/ebooks/{book_id}.epub"
+GUTENBERG_BOOK_EPUB3_BASE_URL: Final[str] = (
+    "https://www.gutenberg.org/ebooks/{book_id}.epub3.images"
+)
+
+# variant that is only considered when picking the smallest one
+VARIANT_EPUB3_IMAGES: Final[str] = "epub3_images"
 
 REQUESTS_TIMEOUT: Final[int] = 10
+DOWNLOAD_CHUNK_SIZE: Final[int] = 64 * 1024
+
+# book downloaded into memory, or mapped from the cache
+Book = Union[BytesIO, MappedFile]
+
+# called with the size of every chunk of a book as it's downloaded
+ChunkCallback = Callable[[int], None]
+# called with the format and URL of the variant of a book that was picked
+ResolvedCallback = Callable[[str, str], None]
 
 
-def download_book(book_id: int) -> Optional[BytesIO]:
+def get_candidate_urls(book_id: int, fmt: str) -> list[tuple[str, str]]:
     """
-    Given a Gutenberg book ID as an integer, and the expected format,
-    fetches the content of the book into memory and returns it wrapped
-    in a Bytes IO instance.
+    Given a Gutenberg book ID and the expected format, returns the
+    variants to try, in order, as pairs of format and URL
     """
 
-    fmt = get_config(SETTINGS_FORMAT)
-    assert isinstance(fmt, str)
-
     book_url = GUTENBERG_BOOK_BASE_URL.format(book_id=book_id)
+    book_with_images_url = GUTENBERG_BOOK_WITH_IMAGES_BASE_URL.format(book_id=book_id)
+
     if fmt == FORMAT_NO_IMAGES:
-        return fetch_book_from_url(book_url)
+        return [(FORMAT_NO_IMAGES, book_url)]
 
-    book_with_images_url = GUTENBERG_BOOK_WITH_IMAGES_BASE_URL.format(book_id=book_id)
     if fmt == FORMAT_IMAGES:
-        return fetch_book_from_url(book_with_images_url)
+        return [(FORMAT_IMAGES, book_with_images_url)]
 
     if fmt == FORMAT_AUTO:
-        book_or_none = fetch_book_from_url(book_with_images_url)
+        return [(FORMAT_IMAGES, book_with_images_url), (FORMAT_NO_IMAGES, book_url)]
+
+    if fmt == FORMAT_SMALLEST:
+        return [
+            (
+                VARIANT_EPUB3_IMAGES,
+                GUTENBERG_BOOK_EPUB3_BASE_URL.format(book_id=book_id),
+            ),
+            (FORMAT_IMAGES, book_with_images_url),
+            (FORMAT_NO_IMAGES, book_url),
+        ]
+
+    raise ValueError(f"{fmt} is an invalid format")
+
+
+def download_book(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    book_id: int,
+    budget: Optional[ByteBudget] = None,
+    cache: Optional[BookCache] = None,
+    revalidate: bool = False,
+    session: Optional[requests.Session] = None,
+    on_chunk: Optional[ChunkCallback] = None,
+    on_resolved: Optional[ResolvedCallback] = None,
+    config: Optional[Config] = None,
+) -> Optional[Book]:
+    """
+    Given a Gutenberg book ID as an integer, and the expected format,
+    fetches the content of the book and returns it, either downloaded
+    into memory in a Bytes IO instance or mapped from the cache.
+
+    If a memory budget is given, the bytes of downloaded books are reserved
+    from it and must be released by the caller once the book has been sent
+    (see `get_reserved_bytes`).
+
+    If a cache is given, books already in it are mapped from disk (see
+    `BookCache.map`) without contacting Project Gutenberg (unless
+    `revalidate` is set and upstream announces a different digest), and
+    without taking any of the memory budget. Downloaded books are stored in
+    the cache.
+
+    If a `requests` session is given, its connections are reused, and if
+    `on_chunk` is given, it's called as the book is downloaded (see
+    `fetch_book_from_url`). If `on_resolved` is given, it's called with
+    the format and URL of the variant of the book that's returned.
+
+    With the `smallest` format, every variant of the book is considered,
+    smallest first (see `sort_by_size`), and the one that's downloaded is
+    recorded in the cache, if given, so that later runs go straight for it.
+    The format is read from `config`, if given (see `resolve_config`).
+    """
+
+    resolved = fetch_variant(
+        book_id, budget, cache, revalidate, session, on_chunk, config
+    )
+    if resolved is None:
+        return None
+
+    variant, book_url, book = resolved
+    if on_resolved is not None:
+        on_resolved(variant, book_url)
+    return book
+
+
+def fetch_variant(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    book_id: int,
+    budget: Optional[ByteBudget] = None,
+    cache: Optional[BookCache] = None,
+    revalidate: bool = False,
+    session: Optional[requests.Session] = None,
+    on_chunk: Optional[ChunkCallback] = None,
+    config: Optional[Config] = None,
+) -> Optional[tuple[str, str, Book]]:
+    """
+    Same as `download_book`, but returns the format and URL of the variant
+    of the book that was picked along with the book itself
+    """
+
+    fmt = get_config(SETTINGS_FORMAT, config)
+    assert isinstance(fmt, str)
+
+    candidates = get_candidate_urls(book_id, fmt)
+    if fmt == FORMAT_SMALLEST:
+        candidates = sort_by_size(book_id, candidates, cache, session)
+
+    if cache is not None:
+        for variant, book_url in candidates:
+            if revalidate and is_cached_book_stale(
+                cache, book_id, variant, book_url, session
+            ):
+                continue
+
+            cached_book = read_cached_book(cache, book_id, variant)
+            if cached_book is not None:
+                return variant, book_url, cached_book
 
+    for variant, book_url in candidates:
+        book_or_none = fetch_book_from_url(book_url, budget, session, on_chunk)
         if book_or_none is not None:
-            return book_or_none
+            if cache is not None:
+                cache.store(book_id, variant, book_url, book_or_none.getvalue())
+                if fmt == FORMAT_SMALLEST:
+                    cache.record_variant(book_id, variant)
+            return variant, book_url, book_or_none
 
-        return fetch_book_from_url(book_url)
+    return None
 
-    raise ValueError(f"{fmt} is an invalid format")
+
+def get_variant_size(
+    book_id: int,
+    variant: str,
+    book_url: str,
+    cache: Optional[BookCache] = None,
+    session: Optional[requests.Session] = None,
+) -> Optional[int]:
+    """
+    Returns the size of a variant of a book, in bytes: the size of its
+    cached copy if any or, without downloading it, the size announced
+    upstream. Returns None if unknown or if the variant isn't available.
+    """
+
+    if cache is not None:
+        entry = cache.lookup(book_id, variant)
+        if entry is not None:
+            return int(entry["size"])
+
+    http = session if session is not None else requests
+    response = http.head(book_url, timeout=REQUESTS_TIMEOUT, allow_redirects=True)
+    content_length = response.headers.get("Content-Length", "")
+    if response.status_code != 200 or not content_length.isdigit():
+        return None
+    return int(content_length)
+
+
+def get_cached_sizes(
+    book_id: int, candidates: list[tuple[str, str]], cache: Optional[BookCache]
+) -> dict[str, int]:
+    """
+    Given the variants of a book, as pairs of format and URL, returns
+    the size, in bytes, of the ones in the cache, by variant
+    """
+
+    if cache is None:
+        return {}
+
+    entries = {variant: cache.lookup(book_id, variant) for variant, _ in candidates}
+    return {
+        variant: int(entry["size"])
+        for variant, entry in entries.items()
+        if entry is not None
+    }
+
+
+def estimate_book_size(
+    book_id: int,
+    cache: Optional[BookCache] = None,
+    session: Optional[requests.Session] = None,
+    config: Optional[Config] = None,
+) -> Optional[int]:
+    """
+    Returns the size, in bytes, of the variant of a book that would be
+    downloaded with the configured format (or the one in `config`, if
+    given), without downloading it, or None if unknown. Upstream is only
+    asked if no variant of the book is in the cache, if given
+    """
+
+    fmt = get_config(SETTINGS_FORMAT, config)
+    assert isinstance(fmt, str)
+
+    candidates = get_candidate_urls(book_id, fmt)
+    cached_sizes = get_cached_sizes(book_id, candidates, cache)
+    if cached_sizes:
+        # the first cached variant is the one that would be read, rather
+        # than downloading any (see `fetch_variant`)
+        if fmt == FORMAT_SMALLEST:
+            candidates = sort_by_size(book_id, candidates, cache, session)
+        return next(
+            cached_sizes[variant]
+            for variant, _ in candidates
+            if variant in cached_sizes
+        )
+
+    sizes = (
+        get_variant_size(book_id, variant, book_url, session=session)
+        for variant, book_url in candidates
+    )
+    known_sizes = (size for size in sizes if size is not None)
+    if fmt == FORMAT_SMALLEST:
+        return min(known_sizes, default=None)
+
+    # the first variant available is the one that would be downloaded
+    return next(known_sizes, None)
+
+
+def sort_by_size(
+    book_id: int,
+    candidates: list[tuple[str, str]],
+    cache: Optional[BookCache] = None,
+    session: Optional[requests.Session] = None,
+) -> list[tuple[str, str]]:
+    """
+    Given the variants of a book, as pairs of format and URL, returns them
+    smallest first, so that the one picked is the smallest available, and
+    under the size limit whenever any variant is. Variants whose size is
+    unknown go last.
+
+    If the cache records the variant chosen in a previous run, it goes
+    first instead, without checking any size. Otherwise, if any variant is
+    in the cache, the cached ones go first, smallest first, without asking
+    upstream for the sizes of the others.
+    """
+
+    chosen = cache.chosen_variant(book_id) if cache is not None else None
+    if chosen is not None:
+        return sorted(candidates, key=lambda candidate: candidate[0] != chosen)
+
+    cached_sizes = get_cached_sizes(book_id, candidates, cache)
+    if cached_sizes:
+        return sorted(
+            candidates,
+            key=lambda candidate: (
+                candidate[0] not in cached_sizes,
+                cached_sizes.get(candidate[0], 0),
+            ),
+        )
+
+    sizes = {
+        variant: get_variant_size(book_id, variant, book_url, session=session)
+        for variant, book_url in candidates
+    }
+    return sorted(
+        candidates,
+        key=lambda candidate: (sizes[candidate[0]] is None, sizes[candidate[0]] or 0),
+    )
+
+
+def prefetch_book(
+    book_id: int,
+    cache: BookCache,
+    budget: Optional[ByteBudget] = None,
+    on_chunk: Optional[ChunkCallback] = None,
+    session: Optional[requests.Session] = None,
+) -> Optional[int]:
+    """
+    Given a Gutenberg book ID, makes sure the book is stored in the cache,
+    downloading it if needed, and verifies the stored copy. Returns the
+    book's size in bytes, or None if it could not be prefetched, e.g.
+    because Project Gutenberg could not be reached.
+    """
+
+    try:
+        book = download_book(book_id, budget, cache, session=session, on_chunk=on_chunk)
+        if book is None:
+            return None
+        book = verify_book(book_id, book, budget, cache, session, on_chunk)
+    except (ValueError, requests.RequestException):
+        return None
+
+    with get_book_view(book) as book_view:
+        digest = content_digest(book_view)
+        size = book_view.nbytes
+
+    valid = cache.verify(digest)
+    if budget is not None:
+        budget.release(get_reserved_bytes(book))
+    book.close()
+
+    return size if valid else None
+
+
+def get_reserved_bytes(book: Book) -> int:
+    """
+    Returns the bytes of the memory budget taken by a book: its size if it
+    was downloaded into memory, or none if it's mapped from the cache
+    """
+
+    return 0 if isinstance(book, MappedFile) else get_book_size(book)
+
+
+def verify_book(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    book_id: int,
+    book: Book,
+    budget: Optional[ByteBudget] = None,
+    cache: Optional[BookCache] = None,
+    session: Optional[requests.Session] = None,
+    on_chunk: Optional[ChunkCallback] = None,
+    config: Optional[Config] = None,
+) -> Book:
+    """
+    Given a downloaded book, checks that it's an intact EPUB (see
+    `verify_epub`) and returns it. If it's corrupt, it's closed and the
+    book is fetched once more from Project Gutenberg, bypassing the cache,
+    and the fresh copy is returned if intact. Raises a ValueError if it
+    isn't, or if it can't be downloaded again.
+
+    The memory reserved for the book in the budget, if any, is carried
+    over to the fresh copy without blocking, or released on errors. The
+    fresh copy is fetched in the format of `config`, if given.
+    """
+
+    try:
+        verify_epub(book)
+        return book
+    except ValueError as err:
+        error = err
+
+    reserved = get_reserved_bytes(book)
+    book.close()
+    if cache is not None:
+        cache.forget(book_id)
+
+    fresh_book = None
+    try:
+        fresh_book = download_book(
+            book_id, None, cache, False, session, on_chunk, None, config
+        )
+        if fresh_book is None:
+            raise ValueError(f"{error}, and it could not be downloaded again")
+        verify_epub(fresh_book)
+    except BaseException:
+        if budget is not None:
+            budget.release(reserved)
+        if fresh_book is not None:
+            fresh_book.close()
+        raise
+
+    if budget is not None:
+        budget.resize(reserved, get_reserved_bytes(fresh_book))
+    return fresh_book
+
+
+def read_cached_book(cache: BookCache, book_id: int, fmt: str) -> Optional[MappedFile]:
+    """Returns a book in a given format mapped from the cache, if stored"""
+
+    entry = cache.lookup(book_id, fmt)
+    if entry is None:
+        return None
+    return cache.map(str(entry["sha256"]))
+
+
+def is_cached_book_stale(
+    cache: BookCache,
+    book_id: int,
+    fmt: str,
+    book_url: str,
+    session: Optional[requests.Session] = None,
+) -> bool:
+    """
+    Returns whether upstream announces a digest for a book that differs
+    from the one of its cached copy, without downloading the book
+    """
+
+    entry = cache.lookup(book_id, fmt)
+    if entry is None:
+        return False
+
+    upstream_digest = fetch_upstream_digest(book_url, session)
+    return upstream_digest is not None and upstream_digest != entry["sha256"]
+
+
+def parse_digest_header(headers: Mapping[str, str]) -> Optional[str]:
+    """
+    Given the headers of a response, returns the SHA-256 digest announced
+    in its `Repr-Digest` (RFC 9530) or `Digest` (RFC 3230) header
+    as a hex string, if any
+    """
+
+    for header in ("Repr-Digest", "Digest"):
+        for value in headers.get(header, "").split(","):
+            algorithm, _, encoded = value.strip().partition("=")
+            if algorithm.lower() != "sha-256" or not encoded:
+                continue
+            try:
+                return base64.b64decode(encoded.strip(":")).hex()
+            except binascii.Error:
+                continue
+    return None
+
+
+def fetch_upstream_digest(
+    book_url: str, session: Optional[requests.Session] = None
+) -> Optional[str]:
+    """
+    Given a Gutenberg book URL, returns the SHA-256 digest that the
+    server announces for it without downloading the book, if any
+    """
+
+    http = session if session is not None else requests
+    response = http.head(book_url, timeout=REQUESTS_TIMEOUT, allow_redirects=True)
+    if response.status_code != 200:
+        return None
+    return parse_digest_header(response.headers)
 
 
-def fetch_book_from_url(book_url: str) -> Optional[BytesIO]:
+def fetch_book_from_url(
+    book_url: str,
+    budget: Optional[ByteBudget] = None,
+    session: Optional[requests.Session] = None,
+    on_chunk: Optional[ChunkCallback] = None,
+) -> Optional[BytesIO]:
     """
     Given a Gutenberg book URL, fetches the content
     of the book into memory and returns it wrapped in a BytesIO
-    instance
+    instance.
+
+    When a memory budget is given, the download blocks before reading
+    the body until the book's announced size fits in the budget.
+
+    Returns None if the server announces a digest that the downloaded
+    content doesn't match. If a `requests` session is given, its
+    connections are reused.
+
+    If `on_chunk` is given, the body is streamed in chunks and the size of
+    each one is passed to it as soon as it's read, e.g. to report progress.
     """
 
-    response = requests.get(book_url, timeout=REQUESTS_TIMEOUT)
+    http = session if session is not None else requests
+    response = http.get(book_url, timeout=REQUESTS_TIMEOUT, stream=True)
     if response.status_code != 200:
+        response.close()
+        return None
+
+    reserved = 0
+    if budget is not None:
+        reserved = int(response.headers.get("Content-Length", 0))
+        budget.acquire(reserved)
+
+    try:
+        if on_chunk is None:
+            book_content = response.content
+        else:
+            book_content = read_in_chunks(response, on_chunk)
+    except requests.RequestException:
+        if budget is not None:
+            budget.release(reserved)
+        raise
+
+    if budget is not None:
+        budget.resize(reserved, len(book_content))
+
+    upstream_digest = parse_digest_header(response.headers)
+    if upstream_digest is not None and upstream_digest != content_digest(book_content):
+        if budget is not None:
+            budget.release(len(book_content))
         return None
-    book_content = response.content
 
     memory_bytes = BytesIO()
     memory_bytes.write(book_content)
     memory_bytes.seek(0)
     return memory_bytes
+
+
+def read_in_chunks(response: requests.Response, on_chunk: ChunkCallback) -> bytes:
+    """Reads the body of a streamed response, passing each chunk's size along"""
+
+    chunks = []
+    for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+        chunks.append(chunk)
+        on_chunk(len(chunk))
+    return b"".join(chunks)
@@ -0,0 +1,282 @@
+"""
+Reuse of DNS lookups and TLS sessions across the many short connections of
+a batch, which otherwise pay for a lookup and a full TLS handshake each,
+with counters to measure how much is saved
+"""
+
+import socket
+import ssl
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Any, Callable, Final, Iterator, Optional, Union
+
+import requests
+from requests.adapters import DEFAULT_CA_BUNDLE_PATH, HTTPAdapter
+
+DEFAULT_DNS_TTL_IN_SECONDS: Final[float] = 300.0
+
+
+@dataclass
+class NetworkStats:
+    """DNS lookups and TLS handshakes done so far, and the time spent on them"""
+
+    dns_lookups: int = 0
+    dns_cached: int = 0
+    dns_seconds: float = 0.0
+    tls_handshakes: int = 0
+    tls_resumed: int = 0
+    tls_seconds: float = 0.0
+
+    def summary(self) -> str:
+        """Returns the counters as a line of text"""
+
+        return (
+            f"{self.dns_lookups} DNS lookups ({self.dns_cached} answered from "
+            f"cache, {self.dns_seconds:.2f} seconds), {self.tls_handshakes} TLS "
+            f"handshakes ({self.tls_resumed} resumed, {self.tls_seconds:.2f} seconds)"
+        )
+
+
+class DnsCache:  # pylint: disable=too-many-instance-attributes
+    """
+    Thread-safe cache of `socket.getaddrinfo` results, each one kept for
+    `ttl` seconds. Lookups that fail are not cached.
+
+    While installed, every lookup in the process goes through the cache,
+    including those of the HTTP and SMTP clients, which don't offer a hook
+    of their own. Installs are counted, so that nested or concurrent users
+    (e.g. several `BookSender`s) only restore the original on the last exit.
+    """
+
+    def __init__(
+        self,
+        ttl: float = DEFAULT_DNS_TTL_IN_SECONDS,
+        resolve: Callable[..., Any] = socket.getaddrinfo,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.ttl = ttl
+        self.clock = clock
+        self.lookups = 0
+        self.hits = 0
+        self.seconds = 0.0
+
+        self._resolve = resolve
+        self._entries: dict[tuple[Any, ...], tuple[float, list[Any]]] = {}
+        self._lock = threading.Lock()
+        self._installs = 0
+
+    def getaddrinfo(self, *args: Any, **kwargs: Any) -> list[Any]:
+        """Same as `socket.getaddrinfo`, answered from the cache if possible"""
+
+        key = (*args, *sorted(kwargs.items()))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.clock() < entry[0]:
+                self.hits += 1
+                return list(entry[1])
+
+        start = time.perf_counter()
+        addresses = list(self._resolve(*args, **kwargs))
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            self.lookups += 1
+            self.seconds += elapsed
+            self._entries[key] = (self.clock() + self.ttl, addresses)
+        return list(addresses)
+
+    def clear(self) -> None:
+        """Forgets every cached lookup"""
+
+        with self._lock:
+            self._entries.clear()
+
+    def install(self) -> None:
+        """Routes every lookup in the process through the cache"""
+
+        with self._lock:
+            if not self._installs:
+                setattr(socket, "getaddrinfo", self.getaddrinfo)
+            self._installs += 1
+
+    def uninstall(self) -> None:
+        """Undoes an install, restoring the original lookups after the last one"""
+
+        with self._lock:
+            self._installs = max(self._installs - 1, 0)
+            if not self._installs:
+                setattr(socket, "getaddrinfo", self._resolve)
+
+    @contextmanager
+    def installed(self) -> Iterator["DnsCache"]:
+        """Installs the cache while within it"""
+
+        self.install()
+        try:
+            yield self
+        finally:
+            self.uninstall()
+
+
+class ResumingTlsContext(ssl.SSLContext):
+    """
+    Client TLS context that offers each host the session of the previous
+    connection to it, so that the server can resume it with an abbreviated
+    handshake instead of a full one. Sessions are only valid within the
+    context that created them, so the same context must be shared by every
+    connection, and it counts the handshakes done through it.
+
+    With TLS 1.3, the session ticket is only received once some data is
+    read, so the session of a connection is picked up as late as possible:
+    when the next connection to the same host is made, or through
+    `remember` while the connection is still open.
+    """
+
+    def __init__(self, *_: Any, **__: Any) -> None:
+        super().__init__()
+        self.handshakes = 0
+        self.resumed = 0
+        self.seconds = 0.0
+
+        self._sessions: dict[str, ssl.SSLSession] = {}
+        self._sockets: dict[str, weakref.ref[ssl.SSLSocket]] = {}
+        self._lock = threading.Lock()
+
+    def remember(self, tls_socket: Optional[socket.socket]) -> None:
+        """Keeps the session of an open connection, to resume it later"""
+
+        if not isinstance(tls_socket, ssl.SSLSocket) or not tls_socket.server_hostname:
+            return
+
+        session = tls_socket.session
+        if session is None or (
+            tls_socket.version() == "TLSv1.3" and not session.has_ticket
+        ):
+            return
+
+        with self._lock:
+            self._sessions[str(tls_socket.server_hostname)] = session
+
+    def wrap_socket(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self,
+        sock: socket.socket,
+        server_side: bool = False,
+        do_handshake_on_connect: bool = True,
+        suppress_ragged_eofs: bool = True,
+        server_hostname: Union[str, bytes, None] = None,
+        session: Optional[ssl.SSLSession] = None,
+    ) -> ssl.SSLSocket:
+        host = (
+            server_hostname.decode()
+            if isinstance(server_hostname, bytes)
+            else server_hostname
+        )
+        if host is not None and not server_side and session is None:
+            with self._lock:
+                previous = self._sockets.get(host)
+            self.remember(previous() if previous is not None else None)
+            with self._lock:
+                session = self._sessions.get(host)
+
+        start = time.perf_counter()
+        tls_socket = super().wrap_socket(
+            sock,
+            server_side,
+            do_handshake_on_connect,
+            suppress_ragged_eofs,
+            server_hostname,
+            session,
+        )
+        elapsed = time.perf_counter() - start
+
+        if host is not None and not server_side:
+            self.remember(tls_socket)
+            with self._lock:
+                self._sockets[host] = weakref.ref(tls_socket)
+                if do_handshake_on_connect:
+                    self.handshakes += 1
+                    self.resumed += bool(tls_socket.session_reused)
+                    self.seconds += elapsed
+        return tls_socket
+
+
+def create_tls_context(cafile: Optional[str] = None) -> ResumingTlsContext:
+    """
+    Returns a new client TLS context with the same settings as
+    `ssl.create_default_context`, trusting the given CA bundle, if any,
+    or the system's certificates otherwise
+    """
+
+    context = ResumingTlsContext(ssl.PROTOCOL_TLS_CLIENT)
+    if cafile is None:
+        context.load_default_certs()
+    else:
+        context.load_verify_locations(cafile)
+    return context
+
+
+DNS_CACHE: Final[DnsCache] = DnsCache()
+_TLS_CONTEXTS: dict[Optional[str], ResumingTlsContext] = {}
+_TLS_CONTEXTS_LOCK: Final[threading.Lock] = threading.Lock()
+
+
+def get_tls_context(cafile: Optional[str] = None) -> ResumingTlsContext:
+    """Returns the TLS context shared by every connection trusting `cafile`"""
+
+    with _TLS_CONTEXTS_LOCK:
+        if cafile not in _TLS_CONTEXTS:
+            _TLS_CONTEXTS[cafile] = create_tls_context(cafile)
+        return _TLS_CONTEXTS[cafile]
+
+
+def get_network_stats() -> NetworkStats:
+    """Returns the DNS lookups and TLS handshakes done so far in the process"""
+
+    with _TLS_CONTEXTS_LOCK:
+        contexts = list(_TLS_CONTEXTS.values())
+
+    return NetworkStats(
+        DNS_CACHE.lookups,
+        DNS_CACHE.hits,
+        DNS_CACHE.seconds,
+        sum(context.handshakes for context in contexts),
+        sum(context.resumed for context in contexts),
+        sum(context.seconds for context in contexts),
+    )
+
+
+class ResumingHttpAdapter(HTTPAdapter):
+    """
+    HTTP adapter whose HTTPS connections share a `ResumingTlsContext`,
+    trusting the same CA bundle as requests does by default
+    """
+
+    def init_poolmanager(self, *args: Any, **kwargs: Any) -> None:
+        kwargs.setdefault("ssl_context", get_tls_context(DEFAULT_CA_BUNDLE_PATH))
+        super().init_poolmanager(*args, **kwargs)
+
+
+def create_http_session() -> requests.Session:
+    """Returns a new HTTP session that resumes TLS sessions across connections"""
+
+    session = requests.Session()
+    session.mount("https://", ResumingHttpAdapter())
+    return session
+
+
+@contextmanager
+def report_network_stats(enabled: bool) -> Iterator[None]:
+    """
+    Prints how many DNS lookups and TLS handshakes were done, and the time
+    spent on them, once the code run within it is done, if asked to, even
+    if it exits the tool
+    """
+
+    try:
+        yield
+    finally:
+        if enabled:
+            print(f"Network: {get_network_stats().summary()}")
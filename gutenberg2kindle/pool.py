@@ -0,0 +1,353 @@
+"""
+Pool of SMTP sender profiles that spreads emails across several accounts,
+retrying transient failures and taking the profiles that keep failing or
+reach their limit out of rotation
+"""
+
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Final, Mapping, Optional, Union
+
+from gutenberg2kindle.config import (
+    SETTINGS_SMTP_PROFILES,
+    SETTINGS_SMTP_STRATEGY,
+    STRATEGY_LEAST_LOADED,
+    STRATEGY_ROUND_ROBIN,
+    Config,
+    get_config,
+    parse_smtp_profiles,
+)
+from gutenberg2kindle.email import (
+    DEFAULT_PROFILE_NAME,
+    SMTP_ERROR_AUTH,
+    SMTP_ERROR_REJECTED,
+    SmtpProfile,
+    SmtpSession,
+    classify_smtp_error,
+)
+
+LIMIT_REACHED: Final[str] = "limit reached"
+
+DEFAULT_SMTP_RETRIES: Final[int] = 3
+BACKOFF_IN_SECONDS: Final[float] = 1.0
+MAX_BACKOFF_IN_SECONDS: Final[float] = 30.0
+BREAKER_THRESHOLD: Final[int] = 3
+BREAKER_COOLDOWN_IN_SECONDS: Final[float] = 60.0
+
+Passwords = Union[str, Mapping[str, str]]
+
+
+@dataclass
+class CircuitBreaker:
+    """
+    Keeps a profile whose server looks down out of rotation for a while.
+    The breaker opens after `threshold` consecutive failures and, once
+    `cooldown` seconds have passed, lets emails through again: if the next
+    one fails too, it opens right away, and a success closes it
+    """
+
+    threshold: int = BREAKER_THRESHOLD
+    cooldown: float = BREAKER_COOLDOWN_IN_SECONDS
+    failures: int = 0
+    opened_at: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        """Whether emails are being kept away from the profile"""
+
+        return (
+            self.opened_at is not None
+            and time.monotonic() - self.opened_at < self.cooldown
+        )
+
+    def record_success(self) -> None:
+        """Closes the breaker"""
+
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self) -> None:
+        """Counts a failure, opening the breaker if needed"""
+
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+
+@dataclass
+class ProfileStats:
+    """Emails sent through a sender profile, and whether it's still in rotation"""
+
+    emails_sent: int = 0
+    bytes_sent: int = 0
+    failures: int = 0
+    retries: int = 0
+    disabled_reason: Optional[str] = None
+    breaker: CircuitBreaker = field(default_factory=CircuitBreaker)
+
+    @property
+    def active(self) -> bool:
+        """Whether the profile is still in rotation"""
+
+        return self.disabled_reason is None and not self.breaker.is_open
+
+
+def load_profiles(config: Optional[Config] = None) -> list[SmtpProfile]:
+    """Returns the sender profiles set in the config (or in `config`), if any"""
+
+    profiles = get_config(SETTINGS_SMTP_PROFILES, config)
+    assert isinstance(profiles, str)
+
+    if not profiles:
+        return []
+    return [SmtpProfile(**profile) for profile in parse_smtp_profiles(profiles)]
+
+
+def get_password(passwords: Passwords, profile_name: str) -> str:
+    """
+    Given a single password for every profile, or a mapping of profile
+    names to passwords, returns the password of a profile
+    """
+
+    if isinstance(passwords, str):
+        return passwords
+    return passwords[profile_name]
+
+
+def get_profile_name(session: SmtpSession) -> str:
+    """Returns the name of the profile a session belongs to"""
+
+    return session.profile.name if session.profile else DEFAULT_PROFILE_NAME
+
+
+def get_backoff(retry: int) -> float:
+    """Returns how many seconds to wait before the given retry of an email"""
+
+    return min(BACKOFF_IN_SECONDS * (1 << (retry - 1)), MAX_BACKOFF_IN_SECONDS)
+
+
+class SenderPool:
+    """
+    SMTP sessions to one or more sender profiles. Each email goes through
+    the profile picked by the strategy: weighted round-robin, or the least
+    loaded profile (the one with the fewest bytes sent for its weight).
+
+    Failures are handled depending on their kind:
+
+    - invalid credentials take the profile out of rotation for good, and
+      the email goes through the next profile right away
+    - transient failures and dropped connections are retried, with an
+      exponential backoff and on a fresh connection, up to `max_retries`
+      times. Profiles that keep failing are taken out of rotation for a
+      while by their circuit breaker
+    - emails rejected by the server are not retried
+
+    Profiles that reach their limit of emails are taken out of rotation too.
+
+    The pool can be shared by several threads: each thread sending at the
+    same time through the same profile gets a connection of its own.
+    """
+
+    def __init__(
+        self,
+        sessions: list[SmtpSession],
+        strategy: str = STRATEGY_ROUND_ROBIN,
+        max_retries: int = DEFAULT_SMTP_RETRIES,
+    ) -> None:
+        self.sessions = sessions
+        self.strategy = strategy
+        self.max_retries = max_retries
+        self.stats = {get_profile_name(session): ProfileStats() for session in sessions}
+        self._current_weights = {name: 0 for name in self.stats}
+        self._idle_sessions = {
+            get_profile_name(session): [session] for session in sessions
+        }
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(
+        cls, passwords: Passwords, config: Optional[Config] = None
+    ) -> "SenderPool":
+        """
+        Creates a pool with the sender profiles set in the config or, if
+        there are none, with the regular SMTP settings as its only profile.
+        If `config` is given (see `resolve_config`), it's read instead of
+        the stored settings, by the pool and by each of its sessions.
+        """
+
+        strategy = get_config(SETTINGS_SMTP_STRATEGY, config)
+        assert isinstance(strategy, str)
+
+        sessions = [
+            SmtpSession(get_password(passwords, profile.name), profile, config)
+            for profile in load_profiles(config)
+        ]
+        if not sessions:
+            sessions = [
+                SmtpSession(get_password(passwords, DEFAULT_PROFILE_NAME), None, config)
+            ]
+
+        return cls(sessions, strategy)
+
+    def close(self) -> None:
+        """Closes the connections of every profile"""
+
+        with self._lock:
+            for idle_sessions in self._idle_sessions.values():
+                for session in idle_sessions:
+                    session.close()
+
+    def reactivate(self) -> None:
+        """
+        Puts the profiles taken out of rotation by their circuit breaker
+        back in rotation, keeping out the ones with invalid credentials
+        or that reached their limit
+        """
+
+        with self._lock:
+            for stats in self.stats.values():
+                stats.breaker.record_success()
+
+    @staticmethod
+    def _weight(session: SmtpSession) -> int:
+        return session.profile.weight if session.profile else 1
+
+    def select(self) -> Optional[SmtpSession]:
+        """
+        Returns the session of the next profile in rotation, if any is left.
+        Not thread-safe on its own, see `send`
+        """
+
+        active = self._active_sessions()
+        if not active:
+            return None
+
+        if self.strategy == STRATEGY_LEAST_LOADED:
+            return min(
+                active,
+                key=lambda session: self.stats[get_profile_name(session)].bytes_sent
+                / self._weight(session),
+            )
+
+        # smooth weighted round-robin, which interleaves heavier profiles
+        # with lighter ones instead of sending bursts through each
+        for session in active:
+            self._current_weights[get_profile_name(session)] += self._weight(session)
+        selected = max(
+            active, key=lambda session: self._current_weights[get_profile_name(session)]
+        )
+        self._current_weights[get_profile_name(selected)] -= sum(
+            self._weight(session) for session in active
+        )
+        return selected
+
+    def active_sessions(self) -> list[SmtpSession]:
+        """Returns the sessions of the profiles in rotation"""
+
+        with self._lock:
+            return self._active_sessions()
+
+    def _active_sessions(self) -> list[SmtpSession]:
+        return [
+            session
+            for session in self.sessions
+            if self.stats[get_profile_name(session)].active
+        ]
+
+    def connect(self, session: SmtpSession) -> None:
+        """
+        Opens the connection of one of the pool's idle sessions ahead of its
+        next email, unless it's already open and alive (see
+        `SmtpSession.ensure_connected`). If it fails, the failure counts
+        against its profile as if an email had failed, and the error is raised
+        """
+
+        try:
+            session.ensure_connected()
+        except OSError as err:
+            with self._lock:
+                self._record_failure(self.stats[get_profile_name(session)], err)
+            raise
+
+    def _any_active(self) -> bool:
+        with self._lock:
+            return any(stats.active for stats in self.stats.values())
+
+    def _acquire(self) -> Optional[SmtpSession]:
+        with self._lock:
+            selected = self.select()
+            if selected is None:
+                return None
+
+            idle_sessions = self._idle_sessions[get_profile_name(selected)]
+            if idle_sessions:
+                return idle_sessions.pop()
+            return SmtpSession(selected.password, selected.profile, selected.config)
+
+    @staticmethod
+    def _record_failure(stats: ProfileStats, error: OSError) -> None:
+        stats.failures += 1
+        kind = classify_smtp_error(error)
+        if kind == SMTP_ERROR_AUTH:
+            stats.disabled_reason = str(error) or type(error).__name__
+        elif kind != SMTP_ERROR_REJECTED:
+            stats.breaker.record_failure()
+
+    def _release(
+        self,
+        session: SmtpSession,
+        sent: bool,
+        size_in_bytes: int,
+        error: Optional[OSError] = None,
+    ) -> None:
+        with self._lock:
+            stats = self.stats[get_profile_name(session)]
+            self._idle_sessions[get_profile_name(session)].append(session)
+
+            if error is not None:
+                self._record_failure(stats, error)
+                return
+
+            stats.breaker.record_success()
+            if sent:
+                stats.emails_sent += 1
+                stats.bytes_sent += size_in_bytes
+                limit = session.profile.limit if session.profile else None
+                if limit is not None and stats.emails_sent >= limit:
+                    stats.disabled_reason = LIMIT_REACHED
+
+    def send(self, send: Callable[[SmtpSession], bool], size_in_bytes: int) -> bool:
+        """
+        Sends an email with `send` through the next profile in rotation,
+        retrying it as described above, and returns whether the email was
+        sent. If it can't be sent, the last error is raised.
+        """
+
+        error: OSError = OSError("No SMTP profile is left in rotation")
+        retries = 0
+        while (session := self._acquire()) is not None:
+            try:
+                sent = send(session)
+            except OSError as err:
+                # whatever happened, the next attempt gets a fresh connection
+                session.close()
+                self._release(session, False, 0, err)
+                error = err
+
+                kind = classify_smtp_error(err)
+                if kind == SMTP_ERROR_REJECTED:
+                    raise
+                if kind != SMTP_ERROR_AUTH:
+                    if retries >= self.max_retries or not self._any_active():
+                        raise
+                    retries += 1
+                    with self._lock:
+                        self.stats[get_profile_name(session)].retries += 1
+                    time.sleep(get_backoff(retries))
+                continue
+
+            self._release(session, sent, size_in_bytes)
+            return sent
+
+        raise error
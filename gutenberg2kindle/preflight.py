@@ -0,0 +1,104 @@
+"""
+Checks that Project Gutenberg and the SMTP server can be reached, and that
+the SMTP credentials are valid, before any book is transferred
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Final, Optional
+
+import requests
+
+from gutenberg2kindle.email import SmtpSession, classify_smtp_error
+from gutenberg2kindle.gutenberg import REQUESTS_TIMEOUT
+from gutenberg2kindle.pool import SenderPool, get_profile_name
+
+CHECK_GUTENBERG: Final[str] = "gutenberg"
+CHECK_SMTP: Final[str] = "smtp"
+
+GUTENBERG_URL: Final[str] = "https://www.gutenberg.org/"
+
+
+@dataclass
+class CheckResult:
+    """
+    Outcome of a check, and how long it took. `smtp_error` is the kind of
+    SMTP error that made an SMTP check fail, see `classify_smtp_error`, and
+    `error_type` the type of the error that made any check fail
+    """
+
+    target: str
+    seconds: float
+    profile: Optional[str] = None
+    error: Optional[str] = None
+    smtp_error: Optional[str] = None
+    error_type: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        """Whether the check passed"""
+
+        return self.error is None
+
+
+def check_gutenberg(http_session: requests.Session) -> CheckResult:
+    """Checks that Project Gutenberg can be reached"""
+
+    start = time.perf_counter()
+    try:
+        response = http_session.head(GUTENBERG_URL, timeout=REQUESTS_TIMEOUT)
+        response.raise_for_status()
+    except requests.RequestException as err:
+        return CheckResult(
+            CHECK_GUTENBERG,
+            time.perf_counter() - start,
+            error=str(err),
+            error_type=type(err).__name__,
+        )
+
+    return CheckResult(CHECK_GUTENBERG, time.perf_counter() - start)
+
+
+def check_smtp(smtp_pool: SenderPool, session: SmtpSession) -> CheckResult:
+    """
+    Opens and authenticates the connection of a sender profile, which is
+    kept open for its first email
+    """
+
+    profile = get_profile_name(session)
+    start = time.perf_counter()
+    try:
+        smtp_pool.connect(session)
+    except OSError as err:
+        return CheckResult(
+            CHECK_SMTP,
+            time.perf_counter() - start,
+            profile,
+            str(err) or type(err).__name__,
+            classify_smtp_error(err),
+            type(err).__name__,
+        )
+
+    return CheckResult(CHECK_SMTP, time.perf_counter() - start, profile)
+
+
+def run_checks(
+    smtp_pool: Optional[SenderPool], http_session: Optional[requests.Session]
+) -> list[CheckResult]:
+    """
+    Checks Project Gutenberg, unless no HTTP session is given, and every
+    sender profile in rotation, unless no pool is given, all at the same
+    time. Returns the result of each check, Project Gutenberg's first
+    """
+
+    sessions = [] if smtp_pool is None else smtp_pool.active_sessions()
+    with ThreadPoolExecutor(max_workers=len(sessions) + 1) as executor:
+        checks = []
+        if http_session is not None:
+            checks.append(executor.submit(check_gutenberg, http_session))
+        if smtp_pool is not None:
+            checks += [
+                executor.submit(check_smtp, smtp_pool, session) for session in sessions
+            ]
+        return [check.result() for check in checks]
@@ -0,0 +1,123 @@
+"""
+Optional CPU and memory profiling of a run of the tool, written to files
+in standard formats so that they can be inspected with the usual tools
+"""
+
+import cProfile
+import pstats
+import threading
+import tracemalloc
+from contextlib import ExitStack, contextmanager
+from typing import Callable, Final, Iterator, Optional
+
+from gutenberg2kindle.email import bytes_to_mb
+
+TRACE_MEMORY_FRAMES: Final[int] = 10
+TRACE_MEMORY_TOP: Final[int] = 25
+
+
+def write_memory_report(
+    snapshot: tracemalloc.Snapshot, peak: int, path: str, top: int = TRACE_MEMORY_TOP
+) -> None:
+    """
+    Writes the peak of traced memory and the `top` lines of code that had
+    the most memory allocated at the end of the run to a text file
+    """
+
+    with open(path, "w", encoding="utf-8") as report:
+        report.write(f"Peak traced memory: {bytes_to_mb(peak)} MB ({peak} bytes)\n")
+        report.write(f"Top {top} lines by allocated memory:\n")
+        for stat in snapshot.statistics("lineno")[:top]:
+            report.write(f"{stat}\n")
+
+
+@contextmanager
+def profile_threads() -> Iterator[list[cProfile.Profile]]:
+    """
+    Profiles every thread started within it, each with a profiler of its
+    own as cProfile only profiles the thread it's enabled in, and yields
+    the profiles of the threads as they finish
+    """
+
+    profiles: list[cProfile.Profile] = []
+    lock = threading.Lock()
+    original_run: Callable[[threading.Thread], None] = threading.Thread.run
+
+    def run(thread: threading.Thread) -> None:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # another profiler already covers every thread (Python 3.12+)
+            original_run(thread)
+            return
+
+        try:
+            original_run(thread)
+        finally:
+            profiler.disable()
+            with lock:
+                profiles.append(profiler)
+
+    threading.Thread.run = run  # type: ignore[method-assign, assignment]
+    try:
+        yield profiles
+    finally:
+        threading.Thread.run = original_run  # type: ignore[method-assign, assignment]
+
+
+def write_cpu_profile(
+    profiler: cProfile.Profile, thread_profiles: list[cProfile.Profile], path: str
+) -> None:
+    """Merges the profile of the calling thread with those of other threads"""
+
+    stats = pstats.Stats(profiler)
+    if thread_profiles:
+        stats.add(*thread_profiles)
+    stats.dump_stats(path)
+
+
+@contextmanager
+def profile_run(
+    cpu_path: Optional[str] = None, memory_path: Optional[str] = None
+) -> Iterator[None]:
+    """
+    Profiles the code run within it, if asked to, and writes the results
+    once it's done, even if it exits the tool:
+
+    - `cpu_path`: CPU profile, in pstats format (see `python -m pstats`),
+      of the calling thread merged with those of the threads started
+      within it and finished by the end of the run, such as the ones
+      downloading, verifying and sending books. Books compacted in other
+      processes are not covered
+    - `memory_path`: memory peak and top allocations of every thread,
+      traced with tracemalloc, as text
+
+    Nothing is set up unless a path is given, so it costs nothing otherwise.
+    """
+
+    profiler = cProfile.Profile() if cpu_path else None
+    if memory_path:
+        tracemalloc.start(TRACE_MEMORY_FRAMES)
+
+    with ExitStack() as stack:
+        thread_profiles = []
+        if profiler is not None:
+            thread_profiles = stack.enter_context(profile_threads())
+            profiler.enable()
+
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                assert cpu_path is not None
+                profiler.disable()
+                write_cpu_profile(profiler, list(thread_profiles), cpu_path)
+                print(f"CPU profile written to {cpu_path}")
+
+            if memory_path:
+                snapshot = tracemalloc.take_snapshot()
+                _, peak = tracemalloc.get_traced_memory()
+                tracemalloc.stop()
+                write_memory_report(snapshot, peak, memory_path)
+                print(f"Memory report written to {memory_path}")
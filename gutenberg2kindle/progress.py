@@ -0,0 +1,188 @@
+"""
+Live progress line for long batches of books, with the bytes transferred,
+the current throughput and an estimate of the time left
+"""
+
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Final, Iterator, Optional, TextIO
+
+from gutenberg2kindle.budget import BYTES_PER_MB
+
+PROGRESS_INTERVAL_IN_SECONDS: Final[float] = 0.5
+CLEAR_LINE: Final[str] = "\r\033[K"
+
+
+def format_duration(seconds: float) -> str:
+    """Formats a duration as e.g. `1h 02m`, `3m 05s` or `12s`"""
+
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours}h {minutes:02d}m"
+    if minutes:
+        return f"{minutes}m {seconds:02d}s"
+    return f"{seconds}s"
+
+
+class ProgressReporter:  # pylint: disable=too-many-instance-attributes
+    """
+    Thread-safe counters of a batch of books, shown as a single line that
+    is redrawn in place. Counters are updated as books are downloaded and
+    sent, chunk by chunk, but the line is only redrawn every `interval`
+    seconds, so that updates stay cheap.
+
+    Nothing is ever drawn unless the stream is a terminal, so that logs
+    and piped output are left untouched. `total_books` is used for the
+    estimate of the time left, which is not shown if unknown.
+    """
+
+    def __init__(
+        self,
+        total_books: Optional[int] = None,
+        stream: Optional[TextIO] = None,
+        interval: float = PROGRESS_INTERVAL_IN_SECONDS,
+        clock: Callable[[], float] = time.monotonic,
+    ) -> None:
+        self.total_books = total_books
+        self.stream = stream if stream is not None else sys.stderr
+        self.enabled = self.stream.isatty()
+        self.interval = interval
+        self.clock = clock
+
+        self.downloaded_bytes = 0
+        self.sent_bytes = 0
+        self.started_books = 0
+        self.done_books = 0
+
+        self._lock = threading.RLock()
+        self._start = self._last_drawn_at = clock()
+        self._last_drawn_bytes = 0
+        self._rate = 0.0
+        self._drawn = False
+
+    def __enter__(self) -> "ProgressReporter":
+        return self
+
+    def __exit__(self, *_: object) -> None:
+        self.close()
+
+    @property
+    def in_flight(self) -> int:
+        """Amount of books started but not done yet"""
+
+        # books skipped once a batch is stopped are done without starting
+        return max(self.started_books - self.done_books, 0)
+
+    def book_started(self) -> None:
+        """Counts a book that started being downloaded"""
+
+        if self.enabled:
+            with self._lock:
+                self.started_books += 1
+                self._maybe_draw()
+
+    def book_done(self) -> None:
+        """Counts a book whose outcome is known"""
+
+        if self.enabled:
+            with self._lock:
+                self.done_books += 1
+                self._maybe_draw()
+
+    def add_downloaded(self, amount: int) -> None:
+        """Counts a chunk of bytes downloaded"""
+
+        if self.enabled:
+            with self._lock:
+                self.downloaded_bytes += amount
+                self._maybe_draw()
+
+    def add_sent(self, amount: int) -> None:
+        """Counts a chunk of bytes sent"""
+
+        if self.enabled:
+            with self._lock:
+                self.sent_bytes += amount
+                self._maybe_draw()
+
+    def render(self) -> str:
+        """Returns the progress line, as it is right now"""
+
+        with self._lock:
+            books = f"{self.done_books}"
+            if self.total_books is not None:
+                books += f"/{self.total_books}"
+
+            line = (
+                f"{books} books done, {self.in_flight} in flight | "
+                f"{self.downloaded_bytes / BYTES_PER_MB:.1f} MB downloaded, "
+                f"{self.sent_bytes / BYTES_PER_MB:.1f} MB sent | "
+                f"{self._rate / BYTES_PER_MB:.1f} MB/s"
+            )
+
+            eta = self._eta()
+            if eta is not None:
+                line += f" | ETA {format_duration(eta)}"
+            return line
+
+    def _eta(self) -> Optional[float]:
+        if self.total_books is None or not self.done_books:
+            return None
+
+        seconds_per_book = (self._last_drawn_at - self._start) / self.done_books
+        return max(self.total_books - self.done_books, 0) * seconds_per_book
+
+    def _maybe_draw(self) -> None:
+        now = self.clock()
+        if now - self._last_drawn_at >= self.interval:
+            self._draw(now)
+
+    def _draw(self, now: float) -> None:
+        transferred = self.downloaded_bytes + self.sent_bytes
+        elapsed = now - self._last_drawn_at
+        if elapsed > 0:
+            self._rate = (transferred - self._last_drawn_bytes) / elapsed
+        self._last_drawn_at, self._last_drawn_bytes = now, transferred
+        self._write()
+
+    def _write(self) -> None:
+        self.stream.write(CLEAR_LINE + self.render())
+        self.stream.flush()
+        self._drawn = True
+
+    def _clear(self) -> None:
+        if self._drawn:
+            self.stream.write(CLEAR_LINE)
+            self.stream.flush()
+            self._drawn = False
+
+    @contextmanager
+    def paused(self) -> Iterator[None]:
+        """
+        Clears the progress line while other output is printed, drawing it
+        again afterwards, so that both don't get mixed up
+        """
+
+        if not self.enabled:
+            yield
+            return
+
+        with self._lock:
+            was_drawn = self._drawn
+            self._clear()
+            try:
+                yield
+            finally:
+                if was_drawn:
+                    self._write()
+
+    def close(self) -> None:
+        """Clears the progress line for good"""
+
+        if self.enabled:
+            with self._lock:
+                self._clear()
+                self.enabled = False
@@ -0,0 +1,220 @@
+"""
+Machine-readable reports of a run, with one row per book and the totals
+of the whole run, so that other tools don't need to parse the output
+"""
+
+import csv
+import io
+import json
+import os
+from dataclasses import asdict, dataclass, fields
+from typing import Final, Iterable, Optional
+
+from gutenberg2kindle.api import (
+    STATUS_ALREADY_SENT,
+    STATUS_DUPLICATE,
+    STATUS_SENT,
+    STATUS_SPOOLED,
+    BookResult,
+)
+from gutenberg2kindle.budget import BYTES_PER_MB
+from gutenberg2kindle.cache import write_atomically
+
+REPORT_FORMAT_JSON: Final[str] = "json"
+REPORT_FORMAT_CSV: Final[str] = "csv"
+VALID_REPORT_FORMATS: Final[tuple[str, ...]] = (REPORT_FORMAT_JSON, REPORT_FORMAT_CSV)
+
+# fields of each book's row, in order
+REPORT_FIELDS: Final[tuple[str, ...]] = (
+    "book_id",
+    "status",
+    "book_format",
+    "url",
+    "size_in_bytes",
+    "download_seconds",
+    "send_seconds",
+    "volumes",
+    "duplicate_of",
+    "error_type",
+    "error",
+    "recipient",
+    "digest",
+)
+
+# books that need nothing else done, as they were sent before or just now
+SUCCESSFUL_STATUSES: Final[tuple[str, ...]] = (
+    STATUS_SENT,
+    STATUS_SPOOLED,
+    STATUS_DUPLICATE,
+    STATUS_ALREADY_SENT,
+)
+
+OUTCOME_SUCCESS: Final[str] = "success"
+OUTCOME_PARTIAL_SUCCESS: Final[str] = "partial_success"
+OUTCOME_FAILURE: Final[str] = "failure"
+
+# 2 is left out, as it's the exit code of invalid arguments
+EXIT_CODES: Final[dict[str, int]] = {
+    OUTCOME_SUCCESS: 0,
+    OUTCOME_FAILURE: 1,
+    OUTCOME_PARTIAL_SUCCESS: 3,
+}
+
+
+@dataclass
+class RunSummary:  # pylint: disable=too-many-instance-attributes
+    """
+    Totals of a run: how many books succeeded or failed, the bytes sent
+    (or spooled), the time spent downloading and sending them and, if the
+    run was timed, its throughput in MB of books sent per second
+    """
+
+    outcome: str
+    total_books: int
+    successful_books: int
+    failed_books: int
+    sent_bytes: int
+    download_seconds: float
+    send_seconds: float
+    elapsed_seconds: Optional[float] = None
+    throughput_mb_per_second: Optional[float] = None
+
+    @property
+    def exit_code(self) -> int:
+        """
+        Exit code of the tool for this run: 0 if every book succeeded (or
+        there were none), 1 if none did and 3 if only some did
+        """
+
+        return EXIT_CODES[self.outcome]
+
+
+# fields of the totals of a run, in order
+SUMMARY_FIELDS: Final[tuple[str, ...]] = tuple(
+    summary_field.name for summary_field in fields(RunSummary)
+)
+
+
+def get_outcome(successful_books: int, failed_books: int) -> str:
+    """Returns whether a run was a success, a partial success or a failure"""
+
+    if not failed_books:
+        return OUTCOME_SUCCESS
+    if successful_books:
+        return OUTCOME_PARTIAL_SUCCESS
+    return OUTCOME_FAILURE
+
+
+def summarize_run(
+    results: Iterable[BookResult], elapsed_seconds: Optional[float] = None
+) -> RunSummary:
+    """Returns the totals of a run, given the result of every book in it"""
+
+    results = list(results)
+    successful = [result for result in results if result.status in SUCCESSFUL_STATUSES]
+    failed_books = len(results) - len(successful)
+    sent_bytes = sum(
+        result.size_in_bytes
+        for result in successful
+        if result.status in (STATUS_SENT, STATUS_SPOOLED)
+    )
+
+    throughput = None
+    if elapsed_seconds:
+        throughput = round(sent_bytes / BYTES_PER_MB / elapsed_seconds, 3)
+
+    return RunSummary(
+        get_outcome(len(successful), failed_books),
+        len(results),
+        len(successful),
+        failed_books,
+        sent_bytes,
+        sum(result.download_seconds for result in results),
+        sum(result.send_seconds for result in results),
+        elapsed_seconds,
+        throughput,
+    )
+
+
+def format_json_report(summary: RunSummary, results: list[BookResult]) -> str:
+    """Returns a report as a JSON object, with the totals and the books"""
+
+    books = [
+        {name: getattr(result, name) for name in REPORT_FIELDS} for result in results
+    ]
+    return json.dumps({"summary": asdict(summary), "books": books}, indent=2) + "\n"
+
+
+def read_json_report(path: str) -> list[BookResult]:
+    """
+    Returns the books of a JSON report, e.g. one written by each shard of
+    a job, raising a ValueError if it isn't a report
+    """
+
+    try:
+        with open(path, encoding="utf-8") as report_file:
+            books = json.load(report_file)["books"]
+        return [BookResult(**book) for book in books]
+    except (ValueError, KeyError, TypeError) as err:
+        raise ValueError(f"{path} is not a JSON report: {err}") from err
+
+
+def merge_results(*results: Iterable[BookResult]) -> list[BookResult]:
+    """
+    Merges the results of several runs, e.g. of every shard of a job, into
+    one result per book, sorted by book ID. When a book was handled in
+    several runs, the result of the last one given is kept
+    """
+
+    merged = {result.book_id: result for run in results for result in run}
+    return sorted(merged.values(), key=lambda result: result.book_id)
+
+
+def format_csv(names: Iterable[str], rows: Iterable[dict[str, object]]) -> str:
+    """Returns the given rows as CSV, with the given field names as its header"""
+
+    content = io.StringIO()
+    writer = csv.DictWriter(content, list(names), extrasaction="ignore")
+    writer.writeheader()
+    writer.writerows(rows)
+    return content.getvalue()
+
+
+def get_summary_path(path: str) -> str:
+    """
+    Returns the path of the file with the totals of a CSV report, next to
+    it, e.g. `report.summary.csv` for `report.csv`
+    """
+
+    root, extension = os.path.splitext(path)
+    return f"{root}.summary{extension or '.csv'}"
+
+
+def write_report(
+    path: str,
+    report_format: str,
+    results: list[BookResult],
+    elapsed_seconds: Optional[float] = None,
+) -> RunSummary:
+    """
+    Writes the report of a run, atomically so that readers never see it
+    half-written, and returns the run's totals. JSON reports hold both the
+    totals and the books. CSV reports hold one row per book, and the totals
+    are written as a single row to a file of their own (see
+    `get_summary_path`), so that both are plain tables any CSV reader takes.
+    """
+
+    if report_format not in VALID_REPORT_FORMATS:
+        raise ValueError(f"{report_format} is an invalid report format")
+
+    summary = summarize_run(results, elapsed_seconds)
+    if report_format == REPORT_FORMAT_JSON:
+        write_atomically(path, format_json_report(summary, results).encode())
+        return summary
+
+    write_atomically(
+        get_summary_path(path),
+        format_csv(SUMMARY_FIELDS, [asdict(summary)]).encode(),
+    )
+    write_atomically(path, format_csv(REPORT_FIELDS, map(asdict, results)).encode())
+    return summary
@@ -0,0 +1,61 @@
+"""
+Policies that decide in which order the books of a batch are sent,
+depending on their size and on the priorities given by the user
+"""
+
+from typing import Final, Iterable, Mapping, Optional
+
+SCHEDULE_INPUT: Final[str] = "input"
+SCHEDULE_SMALLEST_FIRST: Final[str] = "smallest_first"
+SCHEDULE_LARGEST_FIRST: Final[str] = "largest_first"
+VALID_SCHEDULES: Final[list[str]] = [
+    SCHEDULE_INPUT,
+    SCHEDULE_SMALLEST_FIRST,
+    SCHEDULE_LARGEST_FIRST,
+]
+
+
+def parse_priority(value: str) -> tuple[int, int]:
+    """
+    Parses the priority of a book given as `BOOK_ID:PRIORITY`, e.g. `1234:5`,
+    and returns the book ID and its priority
+    """
+
+    book_id, _, priority = value.partition(":")
+    try:
+        return int(book_id), int(priority)
+    except ValueError as err:
+        raise ValueError(f"{value} is not a book priority, e.g. 1234:5") from err
+
+
+def schedule_books(
+    book_ids: Iterable[int],
+    policy: str,
+    sizes: Optional[Mapping[int, Optional[int]]] = None,
+    priorities: Optional[Mapping[int, int]] = None,
+) -> list[int]:
+    """
+    Returns the given books in the order they should be sent:
+
+    - `input`: in the given order
+    - `smallest_first`: smallest books first, which gets most books
+      delivered soonest
+    - `largest_first`: largest books first, which packs batches best
+
+    Books with a higher priority go first among books of the same size
+    (or, with `input`, among all books), and books whose size is unknown
+    go last. Books that tie keep their order.
+    """
+
+    if policy not in VALID_SCHEDULES:
+        raise ValueError(f"{policy} is an invalid schedule")
+
+    sizes = sizes or {}
+    priorities = priorities or {}
+    sign = -1 if policy == SCHEDULE_LARGEST_FIRST else 1
+
+    def _key(book_id: int) -> tuple[bool, int, int]:
+        size = sizes.get(book_id) if policy != SCHEDULE_INPUT else 0
+        return size is None, sign * (size or 0), -priorities.get(book_id, 0)
+
+    return sorted(book_ids, key=_key)
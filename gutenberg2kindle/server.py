@@ -0,0 +1,271 @@
+"""
+Long-running server that keeps warm connections to Project Gutenberg and
+to the SMTP server, and accepts send jobs over a local HTTP API
+"""
+
+import itertools
+import json
+import os
+import queue
+import re
+import socketserver
+import threading
+from dataclasses import asdict, dataclass, field
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, ClassVar, Final, Optional
+
+from gutenberg2kindle.api import BookResult, BookSender, SendOptions
+from gutenberg2kindle.pool import Passwords
+
+DEFAULT_HOST: Final[str] = "127.0.0.1"
+DEFAULT_PORT: Final[int] = 8465
+
+JOB_QUEUED: Final[str] = "queued"
+JOB_RUNNING: Final[str] = "running"
+JOB_DONE: Final[str] = "done"
+JOB_FAILED: Final[str] = "failed"
+
+MAX_FINISHED_JOBS: Final[int] = 100
+
+JOB_PATH_PATTERN: Final[re.Pattern[str]] = re.compile(r"^/jobs/(\d+)$")
+
+
+@dataclass
+class Job:
+    """A batch of books to send, submitted to the server"""
+
+    job_id: int
+    book_ids: list[int]
+    status: str = JOB_QUEUED
+    results: list[BookResult] = field(default_factory=list)
+    error: Optional[str] = None
+
+
+class BookServer:
+    """
+    Queue of send jobs processed one at a time by a background worker,
+    which reuses the same book sender (and so the same HTTP session,
+    SMTP connection and book cache) across jobs. Only the latest
+    `max_finished_jobs` finished jobs are kept, older ones are forgotten
+    """
+
+    def __init__(
+        self,
+        password: Passwords,
+        options: Optional[SendOptions] = None,
+        max_finished_jobs: int = MAX_FINISHED_JOBS,
+    ) -> None:
+        self.sender = BookSender(password, options=options)
+        self.max_finished_jobs = max_finished_jobs
+
+        self._jobs: dict[int, Job] = {}
+        self._job_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._queue: queue.Queue[Optional[Job]] = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+
+    def start(self) -> None:
+        """Starts processing queued jobs in the background"""
+
+        self._worker.start()
+
+    def stop(self) -> None:
+        """
+        Waits for the jobs already queued to finish and closes
+        the server's connections
+        """
+
+        self._queue.put(None)
+        if self._worker.is_alive():
+            self._worker.join()
+        self.sender.close()
+
+    def submit(self, book_ids: list[int]) -> Job:
+        """Queues a new job to send the given books"""
+
+        with self._lock:
+            job = Job(job_id=next(self._job_ids), book_ids=list(book_ids))
+            self._jobs[job.job_id] = job
+        self._queue.put(job)
+        return job
+
+    def get_job(self, job_id: int) -> Optional[Job]:
+        """Returns a job by its ID, if it exists"""
+
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def list_jobs(self) -> list[Job]:
+        """Returns all jobs submitted so far"""
+
+        with self._lock:
+            return list(self._jobs.values())
+
+    def delete_job(self, job_id: int) -> Optional[Job]:
+        """
+        Forgets a finished job, returning it, or `None` if it doesn't exist.
+        Raises a `ValueError` if the job is still queued or running
+        """
+
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job.status not in (JOB_DONE, JOB_FAILED):
+                raise ValueError(f"Job {job_id} hasn't finished yet")
+
+            del self._jobs[job_id]
+            return job
+
+    def _finish(self, job: Job, status: str) -> None:
+        with self._lock:
+            job.status = status
+            # jobs are kept in the order they were submitted, which is also
+            # the order they finish in, so the oldest finished ones come first
+            finished_ids = [
+                finished.job_id
+                for finished in self._jobs.values()
+                if finished.status in (JOB_DONE, JOB_FAILED)
+            ]
+            for job_id in finished_ids[: -self.max_finished_jobs or None]:
+                del self._jobs[job_id]
+
+    def _run(self) -> None:
+        while (job := self._queue.get()) is not None:
+            self.process(job)
+
+    def process(self, job: Job) -> None:
+        """
+        Downloads and sends every book of a job, recording each outcome.
+        If the job fails unexpectedly (e.g. the cache can't be written), it's
+        marked as failed with the error, and the books it didn't reach are
+        recorded as skipped, so that the worker goes on with the next job
+        """
+
+        job.status = JOB_RUNNING
+        try:
+            for result in self.sender.iter_send(job.book_ids):
+                job.results.append(result)
+        except Exception as err:  # pylint: disable=broad-exception-caught
+            reached_ids = {result.book_id for result in job.results}
+            job.results += [
+                BookResult(book_id)
+                for book_id in job.book_ids
+                if book_id not in reached_ids
+            ]
+            job.error = f"{type(err).__name__}: {err}"
+            self._finish(job, JOB_FAILED)
+            return
+
+        self._finish(job, JOB_DONE)
+
+
+class JobRequestHandler(BaseHTTPRequestHandler):
+    """
+    Handler for the server's HTTP API:
+
+    - `POST /jobs` with a `{"book_ids": [...]}` body queues a new job
+    - `GET /jobs` lists all jobs
+    - `GET /jobs/<job id>` returns the status of a job, book by book
+    - `DELETE /jobs/<job id>` forgets a finished job
+    """
+
+    book_server: ClassVar[BookServer]
+
+    def address_string(self) -> str:
+        # Unix socket clients have no address
+        if isinstance(self.client_address, tuple):
+            return super().address_string()
+        return "local"
+
+    def _reply(self, status: HTTPStatus, payload: Any) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        """Returns the status of one or all jobs"""
+
+        if self.path == "/jobs":
+            self._reply(
+                HTTPStatus.OK, [asdict(job) for job in self.book_server.list_jobs()]
+            )
+            return
+
+        match = JOB_PATH_PATTERN.match(self.path)
+        job = self.book_server.get_job(int(match.group(1))) if match else None
+        if job is None:
+            self._reply(HTTPStatus.NOT_FOUND, {"error": "Job not found"})
+            return
+
+        self._reply(HTTPStatus.OK, asdict(job))
+
+    def do_POST(self) -> None:  # pylint: disable=invalid-name
+        """Queues a new job"""
+
+        if self.path != "/jobs":
+            self._reply(HTTPStatus.NOT_FOUND, {"error": "Not found"})
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            book_ids = json.loads(self.rfile.read(length))["book_ids"]
+            if not book_ids or not all(
+                isinstance(book_id, int) for book_id in book_ids
+            ):
+                raise ValueError("`book_ids` must be a non-empty list of integers")
+        except (KeyError, TypeError, ValueError) as err:
+            self._reply(HTTPStatus.BAD_REQUEST, {"error": str(err)})
+            return
+
+        job = self.book_server.submit(book_ids)
+        self._reply(HTTPStatus.ACCEPTED, asdict(job))
+
+    def do_DELETE(self) -> None:  # pylint: disable=invalid-name
+        """Forgets a finished job"""
+
+        match = JOB_PATH_PATTERN.match(self.path)
+        try:
+            job = self.book_server.delete_job(int(match.group(1))) if match else None
+        except ValueError as err:
+            self._reply(HTTPStatus.CONFLICT, {"error": str(err)})
+            return
+
+        if job is None:
+            self._reply(HTTPStatus.NOT_FOUND, {"error": "Job not found"})
+            return
+
+        self._reply(HTTPStatus.OK, asdict(job))
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP server listening on a Unix socket, handling each request in a thread"""
+
+    daemon_threads = True
+
+
+def create_http_server(
+    book_server: BookServer,
+    host: str = DEFAULT_HOST,
+    port: int = DEFAULT_PORT,
+    socket_path: Optional[str] = None,
+) -> socketserver.BaseServer:
+    """
+    Creates the HTTP server for the API of the given book server, listening
+    on a Unix socket if a path is given, or on the given host and port otherwise
+    """
+
+    handler = type(
+        "BoundJobRequestHandler", (JobRequestHandler,), {"book_server": book_server}
+    )
+
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        return UnixHTTPServer(socket_path, handler)
+
+    return ThreadingHTTPServer((host, port), handler)
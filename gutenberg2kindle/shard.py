@@ -0,0 +1,283 @@
+"""
+Helpers to split huge batches of books across several processes or hosts,
+either with a fixed partition of the book IDs or by claiming books from a
+directory shared by every process
+"""
+
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict
+from typing import Final, Iterable, Iterator, Optional
+
+from gutenberg2kindle.api import BookResult
+from gutenberg2kindle.cache import write_atomically
+
+CLAIMS_DIRNAME: Final[str] = "claims"
+RESULTS_DIRNAME: Final[str] = "results"
+CLAIM_HEARTBEAT_IN_SECONDS: Final[float] = 30.0
+STALE_CLAIM_IN_SECONDS: Final[float] = 5 * 60.0
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    """
+    Parses a shard given as `INDEX/COUNT`, e.g. `0/4` for the first of
+    four shards, and returns its index and the amount of shards
+    """
+
+    index, _, count = value.partition("/")
+    try:
+        shard = int(index), int(count)
+    except ValueError as err:
+        raise ValueError(f"{value} is not a shard, e.g. 0/4") from err
+
+    if not 0 <= shard[0] < shard[1]:
+        raise ValueError(f"{value} is not a shard, its index must be under {count}")
+    return shard
+
+
+def get_shard(book_id: int, count: int) -> int:
+    """
+    Returns the shard a book belongs to. It only depends on the book ID,
+    so every process agrees on it regardless of the order of the books
+    """
+
+    digest = hashlib.blake2b(str(book_id).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % count
+
+
+def shard_book_ids(book_ids: Iterable[int], index: int, count: int) -> Iterator[int]:
+    """Yields the given books that belong to a shard, in order"""
+
+    return (book_id for book_id in book_ids if get_shard(book_id, count) == index)
+
+
+def is_owner_gone(owner: str) -> bool:
+    """
+    Given the owner recorded in a claim, returns whether it's known to be
+    gone: a process on this host that isn't running anymore. Processes on
+    other hosts can't be checked, so their claims only go stale with time
+    """
+
+    try:
+        recorded = json.loads(owner)
+        host, pid = recorded["host"], int(recorded["pid"])
+    except (ValueError, KeyError, TypeError):
+        return False
+
+    # `os.kill` terminates processes on Windows, rather than checking them
+    if os.name != "posix" or host != socket.gethostname():
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return True
+    except PermissionError:
+        # running, under another user
+        return False
+    return False
+
+
+class ClaimDirectory:
+    """
+    Directory shared by several processes, on one machine or on a shared
+    filesystem, that go through the same list of books. Each book is
+    claimed by creating its claim file exclusively, which only one process
+    can do, so that no book is sent twice. The result of each book is
+    written next to the claims, so that every process's results can be
+    merged into one report.
+
+    Claims record their owner (host and process) and, while their owner
+    keeps them alive (see `keep_alive`), their file is touched every now
+    and then as a heartbeat. A claim goes stale once its owner is gone, or
+    hasn't touched it for `stale_after` seconds, and the book can then be
+    claimed again, unless its result was already saved.
+    """
+
+    def __init__(
+        self, directory: str, stale_after: float = STALE_CLAIM_IN_SECONDS
+    ) -> None:
+        self.directory = directory
+        self.stale_after = stale_after
+        self._held: set[int] = set()
+        self._lock = threading.Lock()
+
+    def claim_path(self, book_id: int) -> str:
+        """Path of the file that marks a book as claimed"""
+
+        return os.path.join(self.directory, CLAIMS_DIRNAME, f"{book_id}.claim")
+
+    def result_path(self, book_id: int) -> str:
+        """Path of the result of a book"""
+
+        return os.path.join(self.directory, RESULTS_DIRNAME, f"{book_id}.json")
+
+    def claim(self, book_id: int) -> bool:
+        """
+        Claims a book, returning whether it wasn't claimed by anyone yet,
+        or its claim was stale and could be taken over
+        """
+
+        path = self.claim_path(book_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not self._create_claim(path):
+            stale_owner = self._get_stale_owner(book_id)
+            if stale_owner is None or not self._take_over(path, stale_owner):
+                return False
+            if not self._create_claim(path):
+                return False
+
+        with self._lock:
+            self._held.add(book_id)
+        return True
+
+    @staticmethod
+    def _create_claim(path: str) -> bool:
+        try:
+            file_descriptor = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+
+        owner = {"host": socket.gethostname(), "pid": os.getpid(), "at": time.time_ns()}
+        with os.fdopen(file_descriptor, "w", encoding="utf-8") as claim_file:
+            claim_file.write(json.dumps(owner))
+        return True
+
+    def _get_stale_owner(self, book_id: int) -> Optional[str]:
+        """Returns the owner of a book's claim, as recorded in it, if stale"""
+
+        if os.path.exists(self.result_path(book_id)):
+            return None
+
+        path = self.claim_path(book_id)
+        try:
+            with open(path, encoding="utf-8") as claim_file:
+                owner = claim_file.read()
+            age = time.time() - os.path.getmtime(path)
+        except FileNotFoundError:
+            return None
+
+        if age > self.stale_after or is_owner_gone(owner):
+            return owner
+        return None
+
+    @staticmethod
+    def _take_over(path: str, stale_owner: str) -> bool:
+        """
+        Removes a stale claim, returning whether it could be, by moving it
+        aside first, which only one process can do. If the claim moved aside
+        turns out to be another process's fresh claim, it's put back
+        """
+
+        aside_path = f"{path}.{socket.gethostname()}-{os.getpid()}.stale"
+        try:
+            os.rename(path, aside_path)
+        except FileNotFoundError:
+            # removed by another process, so it can be claimed again
+            return True
+
+        with open(aside_path, encoding="utf-8") as claim_file:
+            owner = claim_file.read()
+        if owner != stale_owner:
+            os.rename(aside_path, path)
+            return False
+
+        os.unlink(aside_path)
+        return True
+
+    def heartbeat(self) -> None:
+        """Touches the claims held by this process, so they don't go stale"""
+
+        with self._lock:
+            held = list(self._held)
+        for book_id in held:
+            try:
+                os.utime(self.claim_path(book_id))
+            except FileNotFoundError:
+                continue
+
+    @contextmanager
+    def keep_alive(
+        self, interval: float = CLAIM_HEARTBEAT_IN_SECONDS
+    ) -> Iterator["ClaimDirectory"]:
+        """
+        Keeps the claims held by this process alive while within it, from a
+        background thread that sends a heartbeat every `interval` seconds
+        """
+
+        stopped = threading.Event()
+
+        def _beat() -> None:
+            while not stopped.wait(interval):
+                self.heartbeat()
+
+        beater = threading.Thread(target=_beat, daemon=True)
+        beater.start()
+        try:
+            yield self
+        finally:
+            stopped.set()
+            beater.join()
+
+    def claim_all(self, book_ids: Iterable[int]) -> Iterator[int]:
+        """
+        Yields the given books that could be claimed, claiming each one
+        only when it's reached
+        """
+
+        return (book_id for book_id in book_ids if self.claim(book_id))
+
+    def release(self, book_id: int) -> None:
+        """Releases the claim on a book, so that it can be claimed again"""
+
+        with self._lock:
+            self._held.discard(book_id)
+        try:
+            os.unlink(self.claim_path(book_id))
+        except FileNotFoundError:
+            pass
+
+    def release_held(self) -> None:
+        """
+        Releases every claim still held by this process, i.e. on books
+        that were claimed but won't get a result from it
+        """
+
+        with self._lock:
+            held = list(self._held)
+        for book_id in held:
+            self.release(book_id)
+
+    def record(self, result: BookResult) -> None:
+        """
+        Saves the result of a claimed book, whose claim then no longer needs
+        to be kept alive, as books with a result can't be claimed again
+        """
+
+        write_atomically(
+            self.result_path(result.book_id), json.dumps(asdict(result)).encode()
+        )
+        with self._lock:
+            self._held.discard(result.book_id)
+
+    def results(self) -> list[BookResult]:
+        """Returns the results saved by every process, sorted by book ID"""
+
+        directory = os.path.join(self.directory, RESULTS_DIRNAME)
+        try:
+            filenames = os.listdir(directory)
+        except FileNotFoundError:
+            return []
+
+        results = []
+        for filename in filenames:
+            if not filename.endswith(".json"):
+                continue
+
+            with open(os.path.join(directory, filename), encoding="utf-8") as file:
+                results.append(BookResult(**json.load(file)))
+        return sorted(results, key=lambda result: result.book_id)
@@ -0,0 +1,186 @@
+"""
+Local spool of books ready to be emailed, so that preparing books and
+delivering them over SMTP can happen at different times
+"""
+
+import json
+import os
+import time
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from typing import Final, Optional, Union
+
+from gutenberg2kindle.cache import write_atomically
+
+CONTENT_EXTENSION: Final[str] = ".epub"
+METADATA_EXTENSION: Final[str] = ".json"
+CLAIMED_EXTENSION: Final[str] = ".sending"
+STALE_CLAIM_IN_SECONDS: Final[int] = 60 * 60
+
+
+@dataclass
+class SpoolEntry:  # pylint: disable=too-many-instance-attributes
+    """A book waiting in the spool to be emailed, as an attachment"""
+
+    name: str
+    book_id: int
+    filename: str
+    size_in_bytes: int
+    digest: Optional[str] = None
+    attempts: int = 0
+    last_error: Optional[str] = None
+    spooled_at: str = field(
+        default_factory=lambda: datetime.now(timezone.utc).isoformat()
+    )
+
+
+class Spool:
+    """
+    Directory of books waiting to be emailed, oldest first.
+
+    Every entry is stored as two files, both written atomically: the
+    attachment itself and, once it's fully on disk, the entry's metadata.
+    An entry only exists once its metadata does, so a crash while spooling
+    never leaves a partial entry behind.
+
+    Entries are claimed before they're sent, by renaming their metadata,
+    so that flushes running at the same time never send the same entry.
+    """
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+
+    def content_path(self, name: str) -> str:
+        """Path of the attachment of an entry"""
+
+        return os.path.join(self.directory, name + CONTENT_EXTENSION)
+
+    def metadata_path(self, name: str) -> str:
+        """Path of the metadata of an entry"""
+
+        return os.path.join(self.directory, name + METADATA_EXTENSION)
+
+    def claimed_path(self, name: str) -> str:
+        """Path of the metadata of an entry while it's claimed to be sent"""
+
+        return os.path.join(self.directory, name + CLAIMED_EXTENSION)
+
+    def add(
+        self,
+        book_id: int,
+        content: Union[bytes, memoryview],
+        filename: Optional[str] = None,
+        digest: Optional[str] = None,
+    ) -> SpoolEntry:
+        """
+        Adds a book to the spool, to be sent as an attachment named after
+        the book ID unless a filename is given, and returns its entry
+        """
+
+        filename = filename or f"{book_id}.epub"
+        # entries are named so that sorting them by name sorts them by age
+        name = f"{time.time_ns():020d}-{os.getpid()}-{filename.removesuffix('.epub')}"
+        entry = SpoolEntry(name, book_id, filename, len(content), digest)
+
+        write_atomically(self.content_path(name), content)
+        self.update(entry)
+        return entry
+
+    def update(self, entry: SpoolEntry) -> None:
+        """Saves an entry's metadata, e.g. after a failed delivery attempt"""
+
+        write_atomically(
+            self.metadata_path(entry.name), json.dumps(asdict(entry)).encode()
+        )
+
+    def entries(self) -> list[SpoolEntry]:
+        """Returns the entries in the spool, oldest first"""
+
+        try:
+            filenames = sorted(os.listdir(self.directory))
+        except FileNotFoundError:
+            return []
+
+        entries = []
+        for filename in filenames:
+            if not filename.endswith(METADATA_EXTENSION):
+                continue
+
+            try:
+                with open(
+                    os.path.join(self.directory, filename), encoding="utf-8"
+                ) as metadata_file:
+                    entries.append(SpoolEntry(**json.load(metadata_file)))
+            except FileNotFoundError:
+                # removed by someone else since it was listed
+                continue
+        return entries
+
+    def claim(self, entry: SpoolEntry) -> bool:
+        """
+        Claims an entry to send it, atomically, so that it's no longer
+        listed. Returns whether it was claimed, which it isn't if another
+        flush got to it first
+        """
+
+        try:
+            os.rename(self.metadata_path(entry.name), self.claimed_path(entry.name))
+        except FileNotFoundError:
+            return False
+
+        # claims are timed from when they're made (see `release_stale_claims`)
+        os.utime(self.claimed_path(entry.name))
+        return True
+
+    def release(self, entry: SpoolEntry) -> None:
+        """
+        Puts a claimed entry back in the spool, with its metadata up to date
+        (e.g. after failed delivery attempts), for the next flush
+        """
+
+        self.update(entry)
+        try:
+            os.unlink(self.claimed_path(entry.name))
+        except FileNotFoundError:
+            pass
+
+    def release_stale_claims(self, max_age: float = STALE_CLAIM_IN_SECONDS) -> None:
+        """
+        Puts back in the spool the entries claimed more than `max_age`
+        seconds ago, left behind by flushes that crashed while sending them
+        """
+
+        try:
+            filenames = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+
+        for filename in filenames:
+            if not filename.endswith(CLAIMED_EXTENSION):
+                continue
+
+            name = filename.removesuffix(CLAIMED_EXTENSION)
+            try:
+                if time.time() - os.path.getmtime(self.claimed_path(name)) > max_age:
+                    os.rename(self.claimed_path(name), self.metadata_path(name))
+            except FileNotFoundError:
+                # released or sent since it was listed
+                continue
+
+    def remove(self, entry: SpoolEntry) -> None:
+        """
+        Removes an entry from the spool, once delivered, whether it's
+        claimed or not. Its metadata goes first, so that a crash halfway
+        leaves an orphan attachment that is ignored, rather than an entry
+        without attachment
+        """
+
+        for path in (
+            self.metadata_path(entry.name),
+            self.claimed_path(entry.name),
+            self.content_path(entry.name),
+        ):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
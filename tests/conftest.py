@@ -0,0 +1,31 @@
+"""Fixtures shared by the unit tests"""
+
+import pytest
+import usersettings  # type: ignore
+
+from gutenberg2kindle import api, config
+
+
+@pytest.fixture
+def default_settings(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Replaces the user's settings with the default ones, kept in memory"""
+
+    monkeypatch.setattr(
+        config, "settings", usersettings.Settings("test.gutenberg2kindle")
+    )
+    config.setup_settings()
+    monkeypatch.setattr(api, "ensure_settings", lambda: None)
+
+
+@pytest.fixture(autouse=True)
+def _no_preflight(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Keeps the preflight of each batch from connecting anywhere"""
+
+    monkeypatch.setattr(api, "run_checks", lambda *_: [])
+
+
+@pytest.fixture(autouse=True)
+def _no_verification(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Lets the books mocked in unit tests through, as they aren't real EPUBs"""
+
+    monkeypatch.setattr(api, "verify_book", lambda _book_id, book, *_: book)
@@ -0,0 +1,546 @@
+"""Unit tests for the programmatic API used to send books"""
+
+import io
+import mmap
+import os
+import smtplib
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from pathlib import Path
+from typing import Optional
+
+import pytest
+import requests
+
+from gutenberg2kindle import api, config, gutenberg
+from gutenberg2kindle.budget import ByteBudget
+from gutenberg2kindle.cache import BookCache
+from gutenberg2kindle.email import SMTP_ERROR_AUTH, BookFile, SmtpSession, get_book_size
+from gutenberg2kindle.epub import Volume
+from gutenberg2kindle.preflight import CHECK_GUTENBERG, CHECK_SMTP, CheckResult
+from gutenberg2kindle.progress import ProgressReporter
+from gutenberg2kindle.spool import Spool
+from tests.test_epub import build_epub
+
+
+def _download_book(book_id: int, *_: object) -> Optional[BytesIO]:
+    if book_id == 404:
+        return None
+    return BytesIO(f"book content {book_id}".encode())
+
+
+pytestmark = pytest.mark.usefixtures("default_settings")
+
+
+@pytest.fixture(autouse=True)
+def _download(monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(api, "download_book", _download_book)
+
+
+def test_send_books(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Unit tests for sending books, which never prints or exits"""
+
+    sessions: list[SmtpSession] = []
+
+    def _send_book(book_id: int, _book: BytesIO, _password: str, *args: object) -> bool:
+        assert isinstance(args[1], SmtpSession)
+        sessions.append(args[1])
+        # the stored settings are left alone, and the resolved ones passed instead
+        assert config.settings[config.SETTINGS_KINDLE_EMAIL] == ""
+        assert isinstance(args[2], dict)
+        assert args[2][config.SETTINGS_KINDLE_EMAIL] == "test@kindle.com"
+        return book_id != 413
+
+    monkeypatch.setattr(api, "send_book", _send_book)
+    monkeypatch.setattr(
+        api, "download_book", lambda book_id, *_: _download_book(book_id % 1000)
+    )
+
+    results = api.send_books(
+        [1, 404, 413, 1001],
+        password="m0ck-p4ssw0rd",
+        config={config.SETTINGS_KINDLE_EMAIL: "test@kindle.com"},
+    )
+
+    assert [(result.book_id, result.status) for result in results] == [
+        (1, api.STATUS_SENT),
+        (404, api.STATUS_NOT_DOWNLOADED),
+        (413, api.STATUS_TOO_LARGE),
+        (1001, api.STATUS_DUPLICATE),
+    ]
+    assert results[0].sent
+    assert results[0].size_in_bytes == len(b"book content 1")
+    assert results[0].digest is not None
+    assert results[3].duplicate_of == 1
+    assert len(set(map(id, sessions))) == 1
+    assert config.get_config(config.SETTINGS_KINDLE_EMAIL) == ""
+
+
+@pytest.mark.usefixtures("default_settings")
+def test_send_books_with_different_configs(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Unit test to check that batches sent at the same time with different
+    configs each use their own, down to the SMTP sessions
+    """
+
+    def _send_book(_book_id: int, _book: BytesIO, *args: object) -> bool:
+        time.sleep(0.01)
+        assert isinstance(args[2], SmtpSession) and isinstance(args[3], dict)
+        assert args[2].config is args[3]
+        sent.append(str(args[3][config.SETTINGS_KINDLE_EMAIL]))
+        return True
+
+    sent: list[str] = []
+    monkeypatch.setattr(api, "send_book", _send_book)
+
+    def _send(kindle_email: str) -> list[api.BookResult]:
+        return api.send_books(
+            range(1, 6),
+            password="m0ck-p4ssw0rd",
+            config={config.SETTINGS_KINDLE_EMAIL: kindle_email},
+        )
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first, second = executor.map(_send, ["first@kindle.com", "second@kindle.com"])
+
+    assert {result.recipient for result in first} == {"first@kindle.com"}
+    assert {result.recipient for result in second} == {"second@kindle.com"}
+    assert sorted(sent) == ["first@kindle.com"] * 5 + ["second@kindle.com"] * 5
+
+
+@pytest.mark.parametrize(
+    "error, status, attempts",
+    [
+        (smtplib.SMTPAuthenticationError(535, "bad login"), api.STATUS_SMTP_ERROR, 1),
+        (socket.error("smtp error!"), api.STATUS_SMTP_UNAVAILABLE, 3),
+    ],
+)
+def test_book_sender_skips_books_after_smtp_errors(
+    monkeypatch: pytest.MonkeyPatch, error: OSError, status: str, attempts: int
+) -> None:
+    """
+    Unit tests for the books left unsent after the SMTP credentials turn out
+    to be invalid, or the SMTP server keeps failing after several retries
+    """
+
+    delays: list[float] = []
+    monkeypatch.setattr(api.time, "sleep", delays.append)
+
+    def _send_book(*_: object) -> bool:
+        raise error
+
+    monkeypatch.setattr(api, "send_book", _send_book)
+
+    with api.BookSender("m0ck-p4ssw0rd") as sender:
+        results = sender.send([1, 2, 3])
+        assert sender.budget.in_use == 0
+
+    assert [result.status for result in results] == [
+        status,
+        api.STATUS_SKIPPED,
+        api.STATUS_SKIPPED,
+    ]
+    assert results[0].error == str(error)
+    assert delays == [1.0, 2.0][: attempts - 1]
+
+
+def test_book_sender_events(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Unit tests for the events reported while compacting and splitting books"""
+
+    volumes = [Volume(1, 2, b"first half"), Volume(2, 2, b"second half")]
+    monkeypatch.setattr(api, "split_epub", lambda *_: iter(volumes))
+    monkeypatch.setattr(api, "get_size_limit_in_bytes", lambda _=None: 10)
+    monkeypatch.setattr(api, "is_valid_file_size", lambda *_: False)
+    monkeypatch.setattr(api, "send_book", lambda *_: True)
+    monkeypatch.setattr(api, "ProcessPoolExecutor", ThreadPoolExecutor)
+
+    def _compact_epub(_content: bytes) -> bytes:
+        raise ValueError("Invalid EPUB file")
+
+    monkeypatch.setattr(api, "compact_epub", _compact_epub)
+
+    events: list[api.BookEvent] = []
+
+    with api.BookSender(
+        "m0ck-p4ssw0rd", options=api.SendOptions(split=True), on_event=events.append
+    ) as sender:
+        (result,) = sender.send([1])
+    assert result.status == api.STATUS_SENT
+    assert result.volumes == 2
+
+    with api.BookSender(
+        "m0ck-p4ssw0rd", options=api.SendOptions(compact=True), on_event=events.append
+    ) as sender:
+        (result,) = sender.send([2])
+        assert sender.budget.in_use == 0
+    assert result.status == api.STATUS_NOT_COMPACTED
+    assert result.error == "Invalid EPUB file"
+
+    assert events == [
+        api.BookEvent(1, api.EVENT_SENDING_VOLUME, 1, 2),
+        api.BookEvent(1, api.EVENT_SENDING_VOLUME, 2, 2),
+        api.BookEvent(2, api.EVENT_COMPACTING),
+    ]
+
+
+def test_book_sender_compacts_within_memory_budget(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """
+    Unit test to check that books being compacted don't hold the memory
+    budget, so that the books downloaded after them don't wait forever
+    """
+
+    contents = {1: b"0" * (3 * 1024 * 1024), 2: b"0" * 100}
+
+    def _download_book(book_id: int, budget: ByteBudget, *_: object) -> BytesIO:
+        budget.acquire(len(contents[book_id]))
+        return BytesIO(contents[book_id])
+
+    monkeypatch.setattr(api, "download_book", _download_book)
+    monkeypatch.setattr(
+        api, "is_valid_file_size", lambda book, _=None: get_book_size(book) < 1024**2
+    )
+    monkeypatch.setattr(api, "send_book", lambda *_: True)
+    monkeypatch.setattr(api, "compact_epub", lambda content: content[:100])
+    monkeypatch.setattr(api, "ProcessPoolExecutor", ThreadPoolExecutor)
+
+    results: list[api.BookResult] = []
+    options = api.SendOptions(compact=True, max_memory=2)
+    with api.BookSender("m0ck-p4ssw0rd", options=options) as sender:
+        # a daemon thread, so that a deadlock fails the test instead of hanging
+        batch = threading.Thread(
+            target=lambda: results.extend(sender.send([1, 2])), daemon=True
+        )
+        batch.start()
+        batch.join(timeout=10)
+        hung, in_use = batch.is_alive(), sender.budget.in_use
+        # lets a hung download go, so that the sender can still be closed
+        sender.budget.release(in_use)
+        assert not hung
+        assert in_use == 0
+
+    assert [(result.book_id, result.status) for result in results] == [
+        (2, api.STATUS_SENT),
+        (1, api.STATUS_SENT),
+    ]
+
+
+def test_book_sender_spool(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    """Unit tests for spooling books and flushing the spool later on"""
+
+    monkeypatch.setattr(
+        api, "is_valid_file_size", lambda book, _=None: book.getvalue() != b""
+    )
+    monkeypatch.setattr(api.time, "sleep", lambda _: None)
+    attempts: list[int] = []
+
+    def _send_book(book_id: int, *_: object) -> bool:
+        attempts.append(book_id)
+        if book_id == 2 and attempts.count(2) < 2:
+            raise socket.error("smtp error!")
+        if book_id == 3:
+            raise smtplib.SMTPDataError(554, "message rejected")
+        return True
+
+    monkeypatch.setattr(api, "send_book", _send_book)
+    options = api.SendOptions(spool_dir=str(tmp_path), workers=1, retries=1)
+
+    with api.BookSender("m0ck-p4ssw0rd", options=options) as sender:
+        # leave the retries to the flush, rather than to the sender pool
+        sender.smtp_pool.max_retries = 0
+        results = sender.send([1, 2, 3])
+        assert [result.status for result in results] == [api.STATUS_SPOOLED] * 3
+        assert not attempts
+
+        results = sender.flush()
+
+    assert [(result.book_id, result.status) for result in results] == [
+        (1, api.STATUS_SENT),
+        (2, api.STATUS_SENT),
+        (3, api.STATUS_REJECTED),
+    ]
+    assert attempts == [1, 2, 2, 3]
+
+    (entry,) = Spool(str(tmp_path)).entries()
+    assert entry.book_id == 3
+    assert entry.attempts == 1
+    assert entry.last_error == "(554, 'message rejected')"
+
+
+@pytest.mark.parametrize(
+    "error, status",
+    [
+        (smtplib.SMTPAuthenticationError(535, "bad login"), api.STATUS_SMTP_ERROR),
+        (socket.error("connection refused"), api.STATUS_SMTP_UNAVAILABLE),
+    ],
+)
+def test_book_sender_flush_stops_without_smtp(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path, error: OSError, status: str
+) -> None:
+    """
+    Unit tests to check that flushes stop trying once no SMTP profile is
+    left in rotation, keeping the error of the book that found out and
+    leaving the remaining books in the spool
+    """
+
+    spool = Spool(str(tmp_path))
+    for book_id in range(1, 6):
+        spool.add(book_id, f"book {book_id}".encode())
+    monkeypatch.setattr(api.time, "sleep", lambda _: None)
+    attempts: list[int] = []
+
+    def _send_book(book_id: int, *_: object) -> bool:
+        attempts.append(book_id)
+        raise error
+
+    monkeypatch.setattr(api, "send_book", _send_book)
+    options = api.SendOptions(spool_dir=str(tmp_path), workers=1, retries=2)
+    with api.BookSender("m0ck-p4ssw0rd", options=options) as sender:
+        results = sender.flush()
+
+    assert [(result.book_id, result.status) for result in results] == [(1, status)] + [
+        (book_id, api.STATUS_SKIPPED) for book_id in range(2, 6)
+    ]
+    assert results[0].error == str(error)
+    # the circuit breaker, or the invalid credentials, stop every attempt
+    assert set(attempts) == {1}
+    assert len(attempts) <= 3
+    assert len(spool.entries()) == 5
+
+
+def test_book_sender_concurrent_flushes(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+) -> None:
+    """Unit test to check that flushes of the same spool never send a book twice"""
+
+    spool = Spool(str(tmp_path))
+    for book_id in range(1, 9):
+        spool.add(book_id, f"book {book_id}".encode())
+    sent: list[int] = []
+
+    def _send_book(book_id: int, *_: object) -> bool:
+        time.sleep(0.01)
+        sent.append(book_id)
+        return True
+
+    monkeypatch.setattr(api, "send_book", _send_book)
+    options = api.SendOptions(spool_dir=str(tmp_path), workers=2)
+
+    def _flush(_: int) -> list[api.BookResult]:
+        with api.BookSender("m0ck-p4ssw0rd", options=options) as sender:
+            return sender.flush()
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        flushes = list(executor.map(_flush, range(2)))
+
+    assert sorted(sent) == list(range(1, 9))
+    assert sorted(result.book_id for results in flushes for result in results) == list(
+        range(1, 9)
+    )
+    assert not spool.entries()
+    assert not os.listdir(tmp_path)
+
+
+def test_book_sender_preflight(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    """Unit tests for the batches stopped by a failed preflight"""
+
+    checks = [
+        CheckResult(CHECK_GUTENBERG, 0.1),
+        CheckResult(CHECK_SMTP, 0.2, "default", "bad login", SMTP_ERROR_AUTH),
+    ]
+    checked_gutenberg: list[bool] = []
+
+    def _run_checks(_: object, http_session: object) -> list[CheckResult]:
+        checked_gutenberg.append(http_session is not None)
+        return checks
+
+    monkeypatch.setattr(api, "run_checks", _run_checks)
+    sent: list[int] = []
+
+    def _send_book(book_id: int, *_: object) -> bool:
+        sent.append(book_id)
+        return True
+
+    monkeypatch.setattr(api, "send_book", _send_book)
+
+    with api.BookSender("m0ck-p4ssw0rd") as sender:
+        assert sender.check() == checks
+        results = sender.send([1, 2])
+        assert sender.budget.in_use == 0
+
+    assert [(result.status, result.error) for result in results] == [
+        (api.STATUS_SMTP_ERROR, "bad login"),
+        (api.STATUS_SKIPPED, None),
+    ]
+    assert not sent
+
+    checks[0].error = "no route to host"
+    with api.BookSender("m0ck-p4ssw0rd") as sender:
+        (result,) = sender.send([1])
+    assert result.status == api.STATUS_GUTENBERG_UNREACHABLE
+
+    options = api.SendOptions(preflight=False)
+    with api.BookSender("m0ck-p4ssw0rd", options=options) as sender:
+        (result,) = sender.send([1])
+    assert result.status == api.STATUS_SENT
+    assert sent == [1]
+
+    # cached books don't need Project Gutenberg, unless explicitly checked
+    checks.pop(1)
+    options = api.SendOptions(cache_dir=str(tmp_path))
+    with api.BookSender("m0ck-p4ssw0rd", options=options) as sender:
+        sender.send([2])
+        sender.check()
+    assert checked_gutenberg == [True, True, True, False, True]
+
+
+def test_book_sender_maps_cached_books(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+) -> None:
+    """
+    Unit test to check that cached books are sent mapped from the cache,
+    without taking any of the memory budget, while downloaded ones take it
+    """
+
+    BookCache(str(tmp_path)).store(1, config.FORMAT_IMAGES, "", b"cached book")
+    monkeypatch.setattr(api, "download_book", gutenberg.download_book)
+
+    def _fetch_book_from_url(_url: str, budget: ByteBudget, *_: object) -> BytesIO:
+        budget.acquire(len(b"downloaded book"))
+        return BytesIO(b"downloaded book")
+
+    monkeypatch.setattr(gutenberg, "fetch_book_from_url", _fetch_book_from_url)
+    sent: list[tuple[int, bool, int]] = []
+
+    def _send_book(book_id: int, book: BookFile, *_: object) -> bool:
+        sent.append((book_id, isinstance(book, mmap.mmap), sender.budget.in_use))
+        return True
+
+    monkeypatch.setattr(api, "send_book", _send_book)
+
+    options = api.SendOptions(cache_dir=str(tmp_path), preflight=False)
+    with api.BookSender("m0ck-p4ssw0rd", options=options) as sender:
+        results = sender.send([1, 2])
+        assert sender.budget.in_use == 0
+
+    assert [result.status for result in results] == [api.STATUS_SENT] * 2
+    assert sent == [(1, True, 0), (2, False, len(b"downloaded book"))]
+
+
+def test_book_sender_dns_cache(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Unit test to check that DNS lookups are only cached while books are
+    being sent, and not for as long as the sender is open
+    """
+
+    original = socket.getaddrinfo
+    cached: list[bool] = []
+
+    def _send_book(*_: object) -> bool:
+        cached.append(socket.getaddrinfo is not original)
+        return True
+
+    monkeypatch.setattr(api, "send_book", _send_book)
+
+    with api.BookSender("m0ck-p4ssw0rd") as sender:
+        assert socket.getaddrinfo is original
+        sender.send([1])
+        assert socket.getaddrinfo is original
+    assert cached == [True]
+
+
+def test_book_sender_schedule(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Unit tests for the order in which a batch of books is sent"""
+
+    sizes = {1: 300, 2: 100, 3: 200}
+    sent: list[int] = []
+
+    def _estimate_book_size(book_id: int, *_: object) -> Optional[int]:
+        if book_id == 4:
+            raise requests.ConnectionError("no route to host")
+        return sizes.get(book_id)
+
+    def _send_book(book_id: int, *_: object) -> bool:
+        sent.append(book_id)
+        return True
+
+    monkeypatch.setattr(api, "estimate_book_size", _estimate_book_size)
+    monkeypatch.setattr(api, "send_book", _send_book)
+
+    options = api.SendOptions(schedule="smallest_first", priorities={3: 1})
+    results = api.send_books([4, 1, 2, 3], password="m0ck-p4ssw0rd", options=options)
+    assert [result.book_id for result in results] == [2, 3, 1, 4]
+    assert sent == [2, 3, 1, 4]
+
+    options = api.SendOptions(priorities={3: 1})
+    with api.BookSender("m0ck-p4ssw0rd", options=options) as sender:
+        assert sender.schedule([4, 1, 2, 3]) == [3, 4, 1, 2]
+
+
+def test_book_sender_progress(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Unit tests for the progress reported while a batch is sent"""
+
+    monkeypatch.setattr(api, "send_book", lambda *_: True)
+    stream = io.StringIO()
+    monkeypatch.setattr(stream, "isatty", lambda: True)
+    progress = ProgressReporter(3, stream)
+
+    with api.BookSender("m0ck-p4ssw0rd", progress=progress) as sender:
+        results = sender.send([1, 404, 2])
+
+    assert [result.status for result in results] == [
+        api.STATUS_SENT,
+        api.STATUS_NOT_DOWNLOADED,
+        api.STATUS_SENT,
+    ]
+    assert (progress.started_books, progress.done_books) == (3, 3)
+    assert progress.sent_bytes == sum(result.size_in_bytes for result in results)
+
+
+def test_book_sender_verifies_books(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Unit tests for the books downloaded again when corrupt, and for
+    the ones left unsent when they're still corrupt
+    """
+
+    downloads: list[int] = []
+
+    def _download(book_id: int, *_: object) -> BytesIO:
+        downloads.append(book_id)
+        book = build_epub({"chapter.xhtml": f"<html>Book {book_id}</html>".encode()})
+        # the first download of book 2, and every download of book 3, fail
+        intact = book_id == 1 or (book_id == 2 and downloads.count(2) > 1)
+        return BytesIO(book if intact else book[:-10])
+
+    sent: list[int] = []
+
+    def _send_book(book_id: int, *_: object) -> bool:
+        sent.append(book_id)
+        return True
+
+    monkeypatch.setattr(api, "verify_book", gutenberg.verify_book)
+    monkeypatch.setattr(api, "download_book", _download)
+    monkeypatch.setattr(gutenberg, "download_book", _download)
+    monkeypatch.setattr(api, "send_book", _send_book)
+
+    with api.BookSender("m0ck-p4ssw0rd") as sender:
+        results = sender.send([1, 2, 3])
+
+    assert [result.status for result in results] == [
+        api.STATUS_SENT,
+        api.STATUS_SENT,
+        api.STATUS_CORRUPT,
+    ]
+    assert results[2].error is not None
+    assert "could not be downloaded again" not in results[2].error
+    assert sorted(downloads) == [1, 2, 2, 3, 3]
+    assert sent == [1, 2]
+
+    options = api.SendOptions(verify=False)
+    with api.BookSender("m0ck-p4ssw0rd", options=options) as sender:
+        (result,) = sender.send([3])
+    assert result.status == api.STATUS_SENT
@@ -0,0 +1,61 @@
+"""Unit tests for the module that bounds the memory held by books in flight"""
+
+import threading
+
+import pytest
+
+from gutenberg2kindle.budget import BYTES_PER_MB, ByteBudget
+
+
+def test_byte_budget_from_mb() -> None:
+    """Unit tests for the helper that builds a budget from megabytes"""
+
+    assert ByteBudget.from_mb(None).limit_in_bytes is None
+    assert ByteBudget.from_mb(3).limit_in_bytes == 3 * BYTES_PER_MB
+
+    with pytest.raises(ValueError, match="must be a positive amount"):
+        ByteBudget.from_mb(0)
+
+
+def test_byte_budget_acquire_and_release() -> None:
+    """Unit tests for reserving and releasing bytes from a budget"""
+
+    budget = ByteBudget(100)
+    budget.acquire(60)
+    budget.acquire(40)
+    assert budget.in_use == 100
+
+    budget.release(60)
+    assert budget.in_use == 40
+
+    budget.resize(40, 10)
+    assert budget.in_use == 10
+
+    budget.release(1000)
+    assert budget.in_use == 0
+
+    # an oversized reservation is admitted if nothing else is in flight
+    budget.acquire(500)
+    assert budget.in_use == 500
+
+
+def test_byte_budget_blocks_when_exhausted() -> None:
+    """Unit test to check that acquiring blocks until bytes are released"""
+
+    budget = ByteBudget(100)
+    budget.acquire(80)
+
+    acquired = threading.Event()
+
+    def _acquire() -> None:
+        budget.acquire(50)
+        acquired.set()
+
+    thread = threading.Thread(target=_acquire)
+    thread.start()
+    assert not acquired.wait(0.05)
+
+    budget.release(80)
+    assert acquired.wait(1)
+    thread.join()
+    assert budget.in_use == 50
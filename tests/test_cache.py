@@ -0,0 +1,105 @@
+"""Unit tests for the content-addressed local book cache"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pytest
+
+from gutenberg2kindle.cache import BookCache, content_digest, write_atomically
+
+
+def test_content_digest() -> None:
+    """Unit test for the function that computes a content's digest"""
+
+    assert content_digest(b"") == (
+        "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855"
+    )
+    assert content_digest(memoryview(b"book")) == content_digest(b"book")
+
+
+def test_write_atomically(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """Unit test for the function that writes files atomically"""
+
+    path = tmp_path / "nested" / "file.txt"
+    write_atomically(str(path), b"first")
+    write_atomically(str(path), b"second")
+
+    assert path.read_bytes() == b"second"
+    assert os.listdir(path.parent) == ["file.txt"]
+
+    # bare filenames are relative to the current directory
+    monkeypatch.chdir(path.parent)
+    write_atomically("other.txt", b"third")
+    assert sorted(os.listdir(path.parent)) == ["file.txt", "other.txt"]
+
+
+def test_book_cache_store_and_lookup(tmp_path: Path) -> None:
+    """
+    Unit test to check that books are indexed by ID and format,
+    and that identical content is stored only once
+    """
+
+    cache = BookCache(str(tmp_path))
+    assert cache.lookup(1, "images") is None
+
+    digest_1 = cache.store(1, "images", "https://example.org/1.epub.images", b"book")
+    digest_2 = cache.store(1, "no_images", "https://example.org/1.epub", b"book")
+    digest_3 = cache.store(2, "images", "https://example.org/2.epub.images", b"other")
+
+    assert digest_1 == digest_2 != digest_3
+    assert len(list((tmp_path / "objects").glob("*/*"))) == 2
+
+    entry = BookCache(str(tmp_path)).lookup(1, "no_images")
+    assert entry == {
+        "sha256": digest_1,
+        "url": "https://example.org/1.epub",
+        "size": 4,
+    }
+    assert cache.read(digest_1) == b"book"
+    assert cache.read("0" * 64) is None
+
+
+def test_book_cache_sent_history(tmp_path: Path) -> None:
+    """Unit test for the history of books sent from the cache"""
+
+    cache = BookCache(str(tmp_path))
+    digest = content_digest(b"book")
+    assert not cache.was_sent(digest, "kindle@example.org")
+
+    cache.record_sent(digest, 1, "kindle@example.org")
+    assert cache.was_sent(digest, "kindle@example.org")
+    assert not cache.was_sent(digest, "other@example.org")
+
+
+def _store_books(directory: str, book_ids: range) -> None:
+    cache = BookCache(directory)
+    for book_id in book_ids:
+        cache.store(book_id, "images", f"https://example.org/{book_id}", b"book")
+
+
+def test_book_cache_shared_by_processes(tmp_path: Path) -> None:
+    """
+    Unit test to check that caches sharing a directory, in this process or
+    in others, see each other's entries and don't drop them when storing
+    """
+
+    first, second = BookCache(str(tmp_path)), BookCache(str(tmp_path))
+    assert second.lookup(1, "images") is None
+
+    first.store(1, "images", "https://example.org/1", b"first")
+    second.store(2, "images", "https://example.org/2", b"second")
+    assert first.lookup(2, "images") is not None
+    assert second.lookup(1, "images") is not None
+
+    with ProcessPoolExecutor(max_workers=4) as executor:
+        list(
+            executor.map(
+                _store_books,
+                [str(tmp_path)] * 4,
+                [range(start, start + 10) for start in range(10, 50, 10)],
+            )
+        )
+
+    cache = BookCache(str(tmp_path))
+    assert all(cache.lookup(book_id, "images") for book_id in [1, 2, *range(10, 50)])
@@ -1,14 +1,30 @@
 """Unit test collection for the command-line interface functions."""
 
-import socket
+# pylint: disable=too-many-lines
+
+import json
+import smtplib
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from typing import Optional
+from pathlib import Path
+from typing import Any, Optional
 from unittest.mock import patch
 
 import pytest
 
-from gutenberg2kindle import cli
+from gutenberg2kindle import api, cli, config, pool
+from gutenberg2kindle.api import STATUS_SENT, BookResult
+from gutenberg2kindle.email import SmtpProfile
+from gutenberg2kindle.epub import Volume
+from gutenberg2kindle.preflight import CHECK_GUTENBERG, CHECK_SMTP, CheckResult
+from gutenberg2kindle.report import write_report
+from gutenberg2kindle.shard import ClaimDirectory
+from gutenberg2kindle.spool import Spool
+
+
+def _download_book_mock(book_id: int, *_: object) -> BytesIO:
+    return BytesIO(f"book content {book_id}".encode())
 
 
 def _getpass_mock(message: str) -> str:
@@ -28,6 +44,22 @@ def test_get_parser() -> None:
     assert parser.epilog == "Happy reading! :-)"
 
 
+@pytest.mark.parametrize("flag", ["--max-memory", "--workers"])
+def test_get_parser_positive_flags(flag: str, capfd: pytest.CaptureFixture) -> None:
+    """Unit tests to check that sizes and amounts must be positive integers"""
+
+    parser = cli.get_parser()
+    assert (
+        getattr(parser.parse_args(["send", flag, "2"]), flag[2:].replace("-", "_")) == 2
+    )
+
+    for value in ("0", "-1", "a"):
+        with pytest.raises(SystemExit, match="2"):
+            parser.parse_args(["send", flag, value])
+        _, err = capfd.readouterr()
+        assert f"{value} is not a positive integer" in err
+
+
 def test_format_setting() -> None:
     """Unit tests for the setting formatting function"""
 
@@ -51,7 +83,7 @@ def test_main_config_handlers(
     monkeypatch.setattr(cli, "setup_settings", lambda: None)
 
     # get-config with name
-    monkeypatch.setattr(cli, "get_config", lambda _: "test-value")
+    monkeypatch.setattr(cli, "get_config", lambda *_: "test-value")
     with patch.object(
         sys,
         "argv",
@@ -67,7 +99,7 @@ def test_main_config_handlers(
         assert out == "test-value\n"
 
     # get-config without name
-    monkeypatch.setattr(cli, "get_config", lambda _: {"a": 1, "b": 2})
+    monkeypatch.setattr(cli, "get_config", lambda *_: {"a": 1, "b": 2})
     with patch.object(sys, "argv", ["gutenberg2kindle", "get-config"]):
         cli.main()
         out, _ = capfd.readouterr()
@@ -124,7 +156,8 @@ def test_main_send_handler_if_book_is_none(
     Unit tests for the `send` handler of the CLI when a book can't be found
     """
     monkeypatch.setattr(cli, "setup_settings", lambda: None)
-    monkeypatch.setattr(cli, "download_book", lambda _: None)
+    monkeypatch.setattr(api, "ensure_settings", lambda: None)
+    monkeypatch.setattr(api, "download_book", lambda *_: None)
     monkeypatch.setattr("getpass.getpass", _getpass_mock)
 
     with patch.object(
@@ -154,7 +187,8 @@ def test_main_send_handler_if_book_is_none_with_ignore_errors(
     but the user requests to ignore errors
     """
     monkeypatch.setattr(cli, "setup_settings", lambda: None)
-    monkeypatch.setattr(cli, "download_book", lambda _: None)
+    monkeypatch.setattr(api, "ensure_settings", lambda: None)
+    monkeypatch.setattr(api, "download_book", lambda *_: None)
     monkeypatch.setattr("getpass.getpass", _getpass_mock)
 
     with patch.object(
@@ -168,7 +202,8 @@ def test_main_send_handler_if_book_is_none_with_ignore_errors(
             "1234",
         ],
     ):
-        cli.main()
+        with pytest.raises(SystemExit, match="1"):
+            cli.main()
         out, _ = capfd.readouterr()
         assert out == (
             "Please enter your SMTP password: \n"
@@ -185,20 +220,21 @@ def test_main_send_handler_if_book_is_none_multiple_books(
     and multiple books were requested
     """
 
-    def _download_book(book_id: int) -> Optional[BytesIO]:
+    def _download_book(book_id: int, *_: object) -> Optional[BytesIO]:
         if book_id == 5678:
             return None
-        return BytesIO(b"test")
+        return BytesIO(f"test {book_id}".encode())
 
     monkeypatch.setattr(cli, "setup_settings", lambda: None)
-    monkeypatch.setattr(cli, "download_book", _download_book)
+    monkeypatch.setattr(api, "ensure_settings", lambda: None)
+    monkeypatch.setattr(api, "download_book", _download_book)
     monkeypatch.setattr("getpass.getpass", _getpass_mock)
-    monkeypatch.setattr(cli, "send_book", lambda book_id, *_: book_id != 5678)
+    monkeypatch.setattr(api, "send_book", lambda book_id, *_: book_id != 5678)
 
     with patch.object(
         sys, "argv", ["gutenberg2kindle", "send", "--book-id", "1234", "5678", "9101"]
     ):
-        with pytest.raises(SystemExit, match="1"):
+        with pytest.raises(SystemExit, match="3"):
             cli.main()
         out, _ = capfd.readouterr()
         assert out == (
@@ -217,15 +253,16 @@ def test_main_send_handler_if_book_is_none_multiple_books_with_ignore_errors(
     and multiple books were requested when the user asks to ignore errors
     """
 
-    def _download_book(book_id: int) -> Optional[BytesIO]:
+    def _download_book(book_id: int, *_: object) -> Optional[BytesIO]:
         if book_id == 5678:
             return None
-        return BytesIO(b"test")
+        return BytesIO(f"test {book_id}".encode())
 
     monkeypatch.setattr(cli, "setup_settings", lambda: None)
-    monkeypatch.setattr(cli, "download_book", _download_book)
+    monkeypatch.setattr(api, "ensure_settings", lambda: None)
+    monkeypatch.setattr(api, "download_book", _download_book)
     monkeypatch.setattr("getpass.getpass", _getpass_mock)
-    monkeypatch.setattr(cli, "send_book", lambda book_id, *_: book_id != 5678)
+    monkeypatch.setattr(api, "send_book", lambda book_id, *_: book_id != 5678)
 
     with patch.object(
         sys,
@@ -240,7 +277,8 @@ def test_main_send_handler_if_book_is_none_multiple_books_with_ignore_errors(
             "9101",
         ],
     ):
-        cli.main()
+        with pytest.raises(SystemExit, match="3"):
+            cli.main()
         out, _ = capfd.readouterr()
         assert out == (
             "Please enter your SMTP password: \n"
@@ -261,13 +299,14 @@ def test_main_send_handler_if_email_cant_be_sent(
     Unit tests for the `send` handler of the CLI when the email can't be sent
     """
     monkeypatch.setattr(cli, "setup_settings", lambda: None)
-    monkeypatch.setattr(cli, "download_book", lambda _: BytesIO(b"book content"))
+    monkeypatch.setattr(api, "ensure_settings", lambda: None)
+    monkeypatch.setattr(api, "download_book", lambda *_: BytesIO(b"book content"))
     monkeypatch.setattr("getpass.getpass", _getpass_mock)
 
-    def _send_book_monkeypatch(book_id: int, book: BytesIO, password: str) -> None:
-        raise socket.error("smtp error!")
+    def _send_book_monkeypatch(book_id: int, *_: object) -> None:
+        raise smtplib.SMTPAuthenticationError(535, "smtp error!")
 
-    monkeypatch.setattr(cli, "send_book", _send_book_monkeypatch)
+    monkeypatch.setattr(api, "send_book", _send_book_monkeypatch)
 
     with patch.object(
         sys,
@@ -287,8 +326,48 @@ def test_main_send_handler_if_email_cant_be_sent(
             "Sending book `1234`...\n"
             "SMTP credentials are invalid! "
             "Please validate your current config.\n"
-            "Server error message: smtp error!\n"
+            "Server error message: (535, 'smtp error!')\n"
+        )
+
+
+def test_main_send_handler_if_smtp_server_is_unavailable(
+    monkeypatch: pytest.MonkeyPatch, capfd: pytest.CaptureFixture
+) -> None:
+    """
+    Unit tests for the `send` handler of the CLI when the SMTP server rejects
+    a book, and then keeps failing after retrying the next one
+    """
+    monkeypatch.setattr(cli, "setup_settings", lambda: None)
+    monkeypatch.setattr(cli, "load_profiles", lambda: [])
+    monkeypatch.setattr(api, "ensure_settings", lambda: None)
+    monkeypatch.setattr(api, "download_book", _download_book_mock)
+    monkeypatch.setattr(pool.time, "sleep", lambda _: None)
+    monkeypatch.setattr("getpass.getpass", _getpass_mock)
+    attempts: list[int] = []
+
+    def _send_book(book_id: int, *_: object) -> bool:
+        attempts.append(book_id)
+        if book_id == 1234:
+            raise smtplib.SMTPDataError(552, "message too big")
+        raise smtplib.SMTPServerDisconnected("connection dropped")
+
+    monkeypatch.setattr(api, "send_book", _send_book)
+
+    with patch.object(
+        sys, "argv", ["gutenberg2kindle", "send", "--book-id", "1234", "5678", "9101"]
+    ):
+        with pytest.raises(SystemExit, match="1"):
+            cli.main()
+        out, _ = capfd.readouterr()
+        assert out == (
+            "Please enter your SMTP password: \n"
+            "Sending book `1234`...\n"
+            "Book `1234` was rejected by the SMTP server: (552, 'message too big')\n"
+            "Sending book `5678`...\n"
+            "SMTP server is unavailable, please try again later.\n"
+            "Server error message: connection dropped\n"
         )
+    assert attempts == [1234, 5678, 5678, 5678]
 
 
 def test_main_send_handler_if_email_is_sent(
@@ -299,10 +378,11 @@ def test_main_send_handler_if_email_is_sent(
     successfully
     """
     monkeypatch.setattr(cli, "setup_settings", lambda: None)
-    monkeypatch.setattr(cli, "download_book", lambda _: BytesIO(b"book content"))
+    monkeypatch.setattr(api, "ensure_settings", lambda: None)
+    monkeypatch.setattr(api, "download_book", _download_book_mock)
     monkeypatch.setattr("getpass.getpass", _getpass_mock)
 
-    monkeypatch.setattr(cli, "send_book", lambda *_: True)
+    monkeypatch.setattr(api, "send_book", lambda *_: True)
     with patch.object(
         sys,
         "argv",
@@ -359,10 +439,11 @@ def test_main_send_handler_max_file_size_limit(
     reach the `send_book` function.
     """
     monkeypatch.setattr(cli, "setup_settings", lambda: None)
-    monkeypatch.setattr(cli, "download_book", lambda _: BytesIO(b"book content"))
+    monkeypatch.setattr(api, "ensure_settings", lambda: None)
+    monkeypatch.setattr(api, "download_book", _download_book_mock)
     monkeypatch.setattr("getpass.getpass", _getpass_mock)
 
-    monkeypatch.setattr(cli, "send_book", lambda book_id, *_: book_id != 5678)
+    monkeypatch.setattr(api, "send_book", lambda book_id, *_: book_id != 5678)
 
     # multiple books at once
     with patch.object(
@@ -377,7 +458,8 @@ def test_main_send_handler_max_file_size_limit(
             "9876",
         ],
     ):
-        cli.main()
+        with pytest.raises(SystemExit, match="3"):
+            cli.main()
         out, _ = capfd.readouterr()
         assert out == (
             "Please enter your SMTP password: \n"
@@ -389,3 +471,606 @@ def test_main_send_handler_max_file_size_limit(
             "Book `9876` sent!\n"
             "2 books sent successfully!\n"
         )
+
+
+def test_main_send_handler_compacts_oversized_books(
+    monkeypatch: pytest.MonkeyPatch, capfd: pytest.CaptureFixture
+) -> None:
+    """
+    Unit tests for the `send` handler of the CLI when books over the size
+    limit are compacted before being sent
+    """
+    monkeypatch.setattr(cli, "setup_settings", lambda: None)
+    monkeypatch.setattr(api, "ensure_settings", lambda: None)
+    monkeypatch.setattr(api, "download_book", lambda *_: BytesIO(b"big book content"))
+    monkeypatch.setattr("getpass.getpass", _getpass_mock)
+    monkeypatch.setattr(api, "ProcessPoolExecutor", ThreadPoolExecutor)
+    monkeypatch.setattr(api, "compact_epub", lambda content: content[4:])
+    monkeypatch.setattr(
+        api,
+        "is_valid_file_size",
+        lambda book, _=None: book.getvalue() != b"big book content",
+    )
+    monkeypatch.setattr(api, "send_book", lambda *_: True)
+
+    with patch.object(
+        sys, "argv", ["gutenberg2kindle", "send", "--compact", "--book-id", "1234"]
+    ):
+        cli.main()
+        out, _ = capfd.readouterr()
+        assert out == (
+            "Please enter your SMTP password: \n"
+            "Compacting book `1234`...\n"
+            "Sending book `1234`...\n"
+            "Book `1234` sent!\n"
+        )
+
+
+def test_main_send_handler_splits_oversized_books(
+    monkeypatch: pytest.MonkeyPatch, capfd: pytest.CaptureFixture
+) -> None:
+    """
+    Unit tests for the `send` handler of the CLI when books over the size
+    limit are split into volumes
+    """
+    monkeypatch.setattr(cli, "setup_settings", lambda: None)
+    monkeypatch.setattr(api, "ensure_settings", lambda: None)
+    monkeypatch.setattr(api, "download_book", lambda *_: BytesIO(b"big book content"))
+    monkeypatch.setattr("getpass.getpass", _getpass_mock)
+    monkeypatch.setattr(api, "is_valid_file_size", lambda *_: False)
+    monkeypatch.setattr(api, "get_size_limit_in_bytes", lambda _=None: 10)
+    monkeypatch.setattr(
+        api,
+        "split_epub",
+        lambda *_: iter([Volume(1, 2, b"first"), Volume(2, 2, b"second")]),
+    )
+
+    filenames: list[Optional[str]] = []
+
+    def _send_book(
+        _book_id: int,
+        _book: BytesIO,
+        _password: str,
+        filename: Optional[str],
+        *_: object,
+    ) -> bool:
+        filenames.append(filename)
+        return True
+
+    monkeypatch.setattr(api, "send_book", _send_book)
+
+    with patch.object(
+        sys, "argv", ["gutenberg2kindle", "send", "--split", "--book-id", "1234"]
+    ):
+        cli.main()
+        out, _ = capfd.readouterr()
+        assert out == (
+            "Please enter your SMTP password: \n"
+            "Sending book `1234` (volume 1 of 2)...\n"
+            "Sending book `1234` (volume 2 of 2)...\n"
+            "Book `1234` sent in 2 volumes!\n"
+        )
+        assert filenames == ["1234_1.epub", "1234_2.epub"]
+
+
+def test_main_send_handler_skips_identical_books(
+    monkeypatch: pytest.MonkeyPatch, capfd: pytest.CaptureFixture
+) -> None:
+    """
+    Unit tests for the `send` handler of the CLI when two book IDs
+    have identical content
+    """
+    monkeypatch.setattr(cli, "setup_settings", lambda: None)
+    monkeypatch.setattr(api, "ensure_settings", lambda: None)
+    monkeypatch.setattr(api, "download_book", lambda *_: BytesIO(b"same content"))
+    monkeypatch.setattr("getpass.getpass", _getpass_mock)
+    monkeypatch.setattr(api, "send_book", lambda *_: True)
+
+    with patch.object(
+        sys, "argv", ["gutenberg2kindle", "send", "--book-id", "1234", "5678"]
+    ):
+        cli.main()
+        out, _ = capfd.readouterr()
+        assert out == (
+            "Please enter your SMTP password: \n"
+            "Sending book `1234`...\n"
+            "Book `1234` sent!\n"
+            "Book `5678` is identical to book `1234`, skipping...\n"
+        )
+
+
+def test_main_prefetch_handler(
+    monkeypatch: pytest.MonkeyPatch, capfd: pytest.CaptureFixture
+) -> None:
+    """Unit tests for the `prefetch` handler of the CLI"""
+    monkeypatch.setattr(cli, "setup_settings", lambda: None)
+    monkeypatch.setattr(
+        cli,
+        "prefetch_book",
+        lambda book_id, **_: None if book_id == 5678 else 2097152,
+    )
+
+    # a cache directory is required
+    with patch.object(sys, "argv", ["gutenberg2kindle", "prefetch", "-b", "1234"]):
+        with pytest.raises(SystemExit, match="1"):
+            cli.main()
+        out, _ = capfd.readouterr()
+        assert out == "Please specify a cache directory with the `--cache-dir` flag\n"
+
+    with patch.object(
+        sys,
+        "argv",
+        ["gutenberg2kindle", "prefetch", "--cache-dir", "cache", "-b", "1234", "9876"],
+    ):
+        cli.main()
+        out, _ = capfd.readouterr()
+        assert out.startswith(
+            "Book `1234` prefetched (2 MB)\n"
+            "Book `9876` prefetched (2 MB)\n"
+            "Prefetched 2 of 2 books (4 MB) in "
+        )
+
+    with patch.object(
+        sys,
+        "argv",
+        ["gutenberg2kindle", "prefetch", "--cache-dir", "cache", "-b", "1234", "5678"],
+    ):
+        with pytest.raises(SystemExit, match="3"):
+            cli.main()
+        out, _ = capfd.readouterr()
+        assert out.startswith(
+            "Book `1234` prefetched (2 MB)\n"
+            "Book `5678` could not be prefetched!\n"
+            "Prefetched 1 of 2 books (2 MB) in "
+        )
+
+
+def test_main_send_handler_with_sender_profiles(
+    monkeypatch: pytest.MonkeyPatch, capfd: pytest.CaptureFixture
+) -> None:
+    """
+    Unit tests for the `send` handler of the CLI when several sender
+    profiles are configured and one of them fails
+    """
+    profiles = [
+        SmtpProfile("main", "smtp.main.test", "main@example.org"),
+        SmtpProfile("backup", "smtp.backup.test", "backup@example.org"),
+    ]
+    monkeypatch.setattr(cli, "setup_settings", lambda: None)
+    monkeypatch.setattr(cli, "load_profiles", lambda: profiles)
+    monkeypatch.setattr(pool, "load_profiles", lambda _=None: profiles)
+    monkeypatch.setattr(pool, "get_config", lambda *_: config.STRATEGY_ROUND_ROBIN)
+    monkeypatch.setattr(api, "ensure_settings", lambda: None)
+    monkeypatch.setattr(api, "download_book", _download_book_mock)
+    monkeypatch.setattr("getpass.getpass", _getpass_mock)
+
+    def _send_book(*args: Any) -> bool:
+        if args[4].profile.name == "main":
+            raise smtplib.SMTPAuthenticationError(535, "invalid credentials")
+        return True
+
+    monkeypatch.setattr(api, "send_book", _send_book)
+
+    with patch.object(
+        sys, "argv", ["gutenberg2kindle", "send", "--book-id", "1234", "5678"]
+    ):
+        cli.main()
+        out, _ = capfd.readouterr()
+        assert out == (
+            "Please enter the SMTP password for profile `main`: \n"
+            "Please enter the SMTP password for profile `backup`: \n"
+            "Sending book `1234`...\n"
+            "Book `1234` sent!\n"
+            "Sending book `5678`...\n"
+            "Book `5678` sent!\n"
+            "2 books sent successfully!\n"
+            "Profile `main`: 0 emails sent (0 MB), 1 failures "
+            "(out of rotation: (535, 'invalid credentials'))\n"
+            "Profile `backup`: 2 emails sent (1 MB), 0 failures (active)\n"
+        )
+
+
+@pytest.mark.usefixtures("default_settings")
+def test_main_send_handler_spools_books_and_flush_handler(
+    monkeypatch: pytest.MonkeyPatch, capfd: pytest.CaptureFixture, tmp_path: Path
+) -> None:
+    """
+    Unit tests for the `send` handler of the CLI when books are written
+    to the spool, and for the `flush` handler that emails them afterwards
+    """
+    monkeypatch.setattr(cli, "setup_settings", lambda: None)
+    monkeypatch.setattr(cli, "load_profiles", lambda: [])
+    monkeypatch.setattr(api, "ensure_settings", lambda: None)
+    monkeypatch.setattr(api, "download_book", _download_book_mock)
+    monkeypatch.setattr(api, "is_valid_file_size", lambda *_: True)
+    monkeypatch.setattr("getpass.getpass", _getpass_mock)
+    monkeypatch.setattr(api, "send_book", lambda book_id, *_: book_id != 5678)
+
+    with patch.object(sys, "argv", ["gutenberg2kindle", "flush"]):
+        with pytest.raises(SystemExit, match="1"):
+            cli.main()
+        out, _ = capfd.readouterr()
+        assert out == "Please specify a spool directory with the `--spool` flag\n"
+
+    with patch.object(
+        sys,
+        "argv",
+        ["gutenberg2kindle", "send", "--spool", str(tmp_path), "-b", "1234", "5678"],
+    ):
+        cli.main()
+        out, _ = capfd.readouterr()
+        assert out == (
+            "Spooling book `1234`...\n"
+            "Book `1234` spooled!\n"
+            "Spooling book `5678`...\n"
+            "Book `5678` spooled!\n"
+            "2 books spooled successfully!\n"
+        )
+
+    with patch.object(
+        sys, "argv", ["gutenberg2kindle", "flush", "--spool", str(tmp_path), "-w", "1"]
+    ):
+        with pytest.raises(SystemExit, match="3"):
+            cli.main()
+        out, _ = capfd.readouterr()
+        assert out == (
+            "Please enter your SMTP password: \n"
+            "Sending book `1234`...\n"
+            "Book `1234` sent!\n"
+            "Sending book `5678`...\n"
+            "Book `5678` could not be sent, please check its file size.\n"
+            "Flushed 1 of 2 books from the spool\n"
+        )
+
+    # once the credentials are found to be invalid, no other book is tried
+    def _send_book(*_: object) -> bool:
+        raise smtplib.SMTPAuthenticationError(535, "bad login")
+
+    monkeypatch.setattr(api, "send_book", _send_book)
+    Spool(str(tmp_path)).add(9101, b"book content 9101")
+    with patch.object(
+        sys, "argv", ["gutenberg2kindle", "flush", "--spool", str(tmp_path), "-w", "1"]
+    ):
+        with pytest.raises(SystemExit, match="1"):
+            cli.main()
+        out, _ = capfd.readouterr()
+        assert out == (
+            "Please enter your SMTP password: \n"
+            "Sending book `5678`...\n"
+            "Book `5678` could not be sent, keeping it in the spool: "
+            "(535, 'bad login')\n"
+            "Book `9101` was kept in the spool, as no SMTP profile is left to send it\n"
+            "Flushed 0 of 2 books from the spool\n"
+        )
+
+
+@pytest.mark.usefixtures("default_settings")
+def test_main_check_handler(
+    monkeypatch: pytest.MonkeyPatch, capfd: pytest.CaptureFixture
+) -> None:
+    """Unit tests for the `check` handler of the CLI"""
+    monkeypatch.setattr(cli, "setup_settings", lambda: None)
+    monkeypatch.setattr(cli, "load_profiles", lambda: [])
+    monkeypatch.setattr("getpass.getpass", _getpass_mock)
+    checks = [
+        CheckResult(CHECK_GUTENBERG, 0.123),
+        CheckResult(CHECK_SMTP, 0.5, "default"),
+    ]
+    monkeypatch.setattr(api, "run_checks", lambda *_: checks)
+
+    with patch.object(sys, "argv", ["gutenberg2kindle", "check"]):
+        cli.main()
+        out, _ = capfd.readouterr()
+        assert out == (
+            "Please enter your SMTP password: \n"
+            "Project Gutenberg: OK (0.12 seconds)\n"
+            "SMTP profile `default`: OK (0.50 seconds)\n"
+        )
+
+    checks[1].error = "(535, 'invalid credentials')"
+    with patch.object(sys, "argv", ["gutenberg2kindle", "check"]):
+        with pytest.raises(SystemExit, match="1"):
+            cli.main()
+        out, _ = capfd.readouterr()
+        assert out.endswith(
+            "SMTP profile `default`: failed after 0.50 seconds: "
+            "(535, 'invalid credentials')\n"
+        )
+
+
+@pytest.mark.usefixtures("default_settings")
+def test_main_send_handler_with_claims_and_report_handler(
+    monkeypatch: pytest.MonkeyPatch, capfd: pytest.CaptureFixture, tmp_path: Path
+) -> None:
+    """
+    Unit tests for the `send` handler of the CLI when books are claimed from
+    a shared directory, and for the `report` handler that merges the results
+    """
+    monkeypatch.setattr(cli, "setup_settings", lambda: None)
+    monkeypatch.setattr(cli, "load_profiles", lambda: [])
+    monkeypatch.setattr(api, "ensure_settings", lambda: None)
+    monkeypatch.setattr(api, "download_book", _download_book_mock)
+    monkeypatch.setattr("getpass.getpass", lambda _: "m0ck-p4ssw0rd")
+    monkeypatch.setattr(api, "send_book", lambda book_id, *_: book_id != 5678)
+
+    with patch.object(sys, "argv", ["gutenberg2kindle", "report"]):
+        with pytest.raises(SystemExit, match="1"):
+            cli.main()
+        out, _ = capfd.readouterr()
+        assert out == (
+            "Please specify a claim directory with the `--claim-dir` flag, "
+            "or reports to merge with the `--merge` flag\n"
+        )
+
+    # another process already claimed the first book
+    ClaimDirectory(str(tmp_path)).claim(1234)
+    with patch.object(
+        sys,
+        "argv",
+        ["gutenberg2kindle", "send", "--claim-dir", str(tmp_path), "-b"]
+        + ["1234", "5678", "9101"],
+    ):
+        with pytest.raises(SystemExit, match="3"):
+            cli.main()
+        out, _ = capfd.readouterr()
+        assert out == (
+            "Sending book `5678`...\n"
+            "Book `5678` could not be sent, please check its file size.\n"
+            "Sending book `9101`...\n"
+            "Book `9101` sent!\n"
+        )
+
+    with patch.object(
+        sys, "argv", ["gutenberg2kindle", "report", "--claim-dir", str(tmp_path)]
+    ):
+        with pytest.raises(SystemExit, match="3"):
+            cli.main()
+        out, _ = capfd.readouterr()
+        assert out == (
+            "Book `5678` could not be sent, please check its file size.\n"
+            "Book `9101` sent!\n"
+            "1 of 2 books sent successfully\n"
+        )
+
+    # the report of another shard, where the failed book was sent after all
+    shard_report = tmp_path / "shard.json"
+    write_report(str(shard_report), "json", [BookResult(5678, STATUS_SENT, 100)])
+    with patch.object(
+        sys,
+        "argv",
+        ["gutenberg2kindle", "report", "--claim-dir", str(tmp_path), "--merge"]
+        + [str(shard_report)],
+    ):
+        cli.main()
+        out, _ = capfd.readouterr()
+        assert out == (
+            "Book `5678` sent!\n"
+            "Book `9101` sent!\n"
+            "2 of 2 books sent successfully\n"
+        )
+
+    with patch.object(
+        sys, "argv", ["gutenberg2kindle", "report", "--merge", str(tmp_path / "none")]
+    ):
+        with pytest.raises(SystemExit, match="1"):
+            cli.main()
+        out, _ = capfd.readouterr()
+        assert out.startswith("Could not read the reports to merge: ")
+
+    with patch.object(
+        sys, "argv", ["gutenberg2kindle", "send", "--shard", "4/4", "-b", "1234"]
+    ):
+        with pytest.raises(SystemExit, match="2"):
+            cli.main()
+        _, err = capfd.readouterr()
+        assert "4/4 is not a shard, its index must be under 4" in err
+
+
+@pytest.mark.usefixtures("default_settings")
+def test_main_send_handler_releases_unsent_claims(
+    monkeypatch: pytest.MonkeyPatch, capfd: pytest.CaptureFixture, tmp_path: Path
+) -> None:
+    """
+    Unit test to check that the books claimed by a batch that stopped on an
+    error, but not sent, can be claimed again right away
+    """
+    monkeypatch.setattr(cli, "setup_settings", lambda: None)
+    monkeypatch.setattr(cli, "load_profiles", lambda: [])
+    monkeypatch.setattr(api, "ensure_settings", lambda: None)
+    monkeypatch.setattr(api, "download_book", _download_book_mock)
+    monkeypatch.setattr("getpass.getpass", lambda _: "m0ck-p4ssw0rd")
+
+    def _send_book(book_id: int, *_: Any) -> bool:
+        if book_id == 5678:
+            raise smtplib.SMTPAuthenticationError(535, "smtp error!")
+        return True
+
+    monkeypatch.setattr(api, "send_book", _send_book)
+
+    book_ids = ["1234", "5678", "9101", "1121", "3141"]
+    with patch.object(
+        sys,
+        "argv",
+        ["gutenberg2kindle", "send", "--claim-dir", str(tmp_path), "-b"] + book_ids,
+    ):
+        with pytest.raises(SystemExit, match="3"):
+            cli.main()
+        capfd.readouterr()
+
+    # the results of the books that were reached are kept
+    other = ClaimDirectory(str(tmp_path))
+    assert not other.claim(1234) and not other.claim(5678)
+    assert all(other.claim(int(book_id)) for book_id in book_ids[2:])
+
+
+@pytest.mark.usefixtures("default_settings")
+def test_main_send_handler_writes_report(
+    monkeypatch: pytest.MonkeyPatch, capfd: pytest.CaptureFixture, tmp_path: Path
+) -> None:
+    """
+    Unit tests for the report of the `send` handler of the CLI, where books
+    that were never reached are reported as skipped
+    """
+    monkeypatch.setattr(cli, "setup_settings", lambda: None)
+    monkeypatch.setattr(cli, "load_profiles", lambda: [])
+    monkeypatch.setattr(api, "download_book", _download_book_mock)
+    monkeypatch.setattr("getpass.getpass", lambda _: "m0ck-p4ssw0rd")
+
+    def _send_book(book_id: int, *_: object) -> bool:
+        if book_id == 5678:
+            raise smtplib.SMTPAuthenticationError(535, "smtp error!")
+        return True
+
+    monkeypatch.setattr(api, "send_book", _send_book)
+    path = tmp_path / "report.json"
+
+    with patch.object(
+        sys,
+        "argv",
+        ["gutenberg2kindle", "send", "--report", "json", str(path), "-b"]
+        + ["1234", "5678", "9101"],
+    ):
+        with pytest.raises(SystemExit, match="3"):
+            cli.main()
+
+    content = json.loads(path.read_text())
+    assert content["summary"]["outcome"] == "partial_success"
+    assert [
+        (book["book_id"], book["status"], book["error_type"])
+        for book in content["books"]
+    ] == [
+        (1234, "sent", None),
+        (5678, "smtp_error", "SMTPAuthenticationError"),
+        (9101, "skipped", None),
+    ]
+    assert content["books"][0]["recipient"] == config.get_config("kindle_email")
+
+    with patch.object(
+        sys, "argv", ["gutenberg2kindle", "send", "--report", "xml", str(path)]
+    ):
+        with pytest.raises(SystemExit, match="2"):
+            cli.main()
+        _, err = capfd.readouterr()
+        assert "argument --report: invalid format 'xml'" in err
+
+
+@pytest.mark.usefixtures("default_settings")
+def test_main_watch_handler(
+    monkeypatch: pytest.MonkeyPatch, capfd: pytest.CaptureFixture, tmp_path: Path
+) -> None:
+    """Unit tests for the `watch` handler of the CLI, polling only once"""
+    monkeypatch.setattr(cli, "setup_settings", lambda: None)
+    monkeypatch.setattr(cli, "load_profiles", lambda: [])
+    monkeypatch.setattr(api, "download_book", _download_book_mock)
+    monkeypatch.setattr(api, "send_book", lambda *_: True)
+    monkeypatch.setattr("getpass.getpass", lambda _: "m0ck-p4ssw0rd")
+    config.set_config(config.SETTINGS_WATCH_AUTHORS, "Melville")
+
+    feed_path = tmp_path / "today.rss"
+    item = (
+        "<item><title>{title}</title>"
+        "<link>https://www.gutenberg.org/ebooks/{book_id}</link></item>"
+    )
+    argv = [
+        "gutenberg2kindle",
+        "watch",
+        "--once",
+        "--feed",
+        str(feed_path),
+        "--watch-state",
+        str(tmp_path / "state.json"),
+    ]
+
+    for items in ([(1, "Typee by Melville")], [(2, "Emma by Austen")]):
+        feed_path.write_text(
+            "<rss><channel>"
+            + "".join(item.format(book_id=b, title=t) for b, t in items)
+            + "</channel></rss>",
+            encoding="utf-8",
+        )
+        with patch.object(sys, "argv", argv):
+            cli.main()
+
+    feed_path.write_text(
+        "<rss><channel>"
+        + item.format(book_id=3, title="Moby Dick by Melville")
+        + item.format(book_id=4, title="Persuasion by Austen")
+        + "</channel></rss>",
+        encoding="utf-8",
+    )
+    with patch.object(sys, "argv", argv):
+        cli.main()
+    out, _ = capfd.readouterr()
+    assert out == (
+        "Found 1 new releases, 0 matching the filters\n"
+        "Found 2 new releases, 1 matching the filters\n"
+        "Sending book `3`...\n"
+        "Book `3` sent!\n"
+    )
+
+    with patch.object(sys, "argv", argv):
+        feed_path.write_text("<rss>", encoding="utf-8")
+        with pytest.raises(SystemExit, match="1"):
+            cli.main()
+    out, _ = capfd.readouterr()
+    assert out.startswith("Could not poll the feed of new releases: Invalid feed")
+
+
+@pytest.mark.usefixtures("default_settings")
+def test_main_watch_handler_keeps_watching(
+    monkeypatch: pytest.MonkeyPatch, capfd: pytest.CaptureFixture, tmp_path: Path
+) -> None:
+    """
+    Unit test to check that the `watch` handler keeps watching when books
+    can't be sent, and that they're polled again in the next poll
+    """
+    monkeypatch.setattr(cli, "setup_settings", lambda: None)
+    monkeypatch.setattr(cli, "load_profiles", lambda: [])
+    monkeypatch.setattr(api, "download_book", _download_book_mock)
+    monkeypatch.setattr("getpass.getpass", lambda _: "m0ck-p4ssw0rd")
+    config.set_config(config.SETTINGS_WATCH_AUTHORS, "Melville")
+
+    def _send_book(*_: object) -> bool:
+        raise smtplib.SMTPAuthenticationError(535, "bad login")
+
+    def _sleep(_: float) -> None:
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(api, "send_book", _send_book)
+    monkeypatch.setattr(cli.time, "sleep", _sleep)
+
+    feed_path = tmp_path / "today.rss"
+    argv = [
+        "gutenberg2kindle",
+        "watch",
+        "--feed",
+        str(feed_path),
+        "--watch-state",
+        str(tmp_path / "state.json"),
+    ]
+
+    # the first poll only records where the feed stands
+    feed_path.write_text(
+        "<rss><channel><item><title>Emma by Austen</title>"
+        "<link>https://www.gutenberg.org/ebooks/1</link></item></channel></rss>",
+        encoding="utf-8",
+    )
+    with patch.object(sys, "argv", argv + ["--once"]):
+        cli.main()
+
+    feed_path.write_text(
+        "<rss><channel><item><title>Typee by Melville</title>"
+        "<link>https://www.gutenberg.org/ebooks/2</link></item></channel></rss>",
+        encoding="utf-8",
+    )
+    with patch.object(sys, "argv", argv):
+        cli.main()
+    out, _ = capfd.readouterr()
+    assert "Could not send the new releases, they'll be polled again\n" in out
+    assert out.endswith("Stopping...\n")
+
+    monkeypatch.setattr(api, "send_book", lambda *_: True)
+    with patch.object(sys, "argv", argv + ["--once"]):
+        cli.main()
+    out, _ = capfd.readouterr()
+    assert "Book `2` sent!\n" in out
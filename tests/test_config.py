@@ -1,5 +1,6 @@
 """Unit tests for the auxiliary module that handles configuration values"""
 
+import json
 import random
 from datetime import datetime
 from io import StringIO
@@ -42,6 +43,10 @@ def test_get_config(monkeypatch: pytest.MonkeyPatch) -> None:
         config.SETTINGS_KINDLE_EMAIL: "",
         config.SETTINGS_FORMAT: config.FORMAT_AUTO,
         config.SETTINGS_SIZE_LIMIT_IN_MB: config.DEFAULT_MAX_SIZE_IN_MB,
+        config.SETTINGS_SMTP_PROFILES: "",
+        config.SETTINGS_SMTP_STRATEGY: config.STRATEGY_ROUND_ROBIN,
+        config.SETTINGS_WATCH_AUTHORS: "",
+        config.SETTINGS_WATCH_SUBJECTS: "",
     }
 
 
@@ -55,6 +60,9 @@ def test_set_config(monkeypatch: pytest.MonkeyPatch) -> None:
     with pytest.raises(ValueError, match="`pokemon` is not a valid format"):
         config.set_config(config.SETTINGS_FORMAT, "pokemon")
 
+    with pytest.raises(ValueError, match="`0` is not a valid size limit"):
+        config.set_config(config.SETTINGS_SIZE_LIMIT_IN_MB, "0")
+
     config.settings.add_setting(config.SETTINGS_SMTP_SERVER, str, "")
     config.settings.load_settings()
 
@@ -62,6 +70,10 @@ def test_set_config(monkeypatch: pytest.MonkeyPatch) -> None:
     config.set_config(config.SETTINGS_SMTP_SERVER, "mail.example.org")
     assert config.get_config(config.SETTINGS_SMTP_SERVER) == "mail.example.org"
 
+    # the size limit is read as an integer, even if given as text
+    config.set_config(config.SETTINGS_SIZE_LIMIT_IN_MB, "25")
+    assert config.get_config(config.SETTINGS_SIZE_LIMIT_IN_MB) == 25
+
 
 def test_setup_settings(monkeypatch: pytest.MonkeyPatch) -> None:
     """Unit tests for the function that boots up settings"""
@@ -105,4 +117,58 @@ def test_interactive_config(monkeypatch: pytest.MonkeyPatch) -> None:
         "kindle_email": "kindle@example.org",
         "format": "no_images",
         "size_limit_in_mb": 15,
+        "smtp_profiles": "",
+        "smtp_strategy": "round_robin",
+        "watch_authors": "",
+        "watch_subjects": "",
     }
+
+
+def test_resolve_config(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Unit tests for resolving the settings with some of them overridden,
+    without changing the stored ones
+    """
+    monkeypatch.setattr(config, "settings", _generate_new_settings_instance())
+    config.setup_settings()
+    config.settings[config.SETTINGS_SMTP_SERVER] = "smtp.test"
+
+    with pytest.raises(ValueError, match="`pokemon` is not a valid setting name"):
+        config.resolve_config({"pokemon": 151})
+
+    resolved = config.resolve_config(
+        {
+            config.SETTINGS_SMTP_SERVER: "smtp.other",
+            config.SETTINGS_SIZE_LIMIT_IN_MB: "5",
+        }
+    )
+    assert config.get_config(config.SETTINGS_SMTP_SERVER, resolved) == "smtp.other"
+    assert config.get_config(config.SETTINGS_SIZE_LIMIT_IN_MB, resolved) == 5
+    assert resolved[config.SETTINGS_FORMAT] == config.FORMAT_AUTO
+    assert config.resolve_config() == config.get_config()
+
+    assert config.get_config(config.SETTINGS_SMTP_SERVER) == "smtp.test"
+    assert config.get_config(config.SETTINGS_SIZE_LIMIT_IN_MB) == 15
+
+
+def test_parse_smtp_profiles() -> None:
+    """Unit tests for the validation of the SMTP sender profiles setting"""
+
+    profile = {"name": "main", "smtp_server": "smtp.test", "sender_email": "a@b.c"}
+    assert config.parse_smtp_profiles(json.dumps([profile])) == [profile]
+
+    invalid_profiles = {
+        "{": "SMTP profiles are not valid JSON",
+        json.dumps(profile): "SMTP profiles must be a list of objects",
+        json.dumps([{**profile, "pokemon": 151}]): "`pokemon` is not a valid",
+        json.dumps([{**profile, "weight": 0}]): "`weight` must be a positive integer",
+        json.dumps([{**profile, "limit": "1"}]): "`limit` must be of type `int`",
+        json.dumps([{"name": "main"}]): "missing the `smtp_server` field",
+        json.dumps([profile, profile]): "`main` is defined twice",
+    }
+    for value, message in invalid_profiles.items():
+        with pytest.raises(ValueError, match=message):
+            config.validate_setting(config.SETTINGS_SMTP_PROFILES, value)
+
+    with pytest.raises(ValueError, match="`random` is not a valid strategy"):
+        config.validate_setting(config.SETTINGS_SMTP_STRATEGY, "random")
@@ -1,10 +1,16 @@
 """Unit tests for the email helper module"""
 
+import os
+import smtplib
+from email import message_from_bytes
 from io import BytesIO
+from pathlib import Path
+from typing import Any
 
 import pytest
 
 from gutenberg2kindle import email
+from gutenberg2kindle.config import SETTINGS_SIZE_LIMIT_IN_MB, resolve_config
 
 
 def test_create_base_email() -> None:
@@ -41,10 +47,317 @@ def test_is_valid_file_size(monkeypatch: pytest.MonkeyPatch) -> None:
     """Unit test to check if the function that checks the file size works properly"""
 
     # setting up config
-    monkeypatch.setattr(email, "get_config", lambda _: 10)
+    monkeypatch.setattr(email, "get_config", lambda *_: 10)
 
     # testing with a file that is too big
     assert not email.is_valid_file_size(BytesIO(b"0" * 10485761))
 
     # testing with a file that is small enough
     assert email.is_valid_file_size(BytesIO(b"0" * 1048576))
+
+
+@pytest.mark.usefixtures("default_settings")
+def test_is_valid_file_size_with_settings() -> None:
+    """
+    Unit test to check the file size against the size limit in the settings,
+    as stored or overridden, without mocking them
+    """
+
+    book = BytesIO(b"0" * (2 * 1024 * 1024))
+    assert email.get_size_limit_in_bytes() == 15 * 1024 * 1024
+    assert email.is_valid_file_size(book)
+
+    overridden = resolve_config({SETTINGS_SIZE_LIMIT_IN_MB: "1"})
+    assert email.get_size_limit_in_bytes(overridden) == 1024 * 1024
+    assert not email.is_valid_file_size(book, overridden)
+    assert email.is_valid_file_size(book)
+
+
+def test_get_size_limit_in_bytes(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Unit test for the function that returns the size limit in bytes"""
+
+    monkeypatch.setattr(email, "get_config", lambda *_: 10)
+    assert email.get_size_limit_in_bytes() == 10485760
+
+
+class SMTPMock:
+    """Wrapper to mock an SMTP connection during unit tests"""
+
+    instances: list["SMTPMock"] = []
+    sock = None
+
+    def __init__(self, *address: Any) -> None:
+        self.address = address
+        self.sent: list[str] = []
+        self.closed = False
+        self.instances.append(self)
+
+    def starttls(self, **_: Any) -> None:
+        """Mocks upgrading the connection to TLS"""
+
+    def login(self, *_: Any) -> None:
+        """Mocks logging in"""
+
+    def sendmail(self, _sender: str, _recipient: str, text: str) -> None:
+        """Mocks sending an email, failing if the connection was closed"""
+        if self.closed:
+            raise smtplib.SMTPServerDisconnected("closed")
+        self.sent.append(text)
+
+    def noop(self) -> tuple[int, bytes]:
+        """Mocks checking the connection, failing if it was closed"""
+        if self.closed:
+            raise smtplib.SMTPServerDisconnected("closed")
+        return 250, b"ok"
+
+    def quit(self) -> None:
+        """Mocks closing the connection"""
+        self.closed = True
+
+    def close(self) -> None:
+        """Mocks closing the connection"""
+        self.closed = True
+
+
+class DataSMTPMock(SMTPMock):
+    """Wrapper to mock an SMTP connection that emails are streamed to"""
+
+    def __init__(self, *address: Any) -> None:
+        super().__init__(*address)
+        self.data = b""
+        self.commands: list[str] = []
+        self.replies = [(354, b"go ahead"), (250, b"queued")]
+        self.rcpt_reply = (250, b"ok")
+
+    def ehlo_or_helo_if_needed(self) -> None:
+        """Mocks greeting the server"""
+
+    def mail(self, sender: str) -> tuple[int, bytes]:
+        """Mocks starting a mail transaction, failing if the connection was closed"""
+        if self.closed:
+            raise smtplib.SMTPServerDisconnected("closed")
+        self.commands.append(f"mail {sender}")
+        return 250, b"ok"
+
+    def rcpt(self, recipient: str) -> tuple[int, bytes]:
+        """Mocks adding a recipient"""
+        self.commands.append(f"rcpt {recipient}")
+        return self.rcpt_reply
+
+    def putcmd(self, command: str) -> None:
+        """Mocks sending a command"""
+        self.commands.append(command)
+
+    def getreply(self) -> tuple[int, bytes]:
+        """Mocks reading the reply to a command"""
+        return self.replies.pop(0)
+
+    def send(self, data: bytes) -> None:
+        """Mocks writing raw data to the connection"""
+        self.data += data
+
+    def rset(self) -> None:
+        """Mocks resetting the mail transaction"""
+        self.commands.append("rset")
+
+
+def get_attachment(data: bytes) -> Any:
+    """Returns the attachment of an email with a book attached"""
+
+    parts: Any = message_from_bytes(data).get_payload()
+    return parts[1]
+
+
+def test_iter_email_data(tmp_path: Path) -> None:
+    """
+    Unit test to check that an email with a book mapped from disk is
+    produced chunk by chunk, ready to be sent as SMTP DATA
+    """
+
+    content = os.urandom(email.ATTACHMENT_CHUNK_BYTES * 2 + 1000)
+    path = tmp_path / "1234.epub"
+    path.write_bytes(content)
+
+    with email.map_book(str(path)) as book:
+        chunks = list(
+            email.iter_email_data("sender@example.org", "kindle", book, "1234.epub")
+        )
+
+    # the head, two full chunks, the rest of the book and the tail
+    assert len(chunks) == 5
+    data = b"".join(chunks)
+    assert b"\n" not in data.replace(b"\r\n", b"")
+    assert max(map(len, data.split(b"\r\n"))) <= 78
+
+    assert message_from_bytes(data)["From"] == "sender@example.org"
+    attachment = get_attachment(data)
+    assert attachment.get_filename() == "1234.epub"
+    assert attachment.get_payload(decode=True) == content
+
+    (tmp_path / "empty.epub").write_bytes(b"")
+    with pytest.raises(ValueError, match="Could not map"):
+        with email.map_book(str(tmp_path / "empty.epub")):
+            pass
+
+
+def test_send_book_from_disk(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    """
+    Unit test to check that a book on disk is streamed to the server,
+    again over a new connection if the previous one was dropped
+    """
+
+    monkeypatch.setattr(SMTPMock, "instances", [])
+    monkeypatch.setattr(smtplib, "SMTP", DataSMTPMock)
+    monkeypatch.setattr(
+        email,
+        "get_config",
+        lambda name, _=None: {"smtp_port": 587, "size_limit_in_mb": 1}.get(
+            name, "value"
+        ),
+    )
+    path = tmp_path / "book.epub"
+    path.write_bytes(b"book")
+
+    with email.SmtpSession("password") as session:
+        assert email.send_book(1234, str(path), "password", None, session)
+        SMTPMock.instances[0].closed = True
+        assert email.send_book(5678, str(path), "password", "5678_1.epub", session)
+
+    first, second = SMTPMock.instances[0], SMTPMock.instances[1]
+    assert isinstance(first, DataSMTPMock) and isinstance(second, DataSMTPMock)
+    assert first.commands == ["mail value", "rcpt value", "data"]
+    assert second.data.endswith(b"\r\n.\r\n")
+    attachment = get_attachment(second.data[:-3])
+    assert attachment.get_filename() == "5678_1.epub"
+    assert attachment.get_payload(decode=True) == b"book"
+
+    path.write_bytes(b"0" * 2097152)
+    assert not email.send_book(1234, str(path), "password")
+
+
+def test_stream_email_errors() -> None:
+    """
+    Unit test to check that a refused email raises the same errors as
+    `sendmail` would, resetting the transaction
+    """
+
+    server: Any = DataSMTPMock()
+    server.rcpt_reply = (550, b"no such user")
+    with pytest.raises(smtplib.SMTPRecipientsRefused):
+        email.stream_email(server, "sender", "kindle", [b"data\r\n"])
+    assert server.commands[-1] == "rset"
+
+    server = DataSMTPMock()
+    server.replies = [(354, b"go ahead"), (552, b"too big")]
+    with pytest.raises(smtplib.SMTPDataError, match="too big"):
+        email.stream_email(server, "sender", "kindle", [b"data"])
+    assert server.data == b"data\r\n.\r\n"
+    assert server.commands[-1] == "rset"
+
+
+def test_smtp_session(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Unit test to check that an SMTP session reuses its connection,
+    and reconnects if the connection was dropped
+    """
+
+    monkeypatch.setattr(SMTPMock, "instances", [])
+    monkeypatch.setattr(smtplib, "SMTP", SMTPMock)
+    monkeypatch.setattr(
+        email,
+        "get_config",
+        lambda name, _=None: 587 if name == "smtp_port" else "value",
+    )
+
+    with email.SmtpSession("password") as session:
+        session.sendmail("sender", "kindle", "first")
+        session.sendmail("sender", "kindle", "second")
+        assert len(SMTPMock.instances) == 1
+
+        SMTPMock.instances[0].closed = True
+        session.sendmail("sender", "kindle", "third")
+        assert len(SMTPMock.instances) == 2
+
+        # open connections are reused while they're alive
+        assert session.ensure_connected() is SMTPMock.instances[1]
+        SMTPMock.instances[1].closed = True
+        assert session.ensure_connected() is SMTPMock.instances[2]
+        session.sendmail("sender", "kindle", "fourth")
+
+    assert SMTPMock.instances[0].sent == ["first", "second"]
+    assert SMTPMock.instances[1].sent == ["third"]
+    assert SMTPMock.instances[2].sent == ["fourth"]
+    assert SMTPMock.instances[2].closed
+
+
+def test_send_book(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Unit test for the function that sends a book via email"""
+
+    monkeypatch.setattr(SMTPMock, "instances", [])
+    monkeypatch.setattr(smtplib, "SMTP", SMTPMock)
+    monkeypatch.setattr(
+        email,
+        "get_config",
+        lambda name, _=None: {"smtp_port": 587, "size_limit_in_mb": 1}.get(
+            name, "value"
+        ),
+    )
+
+    assert email.send_book(1234, BytesIO(b"book"), "password")
+    assert "filename=1234.epub" in SMTPMock.instances[0].sent[0]
+
+    assert not email.send_book(1234, BytesIO(b"0" * 2097152), "password")
+    assert len(SMTPMock.instances) == 1
+
+    with email.SmtpSession("password") as session:
+        assert email.send_book(1, BytesIO(b"a"), "password", "1_1.epub", session)
+        assert email.send_book(2, BytesIO(b"b"), "password", None, session)
+    assert len(SMTPMock.instances) == 2
+    assert "filename=1_1.epub" in SMTPMock.instances[1].sent[0]
+
+
+def test_send_book_with_profile(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Unit test to check that a book sent through the session of a sender
+    profile uses the profile's server and address
+    """
+
+    monkeypatch.setattr(SMTPMock, "instances", [])
+    monkeypatch.setattr(smtplib, "SMTP", SMTPMock)
+    monkeypatch.setattr(
+        email,
+        "get_config",
+        lambda name, _=None: 1 if name == "size_limit_in_mb" else "value",
+    )
+
+    profile = email.SmtpProfile("backup", "smtp.backup.test", "backup@example.org")
+    with email.SmtpSession("password", profile) as session:
+        assert session.sender_email == "backup@example.org"
+        assert email.send_book(1234, BytesIO(b"book"), "password", None, session)
+
+    assert SMTPMock.instances[0].address == ("smtp.backup.test", 465)
+    assert "From: backup@example.org" in SMTPMock.instances[0].sent[0]
+
+
+def test_classify_smtp_error() -> None:
+    """Unit tests for the classification of errors raised while sending email"""
+
+    errors = {
+        smtplib.SMTPAuthenticationError(535, "bad login"): email.SMTP_ERROR_AUTH,
+        smtplib.SMTPAuthenticationError(454, "try later"): email.SMTP_ERROR_TRANSIENT,
+        smtplib.SMTPNotSupportedError("no STARTTLS"): email.SMTP_ERROR_AUTH,
+        smtplib.SMTPDataError(552, "too big"): email.SMTP_ERROR_REJECTED,
+        smtplib.SMTPDataError(451, "try later"): email.SMTP_ERROR_TRANSIENT,
+        smtplib.SMTPSenderRefused(421, b"busy", "a@b.c"): email.SMTP_ERROR_TRANSIENT,
+        smtplib.SMTPRecipientsRefused(
+            {"a@b.c": (550, b"no such user")}
+        ): email.SMTP_ERROR_REJECTED,
+        smtplib.SMTPRecipientsRefused(
+            {"a@b.c": (450, b"mailbox busy")}
+        ): email.SMTP_ERROR_TRANSIENT,
+        smtplib.SMTPConnectError(554, "go away"): email.SMTP_ERROR_CONNECTION,
+        smtplib.SMTPServerDisconnected("dropped"): email.SMTP_ERROR_CONNECTION,
+        ConnectionRefusedError("refused"): email.SMTP_ERROR_CONNECTION,
+    }
+    for error, kind in errors.items():
+        assert email.classify_smtp_error(error) == kind, error
@@ -0,0 +1,303 @@
+"""Unit tests for the helper functions that inspect and rewrite EPUB files"""
+
+import re
+import sys
+import types
+import zipfile
+from io import BytesIO
+from typing import Optional
+
+import pytest
+
+from gutenberg2kindle import epub
+
+CONTAINER_XML = """<?xml version="1.0"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+"""
+
+OPF_TEMPLATE = """<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:title>Test book</dc:title>
+  </metadata>
+  <manifest>
+{items}
+  </manifest>
+  <spine>
+{itemrefs}
+  </spine>
+</package>
+"""
+
+
+def build_epub(
+    chapters: Optional[dict[str, bytes]] = None,
+    resources: Optional[dict[str, tuple[str, bytes]]] = None,
+) -> bytes:
+    """
+    Builds a minimal but valid EPUB with the given chapters (name to content)
+    and extra resources (name to media type and content)
+    """
+
+    chapters = chapters or {"chapter1.xhtml": b"<html>Chapter 1</html>"}
+    resources = resources or {}
+
+    items = [
+        f'    <item id="{name}" href="{name}" media-type="application/xhtml+xml"/>'
+        for name in chapters
+    ] + [
+        f'    <item id="{name}" href="{name}" media-type="{media_type}"/>'
+        for name, (media_type, _) in resources.items()
+    ]
+    itemrefs = [f'    <itemref idref="{name}"/>' for name in chapters]
+    opf = OPF_TEMPLATE.format(items="\n".join(items), itemrefs="\n".join(itemrefs))
+
+    output = BytesIO()
+    with zipfile.ZipFile(output, "w") as archive:
+        archive.writestr("mimetype", "application/epub+zip")
+        archive.writestr("META-INF/container.xml", CONTAINER_XML)
+        archive.writestr("OEBPS/content.opf", opf)
+        for name, content in chapters.items():
+            archive.writestr(f"OEBPS/{name}", content)
+        for name, (_, content) in resources.items():
+            archive.writestr(f"OEBPS/{name}", content)
+    return output.getvalue()
+
+
+def test_read_package() -> None:
+    """Unit test for the function that parses an EPUB's package document"""
+
+    book = build_epub(resources={"font.ttf": ("font/ttf", b"font")})
+    with zipfile.ZipFile(BytesIO(book)) as archive:
+        package = epub.read_package(archive)
+
+    assert package.opf_path == "OEBPS/content.opf"
+    assert package.spine == ["chapter1.xhtml"]
+    assert package.manifest["font.ttf"].path == "OEBPS/font.ttf"
+    assert package.manifest["font.ttf"].media_type == "font/ttf"
+
+
+def test_remove_manifest_items() -> None:
+    """Unit test for the function that drops items from a package document"""
+
+    opf = (
+        '<manifest>\n    <item id="a" href="a.css"/>\n'
+        '    <item id="b" href="b.ttf"/>\n</manifest>'
+    )
+    assert epub.remove_manifest_items(opf, {"b"}) == (
+        '<manifest>\n    <item id="a" href="a.css"/>\n</manifest>'
+    )
+
+
+def test_compact_epub() -> None:
+    """
+    Unit test for the function that compacts an EPUB, stripping unused
+    resources and deflating the archive
+    """
+
+    book = build_epub(
+        chapters={
+            "chapter1.xhtml": b'<html><img src="used.png"/>'
+            + b"text " * 2000
+            + b"</html>"
+        },
+        resources={
+            "used.png": ("image/png", b"not really a png"),
+            "unused.ttf": ("font/ttf", b"0" * 5000),
+        },
+    )
+    compacted = epub.compact_epub(book)
+    assert len(compacted) < len(book)
+
+    with zipfile.ZipFile(BytesIO(compacted)) as archive:
+        names = archive.namelist()
+        assert names[0] == "mimetype"
+        assert archive.getinfo("mimetype").compress_type == zipfile.ZIP_STORED
+        assert "OEBPS/used.png" in names
+        assert "OEBPS/unused.ttf" not in names
+        assert b"unused.ttf" not in archive.read("OEBPS/content.opf")
+
+    with pytest.raises(ValueError, match="Invalid EPUB file"):
+        epub.compact_epub(b"not an epub")
+
+
+def test_recompress_image_unsupported_type() -> None:
+    """Unit test to check that unsupported images are left untouched"""
+
+    assert epub.recompress_image(b"<svg/>", "image/svg+xml") == b"<svg/>"
+
+
+def test_recompress_image_unreadable(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Unit test to check that images that Pillow can't read are left untouched,
+    rather than failing the whole book
+    """
+
+    class DecompressionBombError(Exception):
+        """Mocks Pillow's error for images that are too large"""
+
+    def _open(_: object) -> None:
+        raise OSError("cannot identify image file")
+
+    pillow = types.ModuleType("PIL")
+    setattr(
+        pillow,
+        "Image",
+        types.SimpleNamespace(
+            open=_open, DecompressionBombError=DecompressionBombError
+        ),
+    )
+    monkeypatch.setitem(sys.modules, "PIL", pillow)
+
+    assert epub.recompress_image(b"not really a png", "image/png") == (
+        b"not really a png"
+    )
+
+
+def test_split_epub() -> None:
+    """
+    Unit test for the function that splits an EPUB into volumes
+    at chapter boundaries
+    """
+
+    chapters = {
+        f"chapter{index}.xhtml": f'<html><img src="image{index}.png"/></html>'.encode()
+        for index in range(1, 5)
+    }
+    resources = {
+        f"image{index}.png": ("image/png", bytes(range(256)) * 20)
+        for index in range(1, 5)
+    }
+    nav_points = "".join(
+        f'<navPoint id="n{index}"><content src="chapter{index}.xhtml"/></navPoint>\n'
+        for index in range(1, 5)
+    )
+    resources["toc.ncx"] = (
+        epub.NCX_MEDIA_TYPE,
+        f"<ncx><navMap>\n{nav_points}</navMap></ncx>".encode(),
+    )
+    book = build_epub(chapters, resources)
+
+    volumes = list(epub.split_epub(BytesIO(book), 9000))
+    assert len(volumes) > 1
+    assert [volume.number for volume in volumes] == list(range(1, len(volumes) + 1))
+
+    seen_chapters = []
+    for volume in volumes:
+        assert volume.total == len(volumes)
+        assert len(volume.content) <= 9000
+
+        with zipfile.ZipFile(BytesIO(volume.content)) as archive:
+            assert archive.namelist()[0] == "mimetype"
+            package = epub.read_package(archive)
+            opf = archive.read(package.opf_path).decode()
+            assert f"(Volume {volume.number} of {volume.total})" in opf
+
+            for chapter_id in package.spine:
+                chapter_index = chapter_id.removeprefix("chapter").removesuffix(
+                    ".xhtml"
+                )
+                assert f"OEBPS/image{chapter_index}.png" in archive.namelist()
+            for item in package.manifest.values():
+                assert item.path in archive.namelist()
+            seen_chapters.extend(package.spine)
+
+            # the table of contents only lists the volume's chapters
+            ncx = archive.read("OEBPS/toc.ncx").decode()
+            assert re.findall(r'src="([^"]*)"', ncx) == package.spine
+
+    assert seen_chapters == list(chapters)
+
+    # a single chapter over the limit can't be split any further
+    with pytest.raises(ValueError, match="does not fit in a single volume"):
+        list(epub.split_epub(BytesIO(book), 1000))
+
+    with pytest.raises(ValueError, match="Invalid EPUB file"):
+        list(epub.split_epub(BytesIO(b"not an epub"), 1000))
+
+
+def test_split_epub_checks_every_volume(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Unit test to check that no volume is yielded unless every volume fits,
+    so that books aren't sent in part
+    """
+
+    chapters = {
+        f"chapter{index}.xhtml": bytes(range(256)) * 20 for index in range(1, 4)
+    }
+    book = build_epub(chapters)
+    write_volume = epub.write_volume
+
+    def _write_volume(*args: object) -> bytes:
+        content = write_volume(*args)  # type: ignore[arg-type]
+        return content + b"x" * 9000 if args[-1] == 2 else content
+
+    monkeypatch.setattr(epub, "write_volume", _write_volume)
+    with pytest.raises(ValueError, match="Volume 2 exceeds the size limit"):
+        next(epub.split_epub(BytesIO(book), 9000))
+
+
+def test_prune_nav_entries() -> None:
+    """
+    Unit test for the function that drops the entries of a table of contents
+    that point to chapters left out of a volume
+    """
+
+    nav = (
+        "<nav><ol>\n"
+        '  <li><a href="text/part1.xhtml">Part 1</a><ol>\n'
+        '    <li><a href="text/ch1.xhtml#start">Chapter 1</a></li>\n'
+        '    <li><a href="text/ch2.xhtml">Chapter 2</a></li>\n'
+        "  </ol></li>\n"
+        '  <li><a href="text/ch3.xhtml">Chapter 3</a></li>\n'
+        '  <li><a href="https://www.gutenberg.org">Project Gutenberg</a></li>\n'
+        "</ol></nav>"
+    )
+    excluded = {
+        "OEBPS/text/part1.xhtml",
+        "OEBPS/text/ch1.xhtml",
+        "OEBPS/text/ch3.xhtml",
+    }
+
+    assert epub.prune_nav_entries(nav, "li", "OEBPS", excluded) == (
+        "<nav><ol>\n"
+        '  <li><a href="text/ch2.xhtml">Part 1</a><ol>\n'
+        '    <li><a href="text/ch2.xhtml">Chapter 2</a></li>\n'
+        "  </ol></li>\n"
+        '  <li><a href="https://www.gutenberg.org">Project Gutenberg</a></li>\n'
+        "</ol></nav>"
+    )
+
+
+def test_verify_epub() -> None:
+    """Unit tests for the integrity checks of a downloaded EPUB"""
+
+    book = build_epub()
+    epub.verify_epub(BytesIO(book))
+
+    with pytest.raises(ValueError, match="Invalid EPUB file"):
+        epub.verify_epub(BytesIO(book[:-10]))
+
+    with pytest.raises(ValueError, match="chapter1.xhtml is corrupt"):
+        epub.verify_epub(BytesIO(book.replace(b"Chapter 1", b"Chapter 2")))
+
+    # every entry but the mimetype, or every entry but a chapter
+    for skipped, error in (
+        ("mimetype", "does not start with its mimetype"),
+        ("OEBPS/chapter1.xhtml", "missing files: \\['OEBPS/chapter1.xhtml'\\]"),
+    ):
+        output = BytesIO()
+        with zipfile.ZipFile(BytesIO(book)) as source, zipfile.ZipFile(
+            output, "w"
+        ) as target:
+            for info in source.infolist():
+                if info.filename != skipped:
+                    target.writestr(info, source.read(info))
+
+        with pytest.raises(ValueError, match=error):
+            epub.verify_epub(output)
+        assert output.tell() == 0
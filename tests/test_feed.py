@@ -0,0 +1,129 @@
+"""Unit tests for the incremental polling of the feed of new releases"""
+
+import os
+from pathlib import Path
+from typing import Optional
+
+import pytest
+
+from gutenberg2kindle import feed
+
+
+def _build_feed(*items: tuple[int, str, str]) -> bytes:
+    entries = "".join(
+        f"<item><title>{title}</title>"
+        f"<link>https://www.gutenberg.org/ebooks/{book_id}</link>"
+        f"<description>{description}</description></item>"
+        for book_id, title, description in items
+    )
+    return (
+        '<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel>'
+        f"<title>New releases</title>{entries}</channel></rss>"
+    ).encode()
+
+
+class ResponseMock:  # pylint: disable=too-few-public-methods
+    """Mocks a `requests` response to a conditional request"""
+
+    def __init__(self, content: bytes, status_code: int = 200) -> None:
+        self.content = content
+        self.status_code = status_code
+        self.headers = {"ETag": '"v1"', "Last-Modified": "Mon, 01 Jan 2024 00:00:00"}
+
+    def raise_for_status(self) -> None:
+        """Mocks raising on error responses"""
+
+
+def test_parse_feed() -> None:
+    """Unit tests for parsing the entries of a feed, and matching them"""
+
+    content = _build_feed(
+        (2, "Moby Dick by Melville, Herman", "Language: English"),
+        (3, "Untitled", "Sea stories"),
+    )
+    entries = feed.parse_feed(content.replace(b"ebooks/3", b"ebooks/search"))
+    assert entries == [
+        feed.FeedEntry(2, "Moby Dick", "Melville, Herman", "Language: English")
+    ]
+
+    entries = feed.parse_feed(content)
+    entry, untitled = entries[0], entries[1]
+    assert untitled == feed.FeedEntry(3, "Untitled", "", "Sea stories")
+    assert entry.matches([], [])
+    assert entry.matches(["melville"], [])
+    assert entry.matches(["Austen"], ["english"])
+    assert not entry.matches(["Austen"], ["sea"])
+    assert untitled.matches(["Austen"], ["sea"])
+
+    assert feed.parse_filters(" Melville, ,Austen ") == ["Melville", "Austen"]
+    with pytest.raises(ValueError, match="Invalid feed"):
+        feed.parse_feed(b"<rss>")
+
+
+def test_feed_watcher_local_copy(tmp_path: Path) -> None:
+    """
+    Unit tests for polling a local copy of the feed, which is only read
+    again once modified, and for the high-water mark
+    """
+
+    feed_path = tmp_path / "today.rss"
+    feed_path.write_bytes(_build_feed((10, "A by B", ""), (11, "C by D", "")))
+    watcher = feed.FeedWatcher(str(feed_path), str(tmp_path / "state.json"))
+
+    # the first poll only sets the high-water mark
+    update = watcher.poll()
+    assert not update.entries
+    assert update.state.high_water_mark == 11
+    watcher.commit(update)
+
+    # unchanged, so it's not read again
+    assert not watcher.poll().entries
+
+    feed_path.write_bytes(_build_feed((11, "C by D", ""), (12, "E by F", "")))
+    os.utime(feed_path, ns=(1, 1))
+    update = watcher.poll()
+    assert [entry.book_id for entry in update.entries] == [12]
+
+    # entries are returned again until committed
+    assert watcher.poll().entries == update.entries
+    watcher.commit(update)
+    assert not watcher.poll().entries
+    assert watcher.load_state().high_water_mark == 12
+
+
+def test_feed_watcher_conditional_get(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+) -> None:
+    """Unit tests for polling the feed with conditional requests"""
+
+    content = _build_feed((10, "A by B", ""))
+    requests_headers: list[dict[str, str]] = []
+
+    def _get(
+        _url: str, headers: Optional[dict[str, str]] = None, **_: object
+    ) -> ResponseMock:
+        requests_headers.append(headers or {})
+        if headers and headers.get("If-None-Match") == '"v1"':
+            return ResponseMock(b"", 304)
+        return ResponseMock(content)
+
+    monkeypatch.setattr("requests.get", _get)
+    watcher = feed.FeedWatcher(feed.NEW_RELEASES_FEED_URL, str(tmp_path / "s.json"))
+
+    watcher.commit(watcher.poll())
+    update = watcher.poll()
+    assert not update.entries
+    assert update.state.high_water_mark == 10
+    assert requests_headers == [
+        {},
+        {
+            "If-None-Match": '"v1"',
+            "If-Modified-Since": "Mon, 01 Jan 2024 00:00:00",
+        },
+    ]
+
+    # the mark of another feed still holds, but not its validators
+    watcher = feed.FeedWatcher("https://example.org/feed.rss", watcher.state_path)
+    assert watcher.load_state() == feed.WatchState(
+        "https://example.org/feed.rss", high_water_mark=10
+    )
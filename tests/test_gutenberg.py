@@ -1,11 +1,25 @@
 """Unit tests for the helper functions that connect to Project Gutenberg"""
 
-from dataclasses import dataclass
+import base64
+import hashlib
+from dataclasses import dataclass, field
+from io import BytesIO
+from pathlib import Path
+from typing import Iterator
 
 import pytest
+import requests
 
 from gutenberg2kindle import gutenberg
-from gutenberg2kindle.config import FORMAT_AUTO, FORMAT_IMAGES, FORMAT_NO_IMAGES
+from gutenberg2kindle.budget import ByteBudget
+from gutenberg2kindle.cache import BookCache, MappedFile
+from gutenberg2kindle.config import (
+    FORMAT_AUTO,
+    FORMAT_IMAGES,
+    FORMAT_NO_IMAGES,
+    FORMAT_SMALLEST,
+)
+from tests.test_epub import build_epub
 
 
 @dataclass(frozen=True)
@@ -16,6 +30,17 @@ class ResponseMock:
 
     content: bytes
     status_code: int = 200
+    headers: dict[str, str] = field(default_factory=dict)
+
+    def close(self) -> None:
+        """Mocks closing the underlying connection"""
+
+    def iter_content(self, chunk_size: int) -> Iterator[bytes]:
+        """Mocks streaming the body in chunks"""
+
+        body = BytesIO(self.content)
+        while chunk := body.read(chunk_size):
+            yield chunk
 
 
 def test_fetch_book_from_url(monkeypatch: pytest.MonkeyPatch) -> None:
@@ -44,6 +69,47 @@ def test_fetch_book_from_url(monkeypatch: pytest.MonkeyPatch) -> None:
     assert book_response_2 is not None
     assert book_response_2.read() == b"book content"
 
+    # streamed in chunks, reporting each one's size
+    monkeypatch.setattr(gutenberg, "DOWNLOAD_CHUNK_SIZE", 5)
+    chunks: list[int] = []
+    book_response_3 = gutenberg.fetch_book_from_url(
+        "https://www.gutenberg.org/ebooks/1.kindle", on_chunk=chunks.append
+    )
+    assert book_response_3 is not None
+    assert book_response_3.read() == b"book content"
+    assert chunks == [5, 5, 2]
+
+
+def test_fetch_book_from_url_with_budget(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Unit test to check that downloaded books are accounted for
+    in the memory budget until released
+    """
+
+    monkeypatch.setattr(
+        "requests.get",
+        lambda *_args, **_kwargs: ResponseMock(
+            b"book content", headers={"Content-Length": "100"}
+        ),
+    )
+    budget = ByteBudget(1024)
+
+    book = gutenberg.fetch_book_from_url(
+        "https://www.gutenberg.org/ebooks/1.epub", budget
+    )
+    assert book is not None
+    assert budget.in_use == len(b"book content")
+
+    budget.release(book.getbuffer().nbytes)
+    assert budget.in_use == 0
+
+    # failed downloads don't reserve anything
+    monkeypatch.setattr(
+        "requests.get", lambda *_args, **_kwargs: ResponseMock(b"", status_code=404)
+    )
+    assert gutenberg.fetch_book_from_url("https://example.org", budget) is None
+    assert budget.in_use == 0
+
 
 def test_download_book(monkeypatch: pytest.MonkeyPatch) -> None:
     """
@@ -62,19 +128,19 @@ def test_download_book(monkeypatch: pytest.MonkeyPatch) -> None:
     book_id = 1234
 
     # no images
-    monkeypatch.setattr(gutenberg, "get_config", lambda _: FORMAT_NO_IMAGES)
+    monkeypatch.setattr(gutenberg, "get_config", lambda *_: FORMAT_NO_IMAGES)
     book_response_1 = gutenberg.download_book(book_id)
     assert book_response_1 is not None
     assert book_response_1.read() == b"book content"
 
     # images
-    monkeypatch.setattr(gutenberg, "get_config", lambda _: FORMAT_IMAGES)
+    monkeypatch.setattr(gutenberg, "get_config", lambda *_: FORMAT_IMAGES)
     book_response_2 = gutenberg.download_book(book_id)
     assert book_response_2 is not None
     assert book_response_2.read() == b"image book content"
 
     # auto, image available
-    monkeypatch.setattr(gutenberg, "get_config", lambda _: FORMAT_AUTO)
+    monkeypatch.setattr(gutenberg, "get_config", lambda *_: FORMAT_AUTO)
     book_response_3 = gutenberg.download_book(book_id)
     assert book_response_3 is not None
     assert book_response_3.read() == b"image book content"
@@ -87,11 +153,208 @@ def test_download_book(monkeypatch: pytest.MonkeyPatch) -> None:
             status_code=(500 if ".images" in url else 200),
         ),
     )
-    book_response_3 = gutenberg.download_book(book_id)
+    resolved: list[tuple[str, str]] = []
+    book_response_3 = gutenberg.download_book(
+        book_id, on_resolved=lambda *variant: resolved.append(variant)
+    )
     assert book_response_3 is not None
     assert book_response_3.read() == b"book content"
+    assert len(resolved) == 1 and ".images" not in resolved[0][1]
 
     # invalid format
-    monkeypatch.setattr(gutenberg, "get_config", lambda _: "INVALID_FORMAT")
+    monkeypatch.setattr(gutenberg, "get_config", lambda *_: "INVALID_FORMAT")
     with pytest.raises(ValueError, match="INVALID_FORMAT is an invalid format"):
         gutenberg.download_book(book_id)
+
+
+def test_download_book_with_cache(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+) -> None:
+    """
+    Unit test to check that downloaded books are stored in the cache and
+    later mapped from it, without contacting Project Gutenberg nor taking
+    any of the memory budget
+    """
+
+    requested_urls: list[str] = []
+
+    def _get(url: str, *_args: object, **_kwargs: object) -> ResponseMock:
+        requested_urls.append(url)
+        return ResponseMock(
+            b"book content", status_code=404 if ".images" in url else 200
+        )
+
+    monkeypatch.setattr("requests.get", _get)
+    monkeypatch.setattr(gutenberg, "get_config", lambda *_: FORMAT_AUTO)
+    cache = BookCache(str(tmp_path))
+
+    book_1 = gutenberg.download_book(1234, cache=cache)
+    assert book_1 is not None
+    assert len(requested_urls) == 2
+    assert cache.lookup(1234, FORMAT_NO_IMAGES) is not None
+
+    budget = ByteBudget(1)
+    book_2 = gutenberg.download_book(1234, budget, cache=cache)
+    assert isinstance(book_2, MappedFile)
+    assert book_2.read() == b"book content"
+    assert len(requested_urls) == 2
+    assert budget.in_use == gutenberg.get_reserved_bytes(book_2) == 0
+    book_2.close()
+
+    # revalidating against a different upstream digest downloads it again
+    other_digest = base64.b64encode(hashlib.sha256(b"new").digest()).decode()
+    monkeypatch.setattr(
+        "requests.head",
+        lambda *_args, **_kwargs: ResponseMock(
+            b"", headers={"Digest": f"sha-256={other_digest}"}
+        ),
+    )
+    gutenberg.download_book(1234, cache=cache, revalidate=True)
+    assert len(requested_urls) == 4
+
+
+def test_download_book_smallest_variant(
+    monkeypatch: pytest.MonkeyPatch, tmp_path: Path
+) -> None:
+    """
+    Unit test to check that the smallest variant of a book is downloaded,
+    and that the chosen variant is recorded in the cache for later runs
+    """
+
+    sizes = {".epub3.images": "300", ".epub.images": "200", ".epub": ""}
+    head_urls: list[str] = []
+    get_urls: list[str] = []
+
+    def _head(url: str, *_args: object, **_kwargs: object) -> ResponseMock:
+        head_urls.append(url)
+        _, _, extension = url.rpartition("/")[2].partition(".")
+        size = sizes[f".{extension}"]
+        return ResponseMock(b"", headers={"Content-Length": size})
+
+    def _get(url: str, *_args: object, **_kwargs: object) -> ResponseMock:
+        get_urls.append(url)
+        return ResponseMock(url.encode())
+
+    monkeypatch.setattr("requests.head", _head)
+    monkeypatch.setattr("requests.get", _get)
+    monkeypatch.setattr(gutenberg, "get_config", lambda *_: FORMAT_SMALLEST)
+    cache = BookCache(str(tmp_path))
+
+    book = gutenberg.download_book(1234, cache=cache)
+    assert book is not None
+    assert book.read() == b"https://www.gutenberg.org/ebooks/1234.epub.images"
+    assert len(head_urls) == 3
+    assert cache.chosen_variant(1234) == FORMAT_IMAGES
+
+    # later runs go straight for the chosen variant
+    book = gutenberg.download_book(1234, cache=cache)
+    assert book is not None
+    assert len(head_urls) == 3
+    assert len(get_urls) == 1
+
+    # variants whose size is unknown go last
+    candidates = gutenberg.get_candidate_urls(5678, FORMAT_SMALLEST)
+    assert [variant for variant, _ in gutenberg.sort_by_size(5678, candidates)] == [
+        FORMAT_IMAGES,
+        gutenberg.VARIANT_EPUB3_IMAGES,
+        FORMAT_NO_IMAGES,
+    ]
+
+    # sizes are estimated without downloading anything
+    assert gutenberg.estimate_book_size(5678) == 200
+    assert gutenberg.estimate_book_size(1234, cache=cache) == len(get_urls[0])
+    assert len(get_urls) == 1
+
+    # cached variants are enough, without asking upstream for any size
+    head_amount = len(head_urls)
+    cache.store(5678, FORMAT_NO_IMAGES, "url", b"tiny")
+    cache.store(5678, gutenberg.VARIANT_EPUB3_IMAGES, "url", b"bigger")
+    assert [
+        variant for variant, _ in gutenberg.sort_by_size(5678, candidates, cache)
+    ] == [FORMAT_NO_IMAGES, gutenberg.VARIANT_EPUB3_IMAGES, FORMAT_IMAGES]
+    assert gutenberg.estimate_book_size(5678, cache=cache) == len(b"tiny")
+    monkeypatch.setattr(gutenberg, "get_config", lambda *_: FORMAT_AUTO)
+    assert gutenberg.estimate_book_size(5678, cache=cache) == len(b"tiny")
+    assert len(head_urls) == head_amount
+    monkeypatch.setattr(gutenberg, "get_config", lambda *_: FORMAT_SMALLEST)
+
+    sizes[".epub3.images"] = sizes[".epub.images"] = ""
+    assert gutenberg.estimate_book_size(5678) is None
+
+
+def test_parse_digest_header() -> None:
+    """Unit test for the function that parses digests announced upstream"""
+
+    digest = hashlib.sha256(b"book").digest()
+    encoded = base64.b64encode(digest).decode()
+
+    assert gutenberg.parse_digest_header({}) is None
+    assert gutenberg.parse_digest_header({"Digest": "md5=abc"}) is None
+    assert gutenberg.parse_digest_header({"Digest": f"sha-256={encoded}"}) == (
+        digest.hex()
+    )
+    assert gutenberg.parse_digest_header(
+        {"Repr-Digest": f"sha-512=:abc:, sha-256=:{encoded}:"}
+    ) == (digest.hex())
+
+
+def test_fetch_book_from_url_with_mismatching_digest(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """Unit test to check that downloads not matching their digest are dropped"""
+
+    digest = base64.b64encode(hashlib.sha256(b"book").digest()).decode()
+    monkeypatch.setattr(
+        "requests.get",
+        lambda *_args, **_kwargs: ResponseMock(
+            b"truncated", headers={"Digest": f"sha-256={digest}"}
+        ),
+    )
+    budget = ByteBudget()
+    assert gutenberg.fetch_book_from_url("https://example.org", budget) is None
+    assert budget.in_use == 0
+
+
+def _raise_connection_error(*_args: object, **_kwargs: object) -> None:
+    raise requests.ConnectionError("no route to host")
+
+
+def test_prefetch_book(monkeypatch: pytest.MonkeyPatch, tmp_path: Path) -> None:
+    """
+    Unit test for the function that downloads a book into the cache
+    and verifies it, downloading it again if corrupt
+    """
+
+    book = build_epub()
+    downloads: list[str] = []
+
+    def _get(url: str, *_args: object, **_kwargs: object) -> ResponseMock:
+        downloads.append(url)
+        if "1234" in url:
+            return ResponseMock(book)
+        # the first download of 91011 is truncated
+        return ResponseMock(book if "91011" in url and len(downloads) > 4 else b"PK")
+
+    monkeypatch.setattr("requests.get", _get)
+    monkeypatch.setattr(gutenberg, "get_config", lambda *_: FORMAT_NO_IMAGES)
+    cache = BookCache(str(tmp_path))
+    budget = ByteBudget()
+
+    assert gutenberg.prefetch_book(1234, cache, budget) == len(book)
+    assert cache.lookup(1234, FORMAT_NO_IMAGES) is not None
+    assert gutenberg.prefetch_book(5678, cache, budget) is None
+    assert len(downloads) == 3
+    assert gutenberg.prefetch_book(91011, cache, budget) == len(book)
+    assert len(downloads) == 5
+    assert budget.in_use == 0
+
+    # a corrupt cached copy is replaced with a fresh one
+    cache.store(91011, FORMAT_NO_IMAGES, "", b"PK")
+    assert gutenberg.prefetch_book(91011, cache, budget) == len(book)
+    assert len(downloads) == 6
+
+    # books that can't be reached are reported as not prefetched
+    session = requests.Session()
+    monkeypatch.setattr(session, "get", _raise_connection_error)
+    assert gutenberg.prefetch_book(5678, cache, budget, session=session) is None
+    assert budget.in_use == 0
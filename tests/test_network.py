@@ -0,0 +1,158 @@
+"""Unit tests for the reuse of DNS lookups and TLS sessions across connections"""
+
+import socket
+import ssl
+from typing import Any, Optional
+
+import pytest
+from requests.adapters import DEFAULT_CA_BUNDLE_PATH
+
+from gutenberg2kindle import network
+from tests.test_progress import ClockMock
+
+
+class SessionMock:  # pylint: disable=too-few-public-methods
+    """Mocks a TLS session"""
+
+    has_ticket = True
+
+
+class SSLSocketMock(ssl.SSLSocket):  # pylint: disable=abstract-method
+    """Mocks a TLS connection to a host, without connecting anywhere"""
+
+    session: Any = None
+    session_reused = False
+
+    def __init__(  # pylint: disable=super-init-not-called
+        self, host: str, version: str = "TLSv1.2"
+    ) -> None:
+        socket.socket.__init__(self)  # pylint: disable=non-parent-init-called
+        self.server_hostname = host
+        self._version = version
+
+    def version(self) -> str:
+        return self._version
+
+
+def test_dns_cache() -> None:
+    """
+    Unit test to check that lookups are answered from the cache until their
+    TTL expires, and that failed lookups are not cached
+    """
+
+    lookups: list[str] = []
+
+    def _resolve(host: str, port: int) -> list[tuple[str, int]]:
+        lookups.append(host)
+        if host == "missing.test":
+            raise socket.gaierror("not found")
+        return [(f"address of {host}", port)]
+
+    clock = ClockMock()
+    cache = network.DnsCache(60, _resolve, clock)
+
+    assert cache.getaddrinfo("gutenberg.test", 443) == [
+        ("address of gutenberg.test", 443)
+    ]
+    assert cache.getaddrinfo("gutenberg.test", 443) == [
+        ("address of gutenberg.test", 443)
+    ]
+    cache.getaddrinfo("gutenberg.test", 80)
+    assert lookups == ["gutenberg.test", "gutenberg.test"]
+
+    clock.now = 61
+    cache.getaddrinfo("gutenberg.test", 443)
+    assert len(lookups) == 3
+
+    for _ in range(2):
+        with pytest.raises(socket.gaierror):
+            cache.getaddrinfo("missing.test", 443)
+    assert len(lookups) == 5
+    assert (cache.lookups, cache.hits) == (3, 1)
+
+
+def test_dns_cache_install() -> None:
+    """
+    Unit test to check that the cache is only uninstalled once every user
+    that installed it is done with it
+    """
+
+    original = socket.getaddrinfo
+    cache = network.DnsCache()
+
+    with cache.installed():
+        with cache.installed():
+            assert socket.getaddrinfo == cache.getaddrinfo  # pylint: disable=W0143
+        assert socket.getaddrinfo == cache.getaddrinfo  # pylint: disable=W0143
+    assert socket.getaddrinfo is original
+
+
+def test_resuming_tls_context(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Unit test to check that new connections are offered the session of the
+    previous connection to the same host, and that handshakes are counted
+    """
+
+    offered: list[Optional[SessionMock]] = []
+    sockets = [
+        SSLSocketMock("smtp.test"),
+        SSLSocketMock("smtp.test"),
+        SSLSocketMock("gutenberg.test", "TLSv1.3"),
+        SSLSocketMock("gutenberg.test", "TLSv1.3"),
+    ]
+    first_session, ticketless_session = SessionMock(), SessionMock()
+    ticketless_session.has_ticket = False
+    sockets[0].session = first_session
+    sockets[1].session_reused = True
+    sockets[2].session = ticketless_session
+
+    def _wrap_socket(*args: Any) -> SSLSocketMock:
+        offered.append(args[-1])
+        return sockets[len(offered) - 1]
+
+    monkeypatch.setattr(ssl.SSLContext, "wrap_socket", _wrap_socket)
+    context = network.create_tls_context()
+    for tls_socket in sockets:
+        context.wrap_socket(
+            socket.socket(), server_hostname=tls_socket.server_hostname
+        ).close()
+
+    # TLS 1.3 sessions can only be resumed once their ticket was received
+    assert offered == [None, first_session, None, None]
+    assert (context.handshakes, context.resumed) == (4, 1)
+
+
+def test_create_http_session() -> None:
+    """
+    Unit test to check that HTTPS connections of new HTTP sessions share
+    a TLS context, so that their sessions can be resumed
+    """
+
+    with network.create_http_session() as session:
+        adapter: Any = session.get_adapter("https://www.gutenberg.org")
+        assert adapter.poolmanager.connection_pool_kw[
+            "ssl_context"
+        ] is network.get_tls_context(DEFAULT_CA_BUNDLE_PATH)
+
+
+def test_report_network_stats(
+    monkeypatch: pytest.MonkeyPatch, capfd: pytest.CaptureFixture[str]
+) -> None:
+    """Unit test to check that network stats are only printed if asked to"""
+
+    monkeypatch.setattr(
+        network,
+        "get_network_stats",
+        lambda: network.NetworkStats(2, 5, 0.5, 3, 2, 0.25),
+    )
+
+    with network.report_network_stats(False):
+        pass
+    assert capfd.readouterr().out == ""
+
+    with network.report_network_stats(True):
+        pass
+    assert capfd.readouterr().out == (
+        "Network: 2 DNS lookups (5 answered from cache, 0.50 seconds), "
+        "3 TLS handshakes (2 resumed, 0.25 seconds)\n"
+    )
@@ -0,0 +1,164 @@
+"""Unit tests for the pool of SMTP sender profiles"""
+
+import json
+import smtplib
+
+import pytest
+
+from gutenberg2kindle import config, pool
+from gutenberg2kindle.email import SmtpProfile, SmtpSession
+
+
+def _create_pool(
+    weights: dict[str, int], strategy: str = config.STRATEGY_ROUND_ROBIN
+) -> pool.SenderPool:
+    return pool.SenderPool(
+        [
+            SmtpSession("password", SmtpProfile(name, "smtp.test", name, weight=weight))
+            for name, weight in weights.items()
+        ],
+        strategy,
+    )
+
+
+def _send_through(sender_pool: pool.SenderPool, amount: int, size: int = 1) -> str:
+    names: list[str] = []
+
+    def _send(session: SmtpSession) -> bool:
+        names.append(pool.get_profile_name(session))
+        return True
+
+    for _ in range(amount):
+        sender_pool.send(_send, size)
+    return "".join(names)
+
+
+def test_sender_pool_strategies() -> None:
+    """Unit tests for the strategies used to pick the profile of each email"""
+
+    assert _send_through(_create_pool({"a": 2, "b": 1}), 6) == "abaaba"
+
+    least_loaded = _create_pool({"a": 1, "b": 1}, config.STRATEGY_LEAST_LOADED)
+    least_loaded.send(lambda _: True, 10)
+    assert _send_through(least_loaded, 3) == "bbb"
+    assert least_loaded.stats["a"].bytes_sent == 10
+    assert least_loaded.stats["b"].emails_sent == 3
+
+
+def test_sender_pool_takes_profiles_out_of_rotation(
+    monkeypatch: pytest.MonkeyPatch,
+) -> None:
+    """
+    Unit tests for the profiles taken out of rotation when their credentials
+    are invalid, their server keeps failing or they reach their limit
+    """
+
+    delays: list[float] = []
+    monkeypatch.setattr(pool.time, "sleep", delays.append)
+
+    sender_pool = _create_pool({"a": 1, "b": 1, "c": 1})
+    assert sender_pool.sessions[2].profile is not None
+    sender_pool.sessions[2].profile.limit = 1
+
+    def _send(session: SmtpSession) -> bool:
+        if pool.get_profile_name(session) == "a":
+            raise smtplib.SMTPAuthenticationError(535, "invalid credentials")
+        return True
+
+    assert sender_pool.send(_send, 1)
+    assert sender_pool.stats["a"].failures == 1
+    assert not sender_pool.stats["a"].active
+    assert sender_pool.stats["b"].emails_sent == 1
+    assert not delays
+
+    assert _send_through(sender_pool, 3) == "cbb"
+    assert sender_pool.stats["c"].disabled_reason == pool.LIMIT_REACHED
+
+    def _fail(_: SmtpSession) -> bool:
+        raise smtplib.SMTPServerDisconnected("connection dropped")
+
+    with pytest.raises(smtplib.SMTPServerDisconnected, match="connection dropped"):
+        sender_pool.send(_fail, 1)
+    assert delays == [1.0, 2.0]
+    assert sender_pool.stats["b"].retries == 2
+    assert sender_pool.stats["b"].breaker.is_open
+    assert not any(stats.active for stats in sender_pool.stats.values())
+
+    sender_pool.reactivate()
+    assert not sender_pool.stats["a"].active
+    assert sender_pool.stats["b"].active
+    assert not sender_pool.stats["c"].active
+
+
+def test_sender_pool_retries(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Unit tests for the retries of emails that fail, depending on the error"""
+
+    monkeypatch.setattr(pool.time, "sleep", lambda _: None)
+    sender_pool = _create_pool({"a": 1})
+    errors: list[OSError] = [
+        smtplib.SMTPResponseException(421, "try again later"),
+        smtplib.SMTPServerDisconnected("connection dropped"),
+    ]
+
+    def _send(_: SmtpSession) -> bool:
+        if errors:
+            raise errors.pop(0)
+        return True
+
+    assert sender_pool.send(_send, 1)
+    assert sender_pool.stats["a"].retries == 2
+    assert sender_pool.stats["a"].breaker.failures == 0
+
+    errors.append(smtplib.SMTPDataError(554, "message rejected"))
+    with pytest.raises(smtplib.SMTPDataError):
+        sender_pool.send(_send, 1)
+    assert sender_pool.stats["a"].retries == 2
+    assert sender_pool.stats["a"].active
+
+
+def test_circuit_breaker(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Unit tests for the circuit breaker of a profile"""
+
+    now = [100.0]
+    monkeypatch.setattr(pool.time, "monotonic", lambda: now[0])
+
+    breaker = pool.CircuitBreaker(threshold=2, cooldown=10)
+    breaker.record_failure()
+    assert not breaker.is_open
+    breaker.record_failure()
+    assert breaker.is_open
+
+    # once cooled down, a single failure opens it again
+    now[0] += 10
+    assert not breaker.is_open
+    breaker.record_failure()
+    assert breaker.is_open
+
+    now[0] += 10
+    breaker.record_success()
+    breaker.record_failure()
+    assert not breaker.is_open
+
+
+def test_sender_pool_from_config(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Unit tests for the pool created from the configured profiles"""
+
+    profiles = [
+        {"name": "main", "smtp_server": "smtp.main.test", "sender_email": "main@a.b"},
+        {"name": "backup", "smtp_server": "smtp.b.test", "sender_email": "b@a.b"},
+    ]
+    settings = {
+        config.SETTINGS_SMTP_PROFILES: json.dumps(profiles),
+        config.SETTINGS_SMTP_STRATEGY: config.STRATEGY_LEAST_LOADED,
+    }
+    monkeypatch.setattr(pool, "get_config", settings.get)
+
+    sender_pool = pool.SenderPool.from_config({"main": "p4ss", "backup": "b4ckup"})
+    assert sender_pool.strategy == config.STRATEGY_LEAST_LOADED
+    assert [session.password for session in sender_pool.sessions] == ["p4ss", "b4ckup"]
+    assert list(sender_pool.stats) == ["main", "backup"]
+
+    settings[config.SETTINGS_SMTP_PROFILES] = ""
+    sender_pool = pool.SenderPool.from_config("p4ss")
+    assert sender_pool.sessions[0].profile is None
+    assert list(sender_pool.stats) == ["default"]
@@ -0,0 +1,74 @@
+"""Unit tests for the checks run before sending books"""
+
+import smtplib
+from typing import Any
+
+import pytest
+import requests
+
+from gutenberg2kindle import preflight
+from gutenberg2kindle.email import SMTP_ERROR_AUTH, SmtpProfile, SmtpSession
+from gutenberg2kindle.pool import SenderPool
+
+
+class HttpSessionMock:  # pylint: disable=too-few-public-methods
+    """Mock for the Project Gutenberg session, failing if asked to"""
+
+    def __init__(self, error: bool = False) -> None:
+        self.error = error
+        self.urls: list[str] = []
+
+    def head(self, url: str, **_: Any) -> requests.Response:
+        """Mock for the `head` method"""
+
+        self.urls.append(url)
+        if self.error:
+            raise requests.ConnectionError("no route to host")
+
+        response = requests.Response()
+        response.status_code = 200
+        return response
+
+
+def test_run_checks(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Unit tests for checking Project Gutenberg and the sender profiles"""
+
+    connected: list[str] = []
+
+    def _connect(session: SmtpSession) -> None:
+        assert session.profile is not None
+        if session.profile.name == "main":
+            raise smtplib.SMTPAuthenticationError(535, "invalid credentials")
+        connected.append(session.profile.name)
+
+    monkeypatch.setattr(SmtpSession, "connect", _connect)
+
+    sender_pool = SenderPool(
+        [
+            SmtpSession("password", SmtpProfile(name, "smtp.test", name))
+            for name in ("main", "backup")
+        ]
+    )
+    http_session = HttpSessionMock()
+    gutenberg, main, backup = preflight.run_checks(
+        sender_pool, http_session  # type: ignore
+    )
+
+    assert http_session.urls == [preflight.GUTENBERG_URL]
+    assert gutenberg.target == preflight.CHECK_GUTENBERG
+    assert gutenberg.ok
+    assert (main.profile, main.smtp_error) == ("main", SMTP_ERROR_AUTH)
+    assert main.error == "(535, 'invalid credentials')"
+    assert not sender_pool.stats["main"].active
+    assert backup.ok
+    assert connected == ["backup"]
+
+    # profiles out of rotation are not checked again
+    assert len(preflight.run_checks(sender_pool, http_session)) == 2  # type: ignore
+
+    (gutenberg,) = preflight.run_checks(None, HttpSessionMock(error=True))  # type: ignore
+    assert gutenberg.error == "no route to host"
+
+    # without an HTTP session, only the sender profiles are checked
+    (backup,) = preflight.run_checks(sender_pool, None)
+    assert backup.profile == "backup"
@@ -0,0 +1,67 @@
+"""Unit tests for the profiling of a run of the tool"""
+
+import pstats
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+from gutenberg2kindle.profiling import profile_run
+
+
+def _allocate() -> list[bytes]:
+    return [bytes(1024) for _ in range(1024)]
+
+
+def _work_in_thread() -> int:
+    return sum(range(1024))
+
+
+def test_profile_run(tmp_path: Path, capfd: pytest.CaptureFixture) -> None:
+    """Unit tests for the CPU profile and memory report written after a run"""
+
+    cpu_path = str(tmp_path / "run.pstats")
+    memory_path = str(tmp_path / "run.txt")
+
+    with pytest.raises(SystemExit):
+        with profile_run(cpu_path, memory_path):
+            allocated = _allocate()
+            raise SystemExit(1)
+    assert len(allocated) == 1024
+
+    stats = pstats.Stats(cpu_path)
+    assert any(function == "_allocate" for _, _, function in stats.stats)  # type: ignore
+
+    report = Path(memory_path).read_text(encoding="utf-8").splitlines()
+    assert report[0].startswith("Peak traced memory: 2 MB")
+    assert report[1] == "Top 25 lines by allocated memory:"
+    assert "test_profiling.py" in report[2]
+
+    out, _ = capfd.readouterr()
+    assert out == (
+        f"CPU profile written to {cpu_path}\n"
+        f"Memory report written to {memory_path}\n"
+    )
+
+    with profile_run():
+        _allocate()
+    assert not capfd.readouterr().out
+
+
+def test_profile_run_threads(tmp_path: Path) -> None:
+    """
+    Unit test to check that the CPU profile covers the threads started
+    during the run, and not only the calling thread
+    """
+
+    cpu_path = str(tmp_path / "run.pstats")
+    with profile_run(cpu_path):
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            assert (
+                list(executor.map(lambda _: _work_in_thread(), range(4)))
+                == [523776] * 4
+            )
+
+    stats = pstats.Stats(cpu_path)
+    functions = [function for _, _, function in stats.stats]  # type: ignore
+    assert "_work_in_thread" in functions
@@ -0,0 +1,90 @@
+"""Unit tests for the live progress line of a batch of books"""
+
+import io
+
+from gutenberg2kindle.progress import CLEAR_LINE, ProgressReporter, format_duration
+
+
+class TerminalMock(io.StringIO):
+    """Mocks a stream that is a terminal"""
+
+    def isatty(self) -> bool:
+        return True
+
+
+class ClockMock:  # pylint: disable=too-few-public-methods
+    """Mocks a monotonic clock that only moves when told to"""
+
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_format_duration() -> None:
+    """Unit tests for the formatting of the time left"""
+
+    assert format_duration(12.7) == "12s"
+    assert format_duration(185) == "3m 05s"
+    assert format_duration(3720) == "1h 02m"
+
+
+def test_progress_reporter() -> None:
+    """Unit tests for the throttled progress line, and its estimates"""
+
+    stream, clock = TerminalMock(), ClockMock()
+    progress = ProgressReporter(4, stream, interval=1.0, clock=clock)
+
+    progress.book_started()
+    progress.book_started()
+    for _ in range(4):
+        progress.add_downloaded(512 * 1024)
+    assert stream.getvalue() == ""
+
+    clock.now = 2.0
+    progress.book_done()
+    assert stream.getvalue() == (
+        CLEAR_LINE + "1/4 books done, 1 in flight | 2.0 MB downloaded, "
+        "0.0 MB sent | 1.0 MB/s | ETA 6s"
+    )
+
+    # other output is printed on a line of its own
+    with progress.paused():
+        stream.write("Sending book `1`...\n")
+    assert stream.getvalue().endswith(
+        CLEAR_LINE + "Sending book `1`...\n" + CLEAR_LINE + "1/4 books done, "
+        "1 in flight | 2.0 MB downloaded, 0.0 MB sent | 1.0 MB/s | ETA 6s"
+    )
+
+    clock.now = 2.5
+    progress.add_sent(1024 * 1024)
+    assert "0.0 MB sent" in stream.getvalue().rpartition(CLEAR_LINE)[2]
+
+    clock.now = 3.0
+    progress.add_sent(1024 * 1024)
+    assert stream.getvalue().rpartition(CLEAR_LINE)[2] == (
+        "1/4 books done, 1 in flight | 2.0 MB downloaded, 2.0 MB sent | "
+        "2.0 MB/s | ETA 9s"
+    )
+
+    progress.close()
+    assert stream.getvalue().endswith(CLEAR_LINE)
+    progress.book_done()
+    assert stream.getvalue().endswith(CLEAR_LINE)
+
+
+def test_progress_reporter_not_on_a_terminal() -> None:
+    """Unit test to check that nothing is drawn unless on a terminal"""
+
+    stream, clock = io.StringIO(), ClockMock()
+    progress = ProgressReporter(stream=stream, interval=0.0, clock=clock)
+    assert not progress.enabled
+
+    progress.book_started()
+    progress.add_downloaded(1024)
+    with progress.paused():
+        stream.write("Sending book `1`...\n")
+    progress.close()
+
+    assert stream.getvalue() == "Sending book `1`...\n"
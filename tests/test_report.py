@@ -0,0 +1,143 @@
+"""Unit tests for the machine-readable reports of a run"""
+
+import csv
+import json
+from pathlib import Path
+
+import pytest
+
+from gutenberg2kindle import report
+from gutenberg2kindle.api import (
+    STATUS_DUPLICATE,
+    STATUS_NOT_DOWNLOADED,
+    STATUS_SENT,
+    BookResult,
+)
+
+
+def _get_results() -> list[BookResult]:
+    return [
+        BookResult(
+            1234,
+            STATUS_SENT,
+            3 * 1024 * 1024,
+            download_seconds=0.5,
+            send_seconds=1.5,
+            book_format="epub3.images",
+            url="https://www.gutenberg.org/ebooks/1234.epub3.images",
+            recipient="me@kindle.com",
+        ),
+        BookResult(5678, STATUS_DUPLICATE, 1024, duplicate_of=1234),
+        BookResult(9101, STATUS_NOT_DOWNLOADED, download_seconds=0.25),
+    ]
+
+
+@pytest.mark.parametrize(
+    ("statuses", "outcome", "exit_code"),
+    [
+        ([], report.OUTCOME_SUCCESS, 0),
+        ([STATUS_SENT, STATUS_DUPLICATE], report.OUTCOME_SUCCESS, 0),
+        ([STATUS_SENT, STATUS_NOT_DOWNLOADED], report.OUTCOME_PARTIAL_SUCCESS, 3),
+        ([STATUS_NOT_DOWNLOADED], report.OUTCOME_FAILURE, 1),
+    ],
+)
+def test_summarize_run_outcome(
+    statuses: list[str], outcome: str, exit_code: int
+) -> None:
+    """
+    Unit test to check that runs are a success when no book failed, and a
+    partial success when only some did
+    """
+
+    summary = report.summarize_run(
+        BookResult(book_id, status) for book_id, status in enumerate(statuses)
+    )
+    assert (summary.outcome, summary.exit_code) == (outcome, exit_code)
+
+
+def test_summarize_run() -> None:
+    """
+    Unit test to check the totals of a run, where only the books sent in it
+    count towards the bytes sent and the throughput
+    """
+
+    summary = report.summarize_run(_get_results(), 2.0)
+    assert summary == report.RunSummary(
+        report.OUTCOME_PARTIAL_SUCCESS, 3, 2, 1, 3 * 1024 * 1024, 0.75, 1.5, 2.0, 1.5
+    )
+    assert report.summarize_run(_get_results()).throughput_mb_per_second is None
+
+
+def test_write_json_report(tmp_path: Path) -> None:
+    """Unit test to check that JSON reports have the totals and every book"""
+
+    path = tmp_path / "report.json"
+    summary = report.write_report(str(path), "json", _get_results(), 2.0)
+
+    content = json.loads(path.read_text())
+    assert content["summary"]["outcome"] == summary.outcome
+    assert content["summary"]["throughput_mb_per_second"] == 1.5
+    assert [book["book_id"] for book in content["books"]] == [1234, 5678, 9101]
+    assert list(content["books"][0]) == list(report.REPORT_FIELDS)
+    assert content["books"][0]["url"] == (
+        "https://www.gutenberg.org/ebooks/1234.epub3.images"
+    )
+    assert content["books"][2]["status"] == STATUS_NOT_DOWNLOADED
+
+
+def test_write_csv_report(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Unit test to check that CSV reports have a row per book, and that the
+    totals are written as a single row to a file of their own
+    """
+
+    path = tmp_path / "report.csv"
+    report.write_report(str(path), "csv", _get_results())
+
+    with open(path, encoding="utf-8", newline="") as report_file:
+        rows = list(csv.DictReader(report_file))
+    assert [row["book_id"] for row in rows] == ["1234", "5678", "9101"]
+    assert list(rows[0]) == list(report.REPORT_FIELDS)
+    assert rows[0]["recipient"] == "me@kindle.com"
+    assert rows[1]["duplicate_of"] == "1234"
+    assert rows[2]["error"] == ""
+
+    with open(tmp_path / "report.summary.csv", encoding="utf-8", newline="") as file:
+        (summary,) = csv.DictReader(file)
+    assert list(summary) == list(report.SUMMARY_FIELDS)
+    assert summary["outcome"] == "partial_success"
+    assert summary["elapsed_seconds"] == ""
+    assert report.get_summary_path("report") == "report.summary.csv"
+
+    # bare filenames are written to the current directory
+    monkeypatch.chdir(tmp_path)
+    report.write_report("relative.csv", "csv", [])
+    assert (tmp_path / "relative.csv").exists()
+    assert (tmp_path / "relative.summary.csv").exists()
+
+    with pytest.raises(ValueError, match="xml is an invalid report format"):
+        report.write_report(str(path), "xml", [])
+
+
+def test_read_json_report(tmp_path: Path) -> None:
+    """
+    Unit test to check that the books of JSON reports can be read back and
+    merged, e.g. those of every shard of a job
+    """
+
+    first, second = tmp_path / "first.json", tmp_path / "second.json"
+    results = _get_results()
+    report.write_report(str(first), "json", results[1:])
+    assert report.read_json_report(str(first)) == results[1:]
+
+    # books in several reports keep the result of the last one
+    results[1] = BookResult(5678, STATUS_SENT, 1024)
+    report.write_report(str(second), "json", results[:2])
+    merged = report.merge_results(
+        report.read_json_report(str(first)), report.read_json_report(str(second))
+    )
+    assert merged == results
+
+    (tmp_path / "invalid.json").write_text('{"totals": {}}')
+    with pytest.raises(ValueError, match="is not a JSON report"):
+        report.read_json_report(str(tmp_path / "invalid.json"))
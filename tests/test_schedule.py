@@ -0,0 +1,45 @@
+"""Unit tests for the order in which the books of a batch are sent"""
+
+import pytest
+
+from gutenberg2kindle import schedule
+
+
+def test_parse_priority() -> None:
+    """Unit tests for parsing priorities given as `BOOK_ID:PRIORITY`"""
+
+    assert schedule.parse_priority("1234:5") == (1234, 5)
+    assert schedule.parse_priority("1:-2") == (1, -2)
+
+    for value in ("1234", "1234:", "a:5", "1234:high"):
+        with pytest.raises(ValueError, match="is not a book priority"):
+            schedule.parse_priority(value)
+
+
+def test_schedule_books() -> None:
+    """Unit tests for each scheduling policy"""
+
+    book_ids = [1, 2, 3, 4, 5]
+    sizes = {1: 300, 2: 100, 3: None, 4: 200, 5: 100}
+
+    assert schedule.schedule_books(book_ids, schedule.SCHEDULE_INPUT, sizes) == (
+        book_ids
+    )
+    assert schedule.schedule_books(
+        book_ids, schedule.SCHEDULE_SMALLEST_FIRST, sizes
+    ) == [2, 5, 4, 1, 3]
+    assert schedule.schedule_books(
+        book_ids, schedule.SCHEDULE_LARGEST_FIRST, sizes
+    ) == [1, 4, 2, 5, 3]
+
+    # priorities break ties, and reorder books given in order
+    priorities = {5: 1, 3: 2}
+    assert schedule.schedule_books(
+        book_ids, schedule.SCHEDULE_SMALLEST_FIRST, sizes, priorities
+    ) == [5, 2, 4, 1, 3]
+    assert schedule.schedule_books(
+        book_ids, schedule.SCHEDULE_INPUT, priorities=priorities
+    ) == [3, 5, 1, 2, 4]
+
+    with pytest.raises(ValueError, match="is an invalid schedule"):
+        schedule.schedule_books(book_ids, "random")
@@ -0,0 +1,165 @@
+"""Unit tests for the long-running server and its HTTP API"""
+
+import json
+import threading
+from http.client import HTTPConnection
+from http.server import ThreadingHTTPServer
+from io import BytesIO
+from typing import Any, Optional
+
+import pytest
+
+from gutenberg2kindle import api, server
+
+
+def _download_book(book_id: int, *_: object) -> Optional[BytesIO]:
+    if book_id == 404:
+        return None
+    return BytesIO(f"book content {book_id}".encode())
+
+
+pytestmark = pytest.mark.usefixtures("default_settings")
+
+
+def test_book_server_process(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Unit test for the processing of a job, book by book"""
+
+    def _send_book(book_id: int, *_: object) -> bool:
+        if book_id == 500:
+            raise OSError("connection dropped")
+        return book_id != 413
+
+    monkeypatch.setattr(api, "download_book", _download_book)
+    monkeypatch.setattr(api, "send_book", _send_book)
+    monkeypatch.setattr(api.time, "sleep", lambda _: None)
+
+    book_server = server.BookServer("m0ck-p4ssw0rd")
+    job = book_server.submit([1, 404, 413, 500, 2])
+    assert job.status == server.JOB_QUEUED
+
+    book_server.start()
+    book_server.stop()
+
+    assert book_server.get_job(job.job_id) is job
+    assert job.status == server.JOB_DONE
+    assert [(result.book_id, result.status) for result in job.results] == [
+        (1, api.STATUS_SENT),
+        (404, api.STATUS_NOT_DOWNLOADED),
+        (413, api.STATUS_TOO_LARGE),
+        (500, api.STATUS_SMTP_UNAVAILABLE),
+        (2, api.STATUS_SKIPPED),
+    ]
+    assert job.results[3].error == "connection dropped"
+    assert book_server.sender.budget.in_use == 0
+
+
+def test_book_server_failed_job(monkeypatch: pytest.MonkeyPatch) -> None:
+    """
+    Unit test to check that a job that fails unexpectedly is marked as
+    failed, and that the worker goes on with the next job
+    """
+
+    def _failing_download_book(book_id: int, *_: object) -> Optional[BytesIO]:
+        if book_id == 2:
+            raise OSError("disk full")
+        return _download_book(book_id)
+
+    monkeypatch.setattr(api, "download_book", _failing_download_book)
+    monkeypatch.setattr(api, "send_book", lambda *_: True)
+
+    book_server = server.BookServer("m0ck-p4ssw0rd")
+    failed_job = book_server.submit([1, 2, 3])
+    next_job = book_server.submit([4])
+
+    book_server.start()
+    last_job = book_server.submit([5])
+    book_server.stop()
+
+    assert failed_job.status == server.JOB_FAILED
+    assert failed_job.error == "OSError: disk full"
+    assert [(result.book_id, result.status) for result in failed_job.results] == [
+        (1, api.STATUS_SENT),
+        (2, api.STATUS_SKIPPED),
+        (3, api.STATUS_SKIPPED),
+    ]
+    assert next_job.status == server.JOB_DONE
+    assert [result.status for result in next_job.results] == [api.STATUS_SENT]
+    assert last_job.status == server.JOB_DONE
+
+
+def test_book_server_forgets_old_jobs(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Unit test to check that only the latest finished jobs are kept"""
+
+    monkeypatch.setattr(api, "download_book", _download_book)
+    monkeypatch.setattr(api, "send_book", lambda *_: True)
+
+    book_server = server.BookServer("m0ck-p4ssw0rd", max_finished_jobs=2)
+    jobs = [book_server.submit([book_id]) for book_id in range(1, 5)]
+    assert book_server.list_jobs() == jobs
+
+    book_server.start()
+    book_server.stop()
+
+    assert book_server.list_jobs() == jobs[2:]
+    assert book_server.get_job(jobs[0].job_id) is None
+    assert all(job.status == server.JOB_DONE for job in jobs)
+
+
+def test_http_api(monkeypatch: pytest.MonkeyPatch) -> None:
+    """Unit test for the HTTP API used to submit jobs and query their status"""
+
+    monkeypatch.setattr(api, "download_book", _download_book)
+    monkeypatch.setattr(api, "send_book", lambda *_: True)
+
+    book_server = server.BookServer("m0ck-p4ssw0rd")
+    http_server = server.create_http_server(book_server, port=0)
+    thread = threading.Thread(target=http_server.serve_forever, daemon=True)
+    thread.start()
+
+    assert isinstance(http_server, ThreadingHTTPServer)
+    host, port = http_server.server_name, http_server.server_port
+
+    def _request(method: str, path: str, body: Optional[Any] = None) -> Any:
+        connection = HTTPConnection(host, port)
+        connection.request(method, path, json.dumps(body) if body else None)
+        response = connection.getresponse()
+        payload = (response.status, json.loads(response.read()))
+        connection.close()
+        return payload
+
+    try:
+        status, job = _request("POST", "/jobs", {"book_ids": [1, 2]})
+        assert status == 202
+        assert job["book_ids"] == [1, 2]
+
+        assert _request("POST", "/jobs", {"book_ids": "1"})[0] == 400
+        assert _request("POST", "/other", {"book_ids": [1]})[0] == 404
+        assert _request("GET", "/jobs/1234")[0] == 404
+
+        book_server.start()
+        book_server.stop()
+
+        status, job = _request("GET", f"/jobs/{job['job_id']}")
+        assert status == 200
+        assert job["status"] == server.JOB_DONE
+        assert [result["status"] for result in job["results"]] == [
+            api.STATUS_SENT,
+            api.STATUS_SENT,
+        ]
+
+        status, jobs = _request("GET", "/jobs")
+        assert status == 200
+        assert len(jobs) == 1
+
+        status, queued_job = _request("POST", "/jobs", {"book_ids": [3]})
+        assert _request("DELETE", f"/jobs/{queued_job['job_id']}")[0] == 409
+
+        status, deleted_job = _request("DELETE", f"/jobs/{job['job_id']}")
+        assert status == 200
+        assert deleted_job["job_id"] == job["job_id"]
+        assert _request("GET", f"/jobs/{job['job_id']}")[0] == 404
+        assert _request("DELETE", f"/jobs/{job['job_id']}")[0] == 404
+        assert _request("DELETE", "/other")[0] == 404
+    finally:
+        http_server.shutdown()
+        http_server.server_close()
@@ -0,0 +1,125 @@
+"""Unit tests for splitting batches of books across processes"""
+
+import json
+import os
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import pytest
+
+from gutenberg2kindle import api, shard
+
+
+def test_parse_shard() -> None:
+    """Unit tests for parsing shards given as `INDEX/COUNT`"""
+
+    assert shard.parse_shard("0/4") == (0, 4)
+    assert shard.parse_shard("3/4") == (3, 4)
+
+    for value in ("4/4", "-1/4", "1", "a/b", "0/0"):
+        with pytest.raises(ValueError, match="is not a shard"):
+            shard.parse_shard(value)
+
+
+def test_shard_book_ids() -> None:
+    """Unit tests for the partition of books into shards"""
+
+    book_ids = list(range(1, 1001))
+    shards = [list(shard.shard_book_ids(book_ids, index, 4)) for index in range(4)]
+
+    assert sorted(sum(shards, [])) == book_ids
+    assert all(150 < len(book_ids_in_shard) < 350 for book_ids_in_shard in shards)
+
+    # shards only depend on the book IDs, not on their order
+    assert list(shard.shard_book_ids(reversed(book_ids), 1, 4)) == shards[1][::-1]
+
+
+def test_claim_directory(tmp_path: Path) -> None:
+    """Unit tests for claiming books, and saving and merging their results"""
+
+    claims = shard.ClaimDirectory(str(tmp_path))
+    book_ids = list(range(100))
+
+    # two processes going through the same books never claim the same one
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        first, second = executor.map(
+            lambda _: list(claims.claim_all(book_ids)), range(2)
+        )
+    assert sorted(first + second) == book_ids
+
+    assert not claims.claim(1)
+    claims.release(1)
+    claims.release(1)
+    assert claims.claim(1)
+
+    assert not claims.results()
+    claims.record(api.BookResult(5678, api.STATUS_NOT_DOWNLOADED, error="oops"))
+    claims.record(api.BookResult(1234, api.STATUS_SENT, 100))
+    assert claims.results() == [
+        api.BookResult(1234, api.STATUS_SENT, 100),
+        api.BookResult(5678, api.STATUS_NOT_DOWNLOADED, error="oops"),
+    ]
+
+
+def test_claim_directory_stale_claims(tmp_path: Path) -> None:
+    """
+    Unit tests for taking over stale claims, i.e. those whose owner is gone
+    or stopped sending heartbeats, unless the book already has a result
+    """
+
+    claims = shard.ClaimDirectory(str(tmp_path), stale_after=60)
+    other = shard.ClaimDirectory(str(tmp_path), stale_after=60)
+
+    # claims of a running process are kept, as long as they're touched
+    assert claims.claim(1)
+    assert not other.claim(1)
+    os.utime(claims.claim_path(1), (0, 0))
+    claims.heartbeat()
+    assert not other.claim(1)
+
+    # claims that weren't touched in time go stale
+    os.utime(claims.claim_path(1), (0, 0))
+    assert other.claim(1)
+    assert not claims.claim(1)
+
+    # claims of processes that aren't running anymore go stale at once
+    owner = {"host": socket.gethostname(), "pid": 2**22 + 1, "at": 0}
+    Path(claims.claim_path(2)).write_text(json.dumps(owner), encoding="utf-8")
+    assert not shard.is_owner_gone(json.dumps({**owner, "host": "elsewhere"}))
+    assert other.claim(2)
+
+    # books with a result are never claimed again
+    claims.record(api.BookResult(2, api.STATUS_SENT))
+    os.utime(claims.claim_path(2), (0, 0))
+    assert not claims.claim(2)
+    assert sorted(os.listdir(tmp_path / shard.CLAIMS_DIRNAME)) == ["1.claim", "2.claim"]
+
+
+def test_claim_directory_keep_alive(tmp_path: Path) -> None:
+    """Unit test to check that held claims are touched in the background"""
+
+    claims = shard.ClaimDirectory(str(tmp_path))
+    assert claims.claim(1) and claims.claim(2)
+    claims.release(2)
+    os.utime(claims.claim_path(1), (0, 0))
+
+    with claims.keep_alive(interval=0.01):
+        deadline = time.monotonic() + 5
+        while os.path.getmtime(claims.claim_path(1)) == 0:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+
+
+def test_claim_directory_release_held(tmp_path: Path) -> None:
+    """Unit test to check that the claims without a result are released"""
+
+    claims = shard.ClaimDirectory(str(tmp_path))
+    assert claims.claim(1) and claims.claim(2)
+    claims.record(api.BookResult(1, api.STATUS_SENT))
+
+    claims.release_held()
+
+    assert os.listdir(tmp_path / shard.CLAIMS_DIRNAME) == ["1.claim"]
+    assert shard.ClaimDirectory(str(tmp_path)).claim(2)
@@ -0,0 +1,65 @@
+"""Unit tests for the spool of books waiting to be emailed"""
+
+import os
+from pathlib import Path
+
+from gutenberg2kindle.spool import Spool
+
+
+def test_spool(tmp_path: Path) -> None:
+    """Unit tests for adding, listing, updating and removing spool entries"""
+
+    spool = Spool(str(tmp_path / "spool"))
+    assert not spool.entries()
+
+    first = spool.add(1234, b"first book", digest="abcd")
+    second = spool.add(5678, b"second volume", "5678_2.epub")
+    assert first.filename == "1234.epub"
+    assert first.size_in_bytes == len(b"first book")
+
+    # leftovers of a crash while spooling are not entries
+    (tmp_path / "spool" / "orphan.epub").write_bytes(b"orphan")
+    (tmp_path / "spool" / "partial.json.tmp").write_bytes(b"{")
+
+    assert spool.entries() == [first, second]
+    assert Path(spool.content_path(second.name)).read_bytes() == b"second volume"
+
+    first.attempts = 1
+    first.last_error = "smtp error!"
+    spool.update(first)
+    assert spool.entries()[0].last_error == "smtp error!"
+
+    spool.remove(first)
+    spool.remove(first)
+    assert spool.entries() == [second]
+    assert not os.path.exists(spool.content_path(first.name))
+
+
+def test_spool_claims(tmp_path: Path) -> None:
+    """
+    Unit tests for claiming entries to send them, so that concurrent
+    flushes never send the same entry, and for releasing claims
+    """
+
+    spool = Spool(str(tmp_path))
+    first = spool.add(1234, b"first book")
+    second = spool.add(5678, b"second book")
+
+    assert spool.claim(first)
+    assert not spool.claim(first)
+    assert spool.entries() == [second]
+
+    first.attempts = 1
+    spool.release(first)
+    assert spool.entries() == [first, second]
+    assert spool.entries()[0].attempts == 1
+
+    # stale claims, e.g. of a flush that crashed, are put back in the spool
+    assert spool.claim(first) and spool.claim(second)
+    os.utime(spool.claimed_path(first.name), (0, 0))
+    spool.release_stale_claims()
+    assert spool.entries() == [first]
+
+    spool.remove(second)
+    assert not os.path.exists(spool.claimed_path(second.name))
+    assert not os.path.exists(spool.content_path(second.name))